@@ -0,0 +1,37 @@
+"""add effective membership table
+
+Revision ID: 1e7d4b9a2c68
+Revises: 6c2f8e1a4d97
+Create Date: 2026-10-18 21:03:52.274118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1e7d4b9a2c68'
+down_revision: Union[str, Sequence[str], None] = '6c2f8e1a4d97'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('EffectiveMembership',
+    sa.Column('tg_id', sa.Text(), nullable=False),
+    sa.Column('level', sa.Integer(), nullable=False),
+    sa.Column('expires_at', sa.Date(), nullable=True),
+    sa.Column('is_paid', sa.Boolean(), nullable=False),
+    sa.Column('has_activity', sa.Boolean(), nullable=False),
+    sa.Column('activity_expires_at', sa.Date(), nullable=True),
+    sa.Column('refreshed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('tg_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('EffectiveMembership')
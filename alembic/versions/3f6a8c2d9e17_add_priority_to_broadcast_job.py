@@ -0,0 +1,30 @@
+"""add priority to broadcast job
+
+Revision ID: 3f6a8c2d9e17
+Revises: 9a4c7d1e3b56
+Create Date: 2026-10-18 16:32:51.604118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6a8c2d9e17'
+down_revision: Union[str, Sequence[str], None] = '9a4c7d1e3b56'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # existing jobs get the lowest priority, the same as club broadcasts
+    op.add_column('BroadcastJob', sa.Column('priority', sa.Integer(), nullable=False, server_default='2'))
+    op.alter_column('BroadcastJob', 'priority', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('BroadcastJob', 'priority')
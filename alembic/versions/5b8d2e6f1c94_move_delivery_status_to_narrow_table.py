@@ -0,0 +1,50 @@
+"""move delivery status to narrow table
+
+Revision ID: 5b8d2e6f1c94
+Revises: e7b3d9c05a18
+Create Date: 2026-10-18 14:21:37.550812
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8d2e6f1c94'
+down_revision: Union[str, Sequence[str], None] = 'e7b3d9c05a18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('DeliveryStatus',
+    sa.Column('tg_id', sa.Text(), nullable=False),
+    sa.Column('is_last_message_successful', sa.Boolean(), nullable=False),
+    sa.Column('last_message_try_time', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('tg_id')
+    )
+    op.execute('''
+        INSERT INTO "DeliveryStatus" (tg_id, is_last_message_successful, last_message_try_time)
+        SELECT tg_id, is_last_message_successful, COALESCE(last_message_try_time, now() AT TIME ZONE 'utc')
+        FROM "Users"
+        WHERE is_last_message_successful IS NOT NULL
+    ''')
+    op.drop_column('Users', 'last_message_try_time')
+    op.drop_column('Users', 'is_last_message_successful')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('Users', sa.Column('is_last_message_successful', sa.Boolean(), nullable=True))
+    op.add_column('Users', sa.Column('last_message_try_time', sa.DateTime(), nullable=True))
+    op.execute('''
+        UPDATE "Users"
+        SET is_last_message_successful = ds.is_last_message_successful,
+            last_message_try_time = ds.last_message_try_time
+        FROM "DeliveryStatus" ds
+        WHERE ds.tg_id = "Users".tg_id
+    ''')
+    op.drop_table('DeliveryStatus')
@@ -0,0 +1,42 @@
+"""add suppression and retry schedule to delivery status
+
+Revision ID: 9a4c7d1e3b56
+Revises: 5b8d2e6f1c94
+Create Date: 2026-10-18 15:47:09.183224
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4c7d1e3b56'
+down_revision: Union[str, Sequence[str], None] = '5b8d2e6f1c94'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('DeliveryStatus', sa.Column('last_error', sa.Text(), nullable=True))
+    op.add_column('DeliveryStatus', sa.Column('temporary_failure_count', sa.Integer(), nullable=False,
+                                              server_default='0'))
+    op.add_column('DeliveryStatus', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+    op.add_column('DeliveryStatus', sa.Column('is_suppressed', sa.Boolean(), nullable=False,
+                                              server_default=sa.false()))
+    op.alter_column('DeliveryStatus', 'temporary_failure_count', server_default=None)
+    op.alter_column('DeliveryStatus', 'is_suppressed', server_default=None)
+    # broadcasts check this on every audience resolution, most users are never in it
+    op.create_index('ix_delivery_status_unreachable', 'DeliveryStatus', ['tg_id'],
+                    postgresql_where=sa.text('is_suppressed OR next_attempt_at IS NOT NULL'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_delivery_status_unreachable', table_name='DeliveryStatus')
+    op.drop_column('DeliveryStatus', 'is_suppressed')
+    op.drop_column('DeliveryStatus', 'next_attempt_at')
+    op.drop_column('DeliveryStatus', 'temporary_failure_count')
+    op.drop_column('DeliveryStatus', 'last_error')
@@ -0,0 +1,35 @@
+"""add deadline and send rate to broadcast job
+
+Revision ID: b2e9f4a7c130
+Revises: 3f6a8c2d9e17
+Create Date: 2026-10-18 17:40:26.771093
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2e9f4a7c130'
+down_revision: Union[str, Sequence[str], None] = '3f6a8c2d9e17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('BroadcastJob', sa.Column('deadline_at', sa.DateTime(), nullable=True))
+    op.add_column('BroadcastJob', sa.Column('attempted_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('BroadcastJob', sa.Column('send_duration_seconds', sa.Float(), nullable=False,
+                                            server_default='0'))
+    op.alter_column('BroadcastJob', 'attempted_count', server_default=None)
+    op.alter_column('BroadcastJob', 'send_duration_seconds', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('BroadcastJob', 'send_duration_seconds')
+    op.drop_column('BroadcastJob', 'attempted_count')
+    op.drop_column('BroadcastJob', 'deadline_at')
@@ -0,0 +1,50 @@
+"""add tables for durable broadcast jobs
+
+Revision ID: c4e1f2a9b7d3
+Revises: a25d459f4fa3
+Create Date: 2026-10-18 11:02:13.412907
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e1f2a9b7d3'
+down_revision: Union[str, Sequence[str], None] = 'a25d459f4fa3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('BroadcastJob',
+    sa.Column('id', sa.BigInteger(), autoincrement=True, nullable=False),
+    sa.Column('name', sa.Text(), nullable=False),
+    sa.Column('idempotency_key', sa.Text(), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.Column('report_chat_id', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('idempotency_key', name='Unique_broadcast_idempotency_key')
+    )
+    op.create_table('BroadcastRecipient',
+    sa.Column('job_id', sa.BigInteger(), nullable=False),
+    sa.Column('tg_id', sa.Text(), nullable=False),
+    sa.Column('status', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['job_id'], ['BroadcastJob.id'], name='fk_valid_broadcast_job_id', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('job_id', 'tg_id')
+    )
+    op.create_index('ix_broadcast_recipient_job_id_status', 'BroadcastRecipient', ['job_id', 'status'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_broadcast_recipient_job_id_status', table_name='BroadcastRecipient')
+    op.drop_table('BroadcastRecipient')
+    op.drop_table('BroadcastJob')
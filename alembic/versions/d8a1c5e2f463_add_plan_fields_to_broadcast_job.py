@@ -0,0 +1,30 @@
+"""add plan fields to broadcast job
+
+Revision ID: d8a1c5e2f463
+Revises: b2e9f4a7c130
+Create Date: 2026-10-18 18:55:12.093417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8a1c5e2f463'
+down_revision: Union[str, Sequence[str], None] = 'b2e9f4a7c130'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('BroadcastJob', sa.Column('start_at', sa.DateTime(), nullable=True))
+    op.add_column('BroadcastJob', sa.Column('plan_fingerprint', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('BroadcastJob', 'plan_fingerprint')
+    op.drop_column('BroadcastJob', 'start_at')
@@ -0,0 +1,33 @@
+"""add audience spec to broadcast job
+
+Revision ID: e7b3d9c05a18
+Revises: c4e1f2a9b7d3
+Create Date: 2026-10-18 12:24:51.730264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7b3d9c05a18'
+down_revision: Union[str, Sequence[str], None] = 'c4e1f2a9b7d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('BroadcastJob', sa.Column('audience', sa.JSON(), nullable=True))
+    # jobs created before this migration stored all recipients upfront
+    op.add_column('BroadcastJob', sa.Column('is_audience_resolved', sa.Boolean(), nullable=False,
+                                            server_default=sa.true()))
+    op.alter_column('BroadcastJob', 'is_audience_resolved', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('BroadcastJob', 'is_audience_resolved')
+    op.drop_column('BroadcastJob', 'audience')
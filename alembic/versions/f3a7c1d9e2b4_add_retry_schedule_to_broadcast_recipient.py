@@ -0,0 +1,32 @@
+"""add retry schedule to broadcast recipient
+
+Revision ID: f3a7c1d9e2b4
+Revises: 1e7d4b9a2c68
+Create Date: 2026-10-18 19:12:41.506318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a7c1d9e2b4'
+down_revision: Union[str, Sequence[str], None] = '1e7d4b9a2c68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('BroadcastRecipient', sa.Column('attempt_count', sa.Integer(), nullable=False,
+                                                  server_default='0'))
+    op.add_column('BroadcastRecipient', sa.Column('retry_at', sa.DateTime(), nullable=True))
+    op.alter_column('BroadcastRecipient', 'attempt_count', server_default=None)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('BroadcastRecipient', 'retry_at')
+    op.drop_column('BroadcastRecipient', 'attempt_count')
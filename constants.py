@@ -126,6 +126,8 @@ enroll_description = "Бот будет присылать тебе с ссыл
 unenroll_description = "Бот больше не будет присылать тебе новости о потоке"
 
 before_call_reminder = "Обсуждаем {} через 5 минут!"
+# for big courses the reminder starts earlier, "мин" doesn't need plural forms
+before_call_reminder_in_minutes = "Обсуждаем {} через {} мин!"
 
 leetcode_register_ask_timeslots = ("В какое время можешь созвониться? Чем больше слотов отметишь, тем больше "
                                    "вероятность, что я смогу найти тебе парнера! Время указано по Москве. "
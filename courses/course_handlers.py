@@ -1,7 +1,8 @@
 import logging
 
-from sqlalchemy import exists, select
+from sqlalchemy import delete, exists, select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, User
@@ -28,29 +29,28 @@ def is_course_pro(course_id: int) -> bool:
         return False
 
 
-def user_is_enrolled(tg_user: User, course_id: int) -> bool:
-    with Session(models.engine) as session:
-        users_exists = session.scalar(
+# Interactive handlers below use async sessions: while one user waits for Postgres, updates of other users go on
+
+async def user_is_enrolled(tg_user: User, course_id: int, course_name: str) -> bool:
+    async with AsyncSession(models.async_engine) as session:
+        users_exists = await session.scalar(
             select(exists().where(
                 (models.Enrollment.tg_id == str(tg_user.id)) & (models.Enrollment.course_id == course_id))
             )
         )
     if users_exists:
-        logging.info(f"user is already enrolled in {course_helpers.get_course_name(course_id)}: {helpers.repr_user(tg_user)}")
+        logging.info(f"user is already enrolled in {course_name}: {helpers.repr_user(tg_user)}")
     else:
-        logging.info(
-            f"user is not already enrolled in {course_helpers.get_course_name(course_id)}: {helpers.repr_user(tg_user)}")
+        logging.info(f"user is not already enrolled in {course_name}: {helpers.repr_user(tg_user)}")
     return users_exists
 
 
-async def handle_course_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    course_id = context.user_data["callback_course_id"]
-    del context.user_data["callback_course_id"]
-    logging.info(f"handle_course_info for {course_helpers.get_course_name(course_id)} triggered by "
-                 f"{helpers.repr_user_from_update(update)}")
+async def handle_course_info(update: Update, context: ContextTypes.DEFAULT_TYPE, course_id: int) -> None:
+    course_name: str = await course_helpers.get_course_name_async(course_id)
+    logging.info(f"handle_course_info for {course_name} triggered by {helpers.repr_user_from_update(update)}")
 
     tg_user = helpers.get_user(update)
-    if user_is_enrolled(tg_user, course_id):
+    if await user_is_enrolled(tg_user, course_id, course_name):
         button_list = [
             InlineKeyboardButton("Перестать получать уведомления", callback_data=f"unenroll:{course_id}"),
             InlineKeyboardButton("Назад", callback_data="back_to_courses"),
@@ -77,10 +77,10 @@ async def handle_active_courses(update: Update, context: ContextTypes.DEFAULT_TY
 
     tg_id = str(update.effective_user.id)
 
-    with Session(models.engine) as session:
-        active_courses = session.query(models.Course).filter(models.Course.is_active.is_(True)).all()
-        user_enrollments = session.query(models.Enrollment.course_id).filter(models.Enrollment.tg_id == tg_id).all()
-        enrolled_course_ids = {e.course_id for e in user_enrollments}
+    async with AsyncSession(models.async_engine) as session:
+        active_courses = (await session.scalars(select(models.Course).where(models.Course.is_active.is_(True)))).all()
+        enrolled_course_ids = set(await session.scalars(
+            select(models.Enrollment.course_id).where(models.Enrollment.tg_id == tg_id)))
 
         logging.info(f"{active_courses=}")
         logging.info(f"{enrolled_course_ids=}")
@@ -114,27 +114,25 @@ async def handle_active_courses(update: Update, context: ContextTypes.DEFAULT_TY
         )
 
 
-async def handle_enroll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    course_id: int = context.user_data["callback_course_id"]
-    course_name: str = course_helpers.get_course_name(course_id)
-    del context.user_data["callback_course_id"]
+async def handle_enroll(update: Update, context: ContextTypes.DEFAULT_TYPE, course_id: int) -> None:
+    course_name: str = await course_helpers.get_course_name_async(course_id)
     logging.info(f"enroll for {course_name} handled by {helpers.repr_user_from_update(update)}")
 
     tg_user = helpers.get_user(update)
-    with Session(models.engine) as session:
+    async with AsyncSession(models.async_engine) as session:
         enrollment = models.Enrollment(
             course_id=course_id,
-            tg_id=tg_user.id
+            tg_id=str(tg_user.id)
         )
         session.add(enrollment)
         try:
-            session.commit()
+            await session.commit()
             logging.info(f"Add user enrollment to {course_name} to db: {helpers.repr_user(tg_user)}")
         except IntegrityError as e:
-            session.rollback()
+            await session.rollback()
             logging.info(f"Didn't add user {helpers.repr_user(tg_user)} enrollment to {course_name} to db: {e}")
         except Exception as e:
-            session.rollback()
+            await session.rollback()
             logging.warning(f"Couldn't add user enrollment to {course_name}: {e}")
     button_list = [
         InlineKeyboardButton("Перестать получать уведомления", callback_data=f"unenroll:{course_id}"),
@@ -148,21 +146,19 @@ async def handle_enroll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
-async def handle_unenroll(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    course_id: int = context.user_data["callback_course_id"]
-    course_name: str = course_helpers.get_course_name(course_id)
-    del context.user_data["callback_course_id"]
+async def handle_unenroll(update: Update, context: ContextTypes.DEFAULT_TYPE, course_id: int) -> None:
+    course_name: str = await course_helpers.get_course_name_async(course_id)
     logging.info(f"unenroll for {course_name} handled by {helpers.repr_user_from_update(update)}")
 
     tg_user = helpers.get_user(update)
-    with Session(models.engine) as session:
+    async with AsyncSession(models.async_engine) as session:
         try:
-            session.query(models.Enrollment).filter(
-                (models.Enrollment.tg_id == str(tg_user.id)) & (models.Enrollment.course_id == course_id)).delete()
-            session.commit()
+            await session.execute(delete(models.Enrollment).where(
+                (models.Enrollment.tg_id == str(tg_user.id)) & (models.Enrollment.course_id == course_id)))
+            await session.commit()
             logging.info(f"Deleted user enrollment to {course_name} from db: {helpers.repr_user(tg_user)}")
         except Exception as e:
-            session.rollback()
+            await session.rollback()
             logging.error(f"Couldn't delete user enrollment to {course_name}: {e}")
             raise e  # to propagate it to error handler
 
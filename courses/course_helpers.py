@@ -1,3 +1,5 @@
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 import models
@@ -10,3 +12,11 @@ def get_course_name(course_id: int) -> str:
         return result.name
     else:
         raise Exception(f"Invalid course_id: {course_id}")
+
+
+async def get_course_name_async(course_id: int) -> str:
+    async with AsyncSession(models.async_engine) as session:
+        name = await session.scalar(select(models.Course.name).where(models.Course.id == course_id))
+    if name is None:
+        raise Exception(f"Invalid course_id: {course_id}")
+    return name
@@ -1,8 +1,6 @@
 import os
 import logging
 import math
-from typing import Callable
-
 from dotenv import load_dotenv
 
 from sqlalchemy.orm import Session
@@ -16,8 +14,9 @@ import helpers
 import models
 import settings
 from certificates import create_certificates
-from monitoring import push_monitoring, update_users_in_db
-from membership import fetch_patrons, fetch_boosty_patrons, membership, update_membership
+from monitoring import push_monitoring
+from membership import fetch_patrons, fetch_boosty_patrons, membership, patron_refresher, update_membership
+from notifications import broadcast_engine, broadcast_jobs, rendering
 
 
 def is_admin_id(tg_id: int) -> bool:
@@ -112,18 +111,19 @@ async def get_users_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def get_patreon_summary(context: ContextTypes.DEFAULT_TYPE) -> (int, str):
-    await fetch_patrons.load_patrons(context.bot)
+    await patron_refresher.refresh_if_older(context.bot, patron_refresher.PATREON,
+                                            settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS)
+    summary = fetch_patrons.get_patrons_summary("active_patron")
     active_patreon_patrons = fetch_patrons.get_patrons_from_redis("active_patron")
     logging.info(f"active_patrons are {active_patreon_patrons}")
-    active_patrons_count = len(active_patreon_patrons)
-    patreon_total_sum = sum(int(patron[1]) for patron in active_patreon_patrons)
     patreon_subscribers_str = "\n - ".join([', '.join(patron) for patron in active_patreon_patrons])
-    return active_patrons_count, (f"You have {active_patrons_count} active Patreon patrons with total sum of "
-                                  f"${patreon_total_sum // 100}:\n\n - {patreon_subscribers_str}")
+    return summary.count, (f"You have {summary.count} active Patreon patrons with total sum of "
+                           f"${summary.total // 100}:\n\n - {patreon_subscribers_str}")
 
 
 async def get_boosty_summary(context: ContextTypes.DEFAULT_TYPE) -> (int, str):
-    await fetch_boosty_patrons.load_boosty_patrons(context.bot)
+    await patron_refresher.refresh_if_older(context.bot, patron_refresher.BOOSTY,
+                                            settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS)
     active_boosty_patrons = fetch_boosty_patrons.get_boosty_patrons_from_redis(min_price_rub=1500)
 
     logging.info(f"active_boosty_patrons are {active_boosty_patrons}")
@@ -210,44 +210,37 @@ async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 @is_admin
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, reply_markup: InlineKeyboardMarkup = None,
-                    user_filter: Callable[[int], bool] = None) \
+                    audience_spec: dict = None) \
         -> int:
     logging.info(f"broadcast handler triggered by {helpers.repr_user_from_update(update)}")
 
-    with Session(models.engine) as session:
-        users = session.query(models.User).all()
-        logging.info(f"got {len(users)} users from db for broadcast")
-
-    if user_filter:
-        users = [user for user in users if user_filter(user.tg_id)]
-        logging.info(f"got {len(users)} after filtering")
-
-    successful_count = 0
-    failed_ids = []
-    for user in users:
-        if (successful_count + len(failed_ids)) % 50 == 0:
-            logging.info(f"Notification broadcast in progress: {successful_count} successful, "
-                         f"{len(failed_ids)} failed so far")
-        try:
-            await context.bot.copy_message(
-                chat_id=user.tg_id,
-                from_chat_id=update.effective_chat.id,
-                message_id=update.message.message_id,
-                reply_markup=reply_markup
-            )
-            successful_count += 1
-        except Exception as e:
-            failed_ids.append(user.tg_id)
+    job_id = broadcast_jobs.create_job(
+        name="club",
+        idempotency_key=f"broadcast:{update.effective_chat.id}:{update.message.message_id}",
+        payload=rendering.copy_payload(update.message, reply_markup),
+        audience_spec=audience_spec or {"kind": "all_users"},
+        priority=broadcast_engine.CLUB_PRIORITY,
+        report_chat_id=str(update.effective_chat.id),
+    )
+    await start_broadcast_job(update, context, job_id)
+    return ConversationHandler.END
 
-    success_ids = list(set([user.tg_id for user in users]) - set(failed_ids))
-    await update_users_in_db.update_users_after_broadcast(success_ids, failed_ids)
 
-    logging.info(f"Successfully broadcast message to {successful_count} users, failed {len(failed_ids)} users.")
+async def start_broadcast_job(update: Update, context: ContextTypes.DEFAULT_TYPE, job_id: int | None) -> None:
+    if job_id is None:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="This message was already broadcast, not sending it again."
+        )
+        return
+
+    # the job runs in the background, so the bot keeps answering updates (including /broadcast_pause) meanwhile
+    context.application.create_task(broadcast_jobs.run_job(context.bot, job_id), name=f"broadcast_job_{job_id}")
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f"Successfully broadcast to {successful_count} users, failed {len(failed_ids)} users."
+        text=f"Started broadcast job #{job_id}, will report when it's done. Use /broadcast_pause {job_id}, "
+             f"/broadcast_resume {job_id} or /broadcast_cancel {job_id} to control it."
     )
-    return ConversationHandler.END
 
 
 @is_any_curator
@@ -272,6 +265,83 @@ broadcast_conv_handler = ConversationHandler(
 )
 
 
+async def get_broadcast_job_from_args(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str) \
+        -> models.BroadcastJob | None:
+    if len(context.args) != 1 or not context.args[0].isnumeric():
+        await update.message.reply_text(f"Usage: /{command} <job_id>")
+        return None
+
+    job = broadcast_jobs.get_job(int(context.args[0]))
+    if not job:
+        await update.message.reply_text(f"There's no broadcast job {context.args[0]}")
+        return None
+    return job
+
+
+@is_admin
+async def broadcast_jobs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.info(f"broadcast_jobs_handler triggered by {helpers.repr_user_from_update(update)}")
+
+    jobs = broadcast_jobs.get_unfinished_jobs()
+    if not jobs:
+        await update.message.reply_text("There are no unfinished broadcast jobs")
+        return
+
+    lines = []
+    for job in jobs:
+        counts = broadcast_jobs.get_recipient_counts(job.id)
+        lines.append(f"#{job.id} {job.name}, {job.status}: {counts.get(broadcast_jobs.SENT, 0)} sent, "
+                     f"{counts.get(broadcast_jobs.FAILED, 0)} failed, {counts.get(broadcast_jobs.PENDING, 0)} pending")
+    jobs_str = "\n - ".join(lines)
+    await update.message.reply_text(f"Unfinished broadcast jobs:\n - {jobs_str}")
+
+
+@is_admin
+async def broadcast_pause_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.info(f"broadcast_pause_handler triggered by {helpers.repr_user_from_update(update)}")
+
+    job = await get_broadcast_job_from_args(update, context, "broadcast_pause")
+    if not job:
+        return
+    if job.status != broadcast_jobs.RUNNING:
+        await update.message.reply_text(f"Broadcast job #{job.id} is {job.status}, can't pause it")
+        return
+
+    broadcast_jobs.set_job_status(job.id, broadcast_jobs.PAUSED)
+    await update.message.reply_text(f"Paused broadcast job #{job.id} {job.name}, the current batch will be finished")
+
+
+@is_admin
+async def broadcast_resume_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.info(f"broadcast_resume_handler triggered by {helpers.repr_user_from_update(update)}")
+
+    job = await get_broadcast_job_from_args(update, context, "broadcast_resume")
+    if not job:
+        return
+    if job.status != broadcast_jobs.PAUSED:
+        await update.message.reply_text(f"Broadcast job #{job.id} is {job.status}, can't resume it")
+        return
+
+    broadcast_jobs.set_job_status(job.id, broadcast_jobs.RUNNING)
+    context.application.create_task(broadcast_jobs.run_job(context.bot, job.id), name=f"broadcast_job_{job.id}")
+    await update.message.reply_text(f"Resumed broadcast job #{job.id} {job.name}")
+
+
+@is_admin
+async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.info(f"broadcast_cancel_handler triggered by {helpers.repr_user_from_update(update)}")
+
+    job = await get_broadcast_job_from_args(update, context, "broadcast_cancel")
+    if not job:
+        return
+    if job.status not in (broadcast_jobs.PLANNED, broadcast_jobs.RUNNING, broadcast_jobs.PAUSED):
+        await update.message.reply_text(f"Broadcast job #{job.id} is {job.status}, can't cancel it")
+        return
+
+    broadcast_jobs.set_job_status(job.id, broadcast_jobs.CANCELLED)
+    await update.message.reply_text(f"Cancelled broadcast job #{job.id} {job.name}")
+
+
 BROADCAST_BASIC_MEMBERS = 1
 
 
@@ -289,8 +359,7 @@ async def start_broadcast_basic_members(update: Update, context: ContextTypes.DE
 async def broadcast_basic_members(update: Update, context: ContextTypes.DEFAULT_TYPE, reply_markup: InlineKeyboardMarkup = None) \
         -> int:
     logging.info(f"broadcast_basic_members handler triggered by {helpers.repr_user_from_update(update)}")
-    return await broadcast(update, context, reply_markup, lambda tg_id: membership.get_user_membership_info(tg_id).
-                           get_overall_level() == membership.basic)
+    return await broadcast(update, context, reply_markup, {"kind": "all_users", "level": membership.basic.number})
 
 
 @is_any_curator
@@ -330,19 +399,7 @@ async def broadcast_no_active_course(update: Update, context: ContextTypes.DEFAU
         -> int:
     logging.info(f"broadcast_no_active_course handler triggered by {helpers.repr_user_from_update(update)}")
 
-    with Session(models.engine) as session:
-        active_tg_ids = {
-            row[0]
-            for row in (
-                session.query(models.Enrollment.tg_id)
-                .join(models.Course, models.Course.id == models.Enrollment.course_id)
-                .filter(models.Course.is_active.is_(True))
-                .distinct()
-                .all()
-            )
-        }
-
-    return await broadcast(update, context, reply_markup, lambda tg_id: tg_id not in active_tg_ids)
+    return await broadcast(update, context, reply_markup, {"kind": "all_users", "without_active_course": True})
 
 
 @is_any_curator
@@ -405,55 +462,22 @@ async def do_broadcast_course(update: Update, context: ContextTypes.DEFAULT_TYPE
                               membership_filter: membership.MembershipLevel = None) -> int:
     course_name = course_helpers.get_course_name(course_id)
     logging.info(f"do_broadcast_course for {course_name} triggered by {helpers.repr_user_from_update(update)}")
-    with Session(models.engine) as session:
-        course_enrollments = session.query(models.Enrollment.tg_id).filter(
-            models.Enrollment.course_id == course_id).all()
-        tg_ids = [tg_id for (tg_id,) in course_enrollments]
-        logging.info(f"got {len(tg_ids)} users from db for {course_name} broadcast")
-
-        if membership_filter:
-            tg_ids = [tg_id for tg_id in tg_ids if
-                      membership.get_user_membership_info(tg_id).get_overall_level() == membership_filter]
-            logging.info(f"got {len(tg_ids)} users after filtering for {membership_filter}")
-
-    successful_count = 0
-    failed_ids = []
-    msg = update.message
-    signature = f"\n\n---\n@{helpers.get_user(update).username} для курса {course_name}"
-
-    for tg_id in tg_ids:
-        if (successful_count + len(failed_ids)) % 50 == 0:
-            logging.info(f"Course broadcast in progress: {successful_count} successful, "
-                         f"{len(failed_ids)} failed so far")
-        try:
-            if msg.photo:
-                await context.bot.send_photo(
-                    chat_id=tg_id,
-                    photo=msg.photo[-1].file_id,
-                    caption=(msg.caption or "") + signature,
-                    caption_entities=msg.caption_entities,
-                    reply_markup=reply_markup
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=tg_id,
-                    text=(msg.text or "") + signature,
-                    entities=msg.entities,
-                    reply_markup=reply_markup
-                )
-            successful_count += 1
-        except Exception as e:
-            failed_ids.append(tg_id)
-
-    logging.info(f"Successfully {course_name} broadcast to {successful_count} users, failed {len(failed_ids)} users.")
-
-    success_ids = list(set(tg_ids) - set(failed_ids))
-    await update_users_in_db.update_users_after_broadcast(success_ids, failed_ids)
+    audience_spec = {"kind": "course", "course_id": course_id}
+    if membership_filter:
+        audience_spec["level"] = membership_filter.number
 
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=f"Successfully {course_name} broadcast to {successful_count} users, failed {len(failed_ids)} users."
+    signature = f"\n\n---\n@{helpers.get_user(update).username} для курса {course_name}"
+    payload = rendering.render_message(update.message, signature, reply_markup)
+
+    job_id = broadcast_jobs.create_job(
+        name=course_name,
+        idempotency_key=f"course_broadcast:{course_id}:{update.effective_chat.id}:{update.message.message_id}",
+        payload=payload,
+        audience_spec=audience_spec,
+        priority=broadcast_engine.COURSE_PRIORITY,
+        report_chat_id=str(update.effective_chat.id),
     )
+    await start_broadcast_job(update, context, job_id)
     return ConversationHandler.END
 
 
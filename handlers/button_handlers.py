@@ -17,19 +17,24 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
     handlers_dict = {
         "back_to_courses": course_handlers.handle_active_courses,
-        "course_info": course_handlers.handle_course_info,
         "back_to_ddia": handle_back_to_ddia,
-        "enroll": course_handlers.handle_enroll,
-        "unenroll": course_handlers.handle_unenroll,
         "how_to_present": handle_how_to_present,
         "disconnect_patreon": patreon_handlers.disconnect_patreon_handler,
         "disconnect_boosty": boosty_handlers.disconnect_boosty_handler,
     }
 
-    command: str = query.data
-    if ":" in query.data:
-        context.user_data["callback_course_id"] = int(query.data.split(":")[1])
-        command = query.data.split(":")[0]
+    # course buttons carry the course id, it's passed to the handler instead of being stored in user_data, where
+    # another click of the same user handled concurrently could replace it
+    course_handlers_dict = {
+        "course_info": course_handlers.handle_course_info,
+        "enroll": course_handlers.handle_enroll,
+        "unenroll": course_handlers.handle_unenroll,
+    }
+
+    command, _, course_id = query.data.partition(":")
+    if command in course_handlers_dict and course_id:
+        await course_handlers_dict[command](update, context, int(course_id))
+        return
 
     handler = handlers_dict.get(command)
     if handler:
@@ -38,9 +43,9 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         logging.warning(f"Unhandled callback query data: {command} by {helpers.repr_user_from_update(update)}")
 
 
-async def handle_back_to_ddia(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+async def handle_back_to_ddia(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.info(f"back_to_ddia triggered by {helpers.repr_user_from_update(update)}")
-    await course_handlers.handle_course_info(update, constants.ddia_4_course_id)
+    await course_handlers.handle_course_info(update, context, constants.ddia_4_course_id)
 
 
 async def handle_how_to_present(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
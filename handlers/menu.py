@@ -1,5 +1,5 @@
 import logging
-from telegram import Update
+from telegram import Chat, ChatMember, Update
 from telegram.ext import ContextTypes
 
 import sqlalchemy
@@ -9,6 +9,7 @@ from sqlalchemy.exc import IntegrityError
 import constants
 import helpers
 from models import MembershipByActivity, User, engine
+from monitoring import delivery_ledger
 
 
 HELP_TEXT = ("<b>Поддерживаемые команды:</b>\n"
@@ -66,6 +67,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 logging.info(f"User {helpers.repr_user_from_update(update)} has a membership by activity, back-filling "
                              f"tg_id in MembershipByActivity")
 
+    # the user may have blocked the bot before, now broadcasts can reach them again
+    delivery_ledger.set_suppressed(tg_user.id, False)
+
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=constants.club_description + "\n\n" + HELP_TEXT,
@@ -73,6 +77,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def bot_blocked_or_unblocked(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Telegram sends my_chat_member when a user blocks or unblocks the bot in a private chat
+    change = update.my_chat_member
+    if change.chat.type != Chat.PRIVATE:
+        return
+    logging.info(f"bot status changed from {change.old_chat_member.status} to {change.new_chat_member.status} "
+                 f"for {helpers.repr_user_from_update(update)}")
+    if change.new_chat_member.status == ChatMember.BANNED:
+        delivery_ledger.set_suppressed(change.chat.id, True)
+    elif change.new_chat_member.status == ChatMember.MEMBER:
+        delivery_ledger.set_suppressed(change.chat.id, False)
+
+
 async def command_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.info(f"help triggered by {helpers.repr_user_from_update(update)}")
     await context.bot.send_message(
@@ -1,14 +1,16 @@
 import logging
-from telegram.ext import (filters, ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-                          PicklePersistence)
+from telegram.ext import (filters, ApplicationBuilder, ChatMemberHandler, CommandHandler, MessageHandler,
+                          CallbackQueryHandler, PicklePersistence)
 
 from courses import course_handlers
 from handlers import admin_commands, button_handlers, menu, leetcode_mock_handlers
 from users import intro_handler, email_contact_handler, location_handler
-from notifications import notifications
+from notifications import broadcast_jobs, email_outbox, email_sender, notifications
 from membership import (boosty_handlers, fetch_patrons, fetch_boosty_patrons, club_points, membership,
-                        patreon_handlers, convert_points_to_membership)
+                        patreon_handlers, patreon_webhook, patron_cache, patron_refresher,
+                        convert_points_to_membership)
 from monitoring import calculate_metrics_and_report
+import models
 import settings
 from leetcode_pairs import leetcode_notifications
 
@@ -22,20 +24,34 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 async def post_init(app):
     await convert_points_to_membership.register_convert_points_to_membership(app)
     await notifications.register_notifications(app)
+    email_outbox.start_worker()
+    await broadcast_jobs.resume_unfinished_jobs(app)
     await leetcode_notifications.register_leetcode_pairs_notification(application)
-    await fetch_patrons.load_patrons(app.bot)
+    await fetch_patrons.init()
     await fetch_boosty_patrons.init()
-    await fetch_boosty_patrons.load_boosty_patrons(app.bot)
+    await patron_refresher.refresh_all(app.bot)
+    patron_refresher.register(app)
+    await patreon_webhook.start(app.bot)
     await calculate_metrics_and_report.calculate_metrics_and_report(app.bot)
 
 
 async def post_shutdown(_unused_arg):
+    await patreon_webhook.stop()
+    await fetch_patrons.close()
     await fetch_boosty_patrons.close()
+    await email_outbox.stop_worker()
+    await email_sender.pool.close()
+    await patron_cache.async_r.aclose()
+    await models.async_engine.dispose()
 
 
 if __name__ == '__main__':
     persistence = PicklePersistence(filepath="nelenkin_bot_pickle")
-    application = ApplicationBuilder().token(settings.TELEGRAM_TOKEN).persistence(persistence).build()
+    application = (ApplicationBuilder()
+                   .token(settings.TELEGRAM_TOKEN)
+                   .persistence(persistence)
+                   .connection_pool_size(settings.TELEGRAM_CONNECTION_POOL_SIZE)
+                   .build())
 
     # conversation handlers
     application.add_handler(admin_commands.echo_conv_handler)
@@ -63,11 +79,11 @@ if __name__ == '__main__':
     application.add_handler(
         CommandHandler('help', menu.command_help, filters.ChatType.PRIVATE))
     application.add_handler(
-        CommandHandler('membership', membership.handle_membership, filters.ChatType.PRIVATE))
+        CommandHandler('membership', membership.handle_membership, filters.ChatType.PRIVATE, block=False))
     application.add_handler(
         CommandHandler('points', club_points.handle_club_points, filters.ChatType.PRIVATE))
     application.add_handler(
-        CommandHandler('courses', course_handlers.handle_active_courses, filters.ChatType.PRIVATE))
+        CommandHandler('courses', course_handlers.handle_active_courses, filters.ChatType.PRIVATE, block=False))
     application.add_handler(
         CommandHandler('set_email', email_contact_handler.set_email_handler, filters.ChatType.PRIVATE))
     application.add_handler(
@@ -80,6 +96,14 @@ if __name__ == '__main__':
         CommandHandler('add_days', admin_commands.add_days_handler, filters.ChatType.PRIVATE))
     application.add_handler(
         CommandHandler('get_status', admin_commands.get_status_handler, filters.ChatType.PRIVATE))
+    application.add_handler(
+        CommandHandler('broadcast_jobs', admin_commands.broadcast_jobs_handler, filters.ChatType.PRIVATE))
+    application.add_handler(
+        CommandHandler('broadcast_pause', admin_commands.broadcast_pause_handler, filters.ChatType.PRIVATE))
+    application.add_handler(
+        CommandHandler('broadcast_resume', admin_commands.broadcast_resume_handler, filters.ChatType.PRIVATE))
+    application.add_handler(
+        CommandHandler('broadcast_cancel', admin_commands.broadcast_cancel_handler, filters.ChatType.PRIVATE))
     application.add_handler(
         CommandHandler('leetcode_on', admin_commands.leetcode_on, filters.ChatType.PRIVATE))
     application.add_handler(
@@ -93,7 +117,10 @@ if __name__ == '__main__':
     application.add_handler(
         MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, menu.private_message))
 
-    application.add_handler(CallbackQueryHandler(button_handlers.button_click))
+    # membership and course handlers are async all the way down, other updates don't wait for them to finish
+    application.add_handler(CallbackQueryHandler(button_handlers.button_click, block=False))
+    application.add_handler(
+        ChatMemberHandler(menu.bot_blocked_or_unblocked, ChatMemberHandler.MY_CHAT_MEMBER))
 
     application.add_error_handler(button_handlers.error_handler)
 
@@ -9,7 +9,7 @@ from telegram.ext import (CallbackQueryHandler, CommandHandler, ContextTypes, Co
 import helpers
 import models
 import settings
-from membership import fetch_boosty_patrons, membership
+from membership import fetch_boosty_patrons, effective_membership, membership, patron_refresher
 from monitoring import calculate_metrics_and_report
 
 CONNECT_BOOSTY = 1
@@ -61,6 +61,7 @@ async def store_boosty_linking(update: Update, boosty_user_id: str, context: Con
                 text=f"Упс! Случилась ошибка, но проблема не в тебе! Уже оповестил @lenka_colenka"
             )
             return False
+    await effective_membership.refresh_linked_user(context.bot, user.id)
     return True
 
 
@@ -69,16 +70,29 @@ async def do_connect_boosty(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     user_input: str = update.message.text.strip()
 
-    await fetch_boosty_patrons.load_boosty_patrons(context.bot)
-    redis_result = fetch_boosty_patrons.get_boosty_info_by_field(user_input)
+    boosty_infos = fetch_boosty_patrons.find_boosty_infos(user_input)
+    if not any(boosty_info.price >= 1500 for boosty_info in boosty_infos):
+        # the subscriber may have just subscribed or upgraded, look again in fresh data
+        await patron_refresher.refresh_if_older(context.bot, patron_refresher.BOOSTY,
+                                                settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS)
+        boosty_infos = fetch_boosty_patrons.find_boosty_infos(user_input)
 
-    if redis_result:
-        boosty_user_id = redis_result[0]
-        boosty_info = redis_result[1]
+    if len(boosty_infos) > 1:
+        # the same name may belong to several Boosty users, don't guess which one it is
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Нашла {len(boosty_infos)} профиля Boosty с именем {user_input}. Введи email, который привязан к "
+                 f"твоему профилю Boosty, или напиши @lenka_colenka",
+        )
+        return CONNECT_BOOSTY
+
+    if boosty_infos:
+        boosty_info = boosty_infos[0]
+        boosty_user_id = boosty_info.id
         if await store_boosty_linking(update, boosty_user_id, context):
             logging.info(f"Boosty found for user input {user_input}: {boosty_user_id}")
             msg: str = f"Нашла твой профиль Boosty: {user_input}.\n\n"
-            boosty_price = int(boosty_info['price'])
+            boosty_price = boosty_info.price
             if boosty_price >= 1500:
                 msg += f"Ты донатишь мне {boosty_price} рублей в месяц. Спасибо! 🥹"
             elif 0 < boosty_price < 1500:
@@ -136,4 +150,5 @@ async def disconnect_boosty_handler(update: Update, context: ContextTypes.DEFAUL
         session.query(models.BoostyLink).filter(models.BoostyLink.tg_id == str(tg_user.id)).delete()
         session.commit()
         logging.info(f"Deleted Boosty linking for {tg_user.username}")
-        await membership.handle_membership(update, context)
+    await effective_membership.refresh_linked_user(context.bot, tg_user.id)
+    await membership.handle_membership(update, context)
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import logging
 from zoneinfo import ZoneInfo
@@ -6,7 +7,7 @@ from sqlalchemy.orm import Session
 from telegram.ext import ContextTypes
 
 import helpers
-from membership import membership, update_membership, fetch_boosty_patrons, fetch_patrons
+from membership import membership, update_membership, patron_refresher
 import models
 import settings
 
@@ -15,16 +16,21 @@ membership_logger.setLevel(logging.INFO)
 
 
 async def do_convert_points_to_membership(context: ContextTypes.DEFAULT_TYPE):
-    await fetch_boosty_patrons.load_boosty_patrons(context.bot)
-    await fetch_patrons.load_patrons(context.bot)
+    await asyncio.gather(
+        patron_refresher.refresh_if_older(context.bot, patron_refresher.BOOSTY,
+                                          settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS),
+        patron_refresher.refresh_if_older(context.bot, patron_refresher.PATREON,
+                                          settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS),
+    )
 
     with (Session(models.engine) as session):
         users_with_enough_points = session.query(models.ClubPoints.tg_id).filter(models.ClubPoints.balance >= 1000
                                                                                  ).all()
 
+    memberships = membership.get_memberships(tg_id for tg_id, in users_with_enough_points)
     for result in users_with_enough_points:
         tg_id = result[0]
-        membership_info = membership.get_user_membership_info(tg_id)
+        membership_info = memberships[str(tg_id)]
         if membership_info.get_overall_level() == membership.basic:
             point_count, new_balance = update_membership.do_substract_points(tg_id, 1000)
             if new_balance is not None:
@@ -0,0 +1,164 @@
+import asyncio
+import datetime
+import logging
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy import delete, false, func, insert, null, select, true
+from sqlalchemy.orm import Session
+from telegram import Bot
+
+import models
+from . import fetch_boosty_patrons, fetch_patrons, level_changes, membership_cache, patron_cache
+
+effective_logger = logging.getLogger(__name__)
+effective_logger.setLevel(logging.INFO)
+
+# EffectiveMembership holds a row for every user who has or had Pro by any source, so audiences and metrics can filter
+# by level with a join. Patreon and Boosty amounts live in Redis, that's why the table is rebuilt from Python after
+# every patron reload instead of being a Postgres view. Activity membership expires by date, so the level is checked
+# against expires_at at query time and the table doesn't go stale when a date passes.
+
+BASIC_LEVEL = 1  # membership.basic.number, membership.py imports this module
+PRO_LEVEL = 2  # membership.pro.number
+
+
+def get_linked_pro_sources(tg_id: str) -> tuple[set[str], set[str]]:
+    # The user's own Patreon email and Boosty user id, each only when it gives Pro. Refreshing one user reads their two
+    # profiles instead of every Pro patron
+    with Session(models.engine) as session:
+        email = session.scalar(select(models.PatreonLink.patreon_email).where(models.PatreonLink.tg_id == tg_id))
+        boosty_user_id = session.scalar(select(models.BoostyLink.boosty_user_id)
+                                        .where(models.BoostyLink.tg_id == tg_id))
+    patreon_hashes, boosty_hashes = patron_cache.read_profiles([email] if email else [],
+                                                                [boosty_user_id] if boosty_user_id else [])
+    pro_emails, pro_boosty_user_ids = set(), set()
+    if patreon_hashes and patreon_hashes[0]:
+        patron = patron_cache.PatreonRecord.from_hash(email, patreon_hashes[0])
+        if patron.sum_of_entitled_tiers_amount_cents >= fetch_patrons.PRO_MIN_AMOUNT_CENTS:
+            pro_emails.add(email)
+    if boosty_hashes and boosty_hashes[0]:
+        boosty_patron = patron_cache.BoostyRecord.from_hash(boosty_user_id, boosty_hashes[0])
+        if boosty_patron.price >= fetch_boosty_patrons.PRO_MIN_PRICE_RUB:
+            pro_boosty_user_ids.add(boosty_user_id)
+    return pro_emails, pro_boosty_user_ids
+
+
+def sources_query(tg_id: Optional[str] = None) -> sqlalchemy.Select:
+    # the same rules as UserMembershipInfo.get_overall_level: one row per user and Pro source
+    if tg_id is None:
+        pro_emails = fetch_patrons.get_pro_patron_emails()
+        pro_boosty_user_ids = fetch_boosty_patrons.get_pro_boosty_user_ids()
+    else:
+        pro_emails, pro_boosty_user_ids = get_linked_pro_sources(tg_id)
+    by_activity = (
+        select(models.MembershipByActivity.tg_id.label("tg_id"),
+               false().label("is_paid"),
+               true().label("has_activity"),
+               models.MembershipByActivity.expires_at.label("activity_expires_at"))
+        .where(models.MembershipByActivity.tg_id.is_not(None))
+    )
+    by_patreon = (
+        select(models.PatreonLink.tg_id, true(), false(), null())
+        .where(models.PatreonLink.patreon_email.in_(pro_emails))
+    )
+    by_boosty = (
+        select(models.BoostyLink.tg_id, true(), false(), null())
+        .where(models.BoostyLink.boosty_user_id.in_(pro_boosty_user_ids))
+    )
+    if tg_id is not None:
+        by_activity = by_activity.where(models.MembershipByActivity.tg_id == tg_id)
+        by_patreon = by_patreon.where(models.PatreonLink.tg_id == tg_id)
+        by_boosty = by_boosty.where(models.BoostyLink.tg_id == tg_id)
+    return sqlalchemy.union_all(by_activity, by_patreon, by_boosty).subquery()
+
+
+def effective_query(tg_id: Optional[str] = None) -> sqlalchemy.Select:
+    sources = sources_query(tg_id)
+    is_paid = func.bool_or(sources.c.is_paid)
+    has_activity = func.bool_or(sources.c.has_activity)
+    # MembershipByActivity.tg_id is unique, so there's at most one activity row per user
+    activity_expires_at = func.max(sources.c.activity_expires_at)
+    return (
+        select(sources.c.tg_id,
+               sqlalchemy.literal(PRO_LEVEL).label("level"),
+               # paid Pro and activity Pro without expiration don't expire
+               sqlalchemy.case((is_paid | (has_activity & activity_expires_at.is_(None)), null()),
+                               else_=activity_expires_at).label("expires_at"),
+               is_paid.label("is_paid"),
+               has_activity.label("has_activity"),
+               activity_expires_at.label("activity_expires_at"),
+               sqlalchemy.literal(datetime.datetime.utcnow()).label("refreshed_at"))
+        .group_by(sources.c.tg_id)
+    )
+
+
+def refresh(tg_id: Optional[str] = None) -> list[level_changes.LevelChange]:
+    # one transaction, readers see either the old or the new rows. Returns users who became Pro or lost it
+    columns = ["tg_id", "level", "expires_at", "is_paid", "has_activity", "activity_expires_at", "refreshed_at"]
+    pro_query = pro_tg_ids_query()
+    stmt = delete(models.EffectiveMembership)
+    if tg_id is not None:
+        pro_query = pro_query.where(models.EffectiveMembership.tg_id == tg_id)
+        stmt = stmt.where(models.EffectiveMembership.tg_id == tg_id)
+    with Session(models.engine) as session:
+        # the table starts empty after the migration, the first full refresh would report every Pro user as new
+        is_first_refresh = tg_id is None and not session.scalar(select(sqlalchemy.exists(models.EffectiveMembership)))
+        was_pro = set(session.scalars(pro_query))
+        session.execute(stmt)
+        result = session.execute(insert(models.EffectiveMembership).from_select(columns, effective_query(tg_id)))
+        is_pro = set(session.scalars(pro_query))
+        session.commit()
+    if tg_id is None:
+        effective_logger.info(f"Refreshed effective membership for {result.rowcount} users")
+    if is_first_refresh:
+        effective_logger.info(f"Effective membership was empty, not reporting {len(is_pro)} Pro users as level changes")
+        return []
+    return ([level_changes.LevelChange(changed_tg_id, BASIC_LEVEL, PRO_LEVEL) for changed_tg_id in is_pro - was_pro] +
+            [level_changes.LevelChange(changed_tg_id, PRO_LEVEL, BASIC_LEVEL) for changed_tg_id in was_pro - is_pro])
+
+
+def refresh_user(tg_id) -> list[level_changes.LevelChange]:
+    return refresh(str(tg_id))
+
+
+async def refresh_linked_user(bot: Bot, tg_id) -> None:
+    # For handlers, after a user linked or unlinked a Patreon or Boosty profile. The refresh runs in a thread and its
+    # level change is published, so linking a Pro profile gets congratulated. A failed refresh doesn't undo the saved
+    # link, it's logged and the next patron reload fixes the table
+    membership_cache.invalidate(tg_id)
+    try:
+        changes = await asyncio.to_thread(refresh_user, tg_id)
+    except Exception as e:
+        effective_logger.error(f"Couldn't refresh effective membership of {tg_id}: {e}")
+        return
+    await level_changes.publish(bot, changes)
+
+
+def refresh_all() -> list[level_changes.LevelChange]:
+    try:
+        return refresh()
+    except Exception as e:
+        # the table keeps the previous state, it's refreshed again on the next patron reload
+        effective_logger.error(f"Couldn't refresh effective membership: {e}")
+        return []
+
+
+def pro_tg_ids_query() -> sqlalchemy.Select:
+    return select(models.EffectiveMembership.tg_id).where(
+        (models.EffectiveMembership.level == PRO_LEVEL) &
+        (models.EffectiveMembership.expires_at.is_(None) |
+         (models.EffectiveMembership.expires_at >= datetime.date.today()))
+    )
+
+
+def pro_by_activity_tg_ids_query() -> sqlalchemy.Select:
+    return select(models.EffectiveMembership.tg_id).where(
+        models.EffectiveMembership.has_activity.is_(True) &
+        (models.EffectiveMembership.activity_expires_at.is_(None) |
+         (models.EffectiveMembership.activity_expires_at >= datetime.date.today()))
+    )
+
+
+def paid_tg_ids_query() -> sqlalchemy.Select:
+    return select(models.EffectiveMembership.tg_id).where(models.EffectiveMembership.is_paid.is_(True))
@@ -1,18 +1,21 @@
+import asyncio
 import logging
-from typing import Optional
+from typing import AsyncIterator, Optional
 from pathlib import Path
 
-import redis
+import aiohttp
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 from telegram import Bot
 from boosty_api import BoostyAPI
 
+import models
 import settings
+from . import effective_membership, level_changes, membership_cache, patron_cache
 
 boosty_logger = logging.getLogger(__name__)
 boosty_logger.setLevel(logging.INFO)
 
-r = redis.Redis(host='localhost', port=6379, db=0)
-
 boosty_api: Optional[BoostyAPI] = None
 blog_href: Optional[str] = None
 
@@ -33,30 +36,63 @@ async def close():
         await boosty_api.close()
 
 
+async def fetch_subscribers_page(offset: int) -> dict:
+    # BoostyAPI.get_subscribers has no offset, so the page is requested on its session directly
+    url = f"{boosty_api.BASE_API_URL}/v1/blog/{blog_href}/subscribers"
+    params = {"sort_by": "on_time", "order": "gt", "limit": settings.BOOSTY_PAGE_SIZE, "offset": offset}
+    headers = {
+        "Authorization": f"Bearer {boosty_api.get_bearer()}",
+        "X-Currency": "RUB",
+        "X-Locale": "ru_RU",
+        "X-App": "web"
+    }
+    async with boosty_api.session.get(url, headers=headers, params=params,
+                                      timeout=aiohttp.ClientTimeout(total=settings.BOOSTY_TIMEOUT_SECONDS)) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Boosty answered {resp.status} for subscribers at offset {offset}")
+        return await resp.json()
+
+
+async def iter_subscriber_pages() -> AsyncIterator[tuple[int, list[dict]]]:
+    # yields (total, subscribers) for every page as soon as it arrives, at most BOOSTY_FETCH_CONCURRENCY pages are
+    # requested at once
+    first_page = await fetch_subscribers_page(0)
+    total = first_page["total"]
+    yield total, first_page["data"]
+
+    # Boosty may return fewer subscribers than asked for, the first page tells the real page size
+    page_size = len(first_page["data"]) or settings.BOOSTY_PAGE_SIZE
+    semaphore = asyncio.Semaphore(settings.BOOSTY_FETCH_CONCURRENCY)
+
+    async def fetch(offset: int) -> dict:
+        async with semaphore:
+            return await fetch_subscribers_page(offset)
+
+    pages = [asyncio.create_task(fetch(offset)) for offset in range(page_size, total, page_size)]
+    try:
+        for page in asyncio.as_completed(pages):
+            yield total, (await page)["data"]
+    finally:
+        for page in pages:
+            page.cancel()
+
+
 async def fetch_boosty_patrons(bot: Bot) -> Optional[list[dict]]:
-    boosty_all_members = []
+    boosty_all_members = {}
+    total = 0
 
     try:
-        stats = await boosty_api.get_subscribers(limit=40)
-
-        if stats["total"] != len(stats["data"]):
-            boosty_logger.error(f"Couldn't get all subscribers from Boosty, need pagination! Total is "
-                                  f"{stats['total']}, got {len(stats['data'])} subscribers.")
-            await bot.send_message(
-                chat_id=settings.ADMIN_CHAT_ID,
-                text=f"Couldn't get all subscribers from Boosty, need pagination! Total is {stats['total']}, got "
-                     f"{len(stats['data'])} subscribers.",
-                parse_mode="HTML")
-            return None
-
-        for subscriber in stats["data"]:
-            boosty_all_members.append({
-                "id": subscriber["id"],
-                "email": subscriber["email"],
-                "name": subscriber["name"],
-                "price": subscriber["price"],
-            })
-        return boosty_all_members
+        async for total, subscribers in iter_subscriber_pages():
+            # Pages are collected as they arrive and stored together once all are here: patron_cache.sync needs the
+            # whole list to tell removed subscribers, and an incomplete one is rejected below. A subscriber may show up
+            # twice if the list shifted meanwhile
+            for subscriber in subscribers:
+                boosty_all_members[subscriber["id"]] = {
+                    "id": subscriber["id"],
+                    "email": subscriber["email"],
+                    "name": subscriber["name"],
+                    "price": subscriber["price"],
+                }
     except Exception as e:
         boosty_logger.error(f"Unexpected error while getting info from Boosty: {e}")
         await bot.send_message(
@@ -65,78 +101,89 @@ async def fetch_boosty_patrons(bot: Bot) -> Optional[list[dict]]:
             parse_mode="HTML")
         return None
 
+    if len(boosty_all_members) < total:
+        # someone unsubscribed while the pages were fetched and the offsets moved. A partial list would take Pro away
+        # from the skipped subscribers, so the previous one is kept until the next reload
+        boosty_logger.error(f"Couldn't get all subscribers from Boosty! Total is {total}, got "
+                            f"{len(boosty_all_members)} subscribers.")
+        await bot.send_message(
+            chat_id=settings.ADMIN_CHAT_ID,
+            text=f"Couldn't get all subscribers from Boosty! Total is {total}, got {len(boosty_all_members)} "
+                 f"subscribers.",
+            parse_mode="HTML")
+        return None
 
-def clear_boosty_patrons_from_cache() -> None:
-    count = 0
-    for key in r.scan_iter("boosty:user:*"):
-        r.delete(key)
-        count += 1
-    boosty_logger.info(f"Deleted {count} Boosty user entries from Redis.")
-
+    boosty_logger.info(f"Got {len(boosty_all_members)} subscribers from Boosty")
+    return list(boosty_all_members.values())
 
-def store_boosty_patrons_to_cache(all_boosty_patrons: [dict]) -> None:
-    success_insert_count = 0
-    fail_insert_count = 0
 
+def store_boosty_patrons_to_cache(all_boosty_patrons: [dict]) -> Optional[set[str]]:
+    records = []
     for boosty_patron in all_boosty_patrons:
         try:
-            r.hset(f"boosty:user:{boosty_patron['id']}",
-                   mapping={
-                       "email": boosty_patron['email'],
-                       "name": boosty_patron['name'],
-                       "price": boosty_patron['price'],
-                   })
-            success_insert_count += 1
+            records.append(patron_cache.BoostyRecord.from_api(boosty_patron))
         except Exception as e:
-            fail_insert_count += 1
             boosty_logger.warning(f"Couldn't add Boosty patron to Redis: {e}")
-    boosty_logger.info(f"Inserted {success_insert_count} Boosty patrons to Redis, failed to insert {fail_insert_count} "
-                       f"Boosty patrons")
+    changed_ids = patron_cache.store_boosty_patrons(records)
+    boosty_logger.info(f"Stored {len(records)} Boosty patrons in Redis, failed to store "
+                       f"{len(all_boosty_patrons) - len(records)} Boosty patrons")
+    return changed_ids
+
 
+def invalidate_linked(boosty_user_ids: Optional[set[str]]) -> None:
+    # None means any patron may have changed
+    if boosty_user_ids is None:
+        membership_cache.invalidate_all()
+        return
+    with Session(models.engine) as session:
+        for tg_id in session.scalars(select(models.BoostyLink.tg_id)
+                                     .where(models.BoostyLink.boosty_user_id.in_(boosty_user_ids))):
+            membership_cache.invalidate(tg_id)
 
-async def load_boosty_patrons(bot: Bot):
+
+async def load_boosty_patrons(bot: Bot) -> bool:
+    # False when nothing was loaded and the stored patrons are kept. Handlers go through patron_refresher instead
     boosty_patrons = await fetch_boosty_patrons(bot)
     if boosty_patrons:
-        # boosty patrons may change email address, in this case old email should be deleted from cache
-        clear_boosty_patrons_from_cache()
-        store_boosty_patrons_to_cache(boosty_patrons)
+        # only Boosty patrons who were added, changed or removed since the last reload are written
+        changed_ids = store_boosty_patrons_to_cache(boosty_patrons)
+        if changed_ids is None or changed_ids:
+            invalidate_linked(changed_ids)
+            await level_changes.publish(bot, effective_membership.refresh_all())
+    return bool(boosty_patrons)
 
 
 def get_boosty_patrons_from_redis(min_price_rub: int = 1) -> list[(str, str)]:
     active_boosty_patrons = []
 
-    for key in r.scan_iter("boosty:user:*"):
-        user_data = r.hgetall(key)
-        user_data = {k.decode(): v.decode() for k, v in user_data.items()}
-
-        if int(user_data.get("price")) >= min_price_rub:
-            boosty_logger.debug(f"paid boosty subscriber is {user_data}")
-            boosty_patron_info = [user_data.get("name"), user_data.get("email"), user_data.get("price")]
-            active_boosty_patrons.append(boosty_patron_info)
+    for boosty_patron in patron_cache.get_boosty_patrons_by_price(min_price_rub):
+        boosty_logger.debug(f"paid boosty subscriber is {boosty_patron}")
+        active_boosty_patrons.append([boosty_patron.name, boosty_patron.email, str(boosty_patron.price)])
 
     return active_boosty_patrons
 
 
-def get_boosty_info(boosty_user_id: str) -> Optional[dict]:
+def count_boosty_patrons(min_price_rub: int = 1) -> int:
+    return patron_cache.count_boosty_patrons(min_price_rub)
+
+
+PRO_MIN_PRICE_RUB = 1500
+
+
+def get_pro_boosty_user_ids(min_price_rub: int = PRO_MIN_PRICE_RUB) -> set[str]:
+    return patron_cache.get_boosty_user_ids_by_price(min_price_rub)
+
+
+def get_boosty_info(boosty_user_id: str) -> Optional[patron_cache.BoostyRecord]:
     # todo: maybe need to reload from Boosty somewhere here
-    key = f"boosty:user:{boosty_user_id}"
-
-    if r.exists(key):
-        user_data = r.hgetall(key)
-        user_data = {k.decode(): v.decode() for k, v in user_data.items()}
-        return user_data
-    return None
-
-
-# user_input should be either email or name
-# slower method than `get_boosty_info`, use only when boosty_user_id is not present
-# works in O(n) where n is a number of Boosty users
-def get_boosty_info_by_field(user_input: str = None) -> Optional[tuple[str, dict]]:
-    user_input = user_input.lower()
-    for key in r.scan_iter("boosty:user:*"):
-        user_data = r.hgetall(key)
-        user_data = {k.decode(): v.decode() for k, v in user_data.items()}
-
-        if user_data.get("email").lower() == user_input or user_data.get("name").lower() == user_input:
-            return key.decode().split(':')[2], user_data
-    return None
+    return patron_cache.get_boosty_patron(boosty_user_id)
+
+
+# user_input should be either email or name, use only when boosty_user_id is not present. More than one profile means
+# several Boosty users have this name
+def find_boosty_infos(user_input: str) -> list[patron_cache.BoostyRecord]:
+    boosty_infos = patron_cache.find_boosty_patrons(user_input)
+    if len(boosty_infos) > 1:
+        boosty_logger.warning(f"{len(boosty_infos)} Boosty profiles match {user_input}: "
+                              f"{[boosty_info.id for boosty_info in boosty_infos]}")
+    return boosty_infos
@@ -1,146 +1,231 @@
+import asyncio
 import logging
 import os
-import requests
-import redis
+import random
 from typing import Optional
 
+import httpx
 from dotenv import load_dotenv
 
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 from telegram import Bot
 
+import models
 import settings
+from . import effective_membership, level_changes, membership_cache, patron_cache
 
 patreon_logger = logging.getLogger(__name__)
 patreon_logger.setLevel(logging.INFO)
 
-r = redis.Redis(host='localhost', port=6379, db=0)
+# One pooled client for all Patreon requests, opened in post_init. PATREON_API_URL points it to a stand-in server, see
+# scripts/patreon_stub_server.py
+client: Optional[httpx.AsyncClient] = None
+access_token: Optional[str] = None
 
+# worth retrying, anything else is an answer
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+async def init():
+    global client
+    client = httpx.AsyncClient(
+        base_url=settings.PATREON_API_URL,
+        timeout=settings.PATREON_TIMEOUT_SECONDS,
+        limits=httpx.Limits(max_connections=2, max_keepalive_connections=2),
+    )
 
-async def fetch_patrons(bot: Bot) -> Optional[list[dict]]:
-    load_dotenv(override=True)
 
+async def close():
+    if client:
+        patreon_logger.info("Closing Patreon client...")
+        await client.aclose()
+
+
+def read_access_token(reload: bool = False) -> str:
     # todo: this token expires about once a month. Need to refresh it automatically
-    access_token = os.getenv("PATREON_ACCESS_TOKEN")
+    # scripts/refresh_patreon_token.py writes a new token to .env from cron, it's read again when Patreon rejects the
+    # current one
+    global access_token
+    if access_token is None or reload:
+        load_dotenv(override=True)
+        access_token = os.getenv("PATREON_ACCESS_TOKEN")
+    return access_token
+
+
+def get_retry_delay(response: Optional[httpx.Response], attempt: int) -> float:
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return settings.PATREON_RETRY_BASE_SECONDS * 2 ** attempt + random.uniform(0, 1)
+
+
+async def get_page(url: str, params: Optional[dict] = None) -> dict:
+    token_reloaded = False
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = await client.get(url, params=params,
+                                        headers={"Authorization": f"Bearer {read_access_token()}"})
+            if response.status_code == 401 and not token_reloaded:
+                read_access_token(reload=True)
+                token_reloaded = True
+                continue
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response.json()
+            error = f"status {response.status_code}"
+        except httpx.TransportError as e:
+            error = repr(e)
+        attempt += 1
+        if attempt >= settings.PATREON_MAX_ATTEMPTS:
+            if response is not None:
+                response.raise_for_status()
+            raise httpx.TransportError(f"Patreon didn't answer after {attempt} attempts: {error}")
+        delay = get_retry_delay(response, attempt - 1)
+        patreon_logger.warning(f"Patreon request failed with {error}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+
+def get_entitled_amount(member: dict, tier_id_to_amount: dict[str, int]) -> Optional[int]:
+    # The one rule for a patron's amount, used by full reloads and webhooks alike: the sum of amount_cents of the tiers
+    # the member is entitled to. currently_entitled_amount_cents is never used, it may differ and flip the level.
+    # None when an entitled tier came without its amount
+    tier_ids = [
+        t["id"]
+        for t in member.get("relationships", {}).get("currently_entitled_tiers", {}).get("data", [])
+        if t.get("type") == "tier"
+    ]
+    if any(tid not in tier_id_to_amount for tid in tier_ids):
+        return None
+    # just in case someone splits subscription in multiple
+    return sum(tier_id_to_amount[tid] for tid in tier_ids)
+
+
+def parse_page(data: dict, tier_id_to_amount: dict[str, int]) -> list[dict]:
+    for tier in data.get("included", []):
+        if tier.get("type") != "tier":
+            continue
+        attrs = tier.get("attributes", {})
+        amount = attrs.get("amount_cents")
+        if amount is not None:
+            tier_id_to_amount[tier["id"]] = amount
+    patreon_logger.debug(f"{tier_id_to_amount=}")
+
+    members = []
+    for m in data["data"]:
+        attrs = m["attributes"].copy()
+        attrs["sum_of_entitled_tiers_amount_cents"] = get_entitled_amount(m, tier_id_to_amount)
+        members.append(attrs)
+    return members
+
+
+async def fetch_patrons(bot: Bot) -> Optional[list[dict]]:
     campaign_id = os.getenv("PATREON_CAMPAIGN_ID")
-    api_url = f"https://www.patreon.com/api/oauth2/v2/campaigns/{campaign_id}/members"
     params = {
         "include": "currently_entitled_tiers",
         "fields[member]": "full_name,email,patron_status,currently_entitled_amount_cents,is_gifted",
-        "fields[tier]": "title,amount_cents"
+        "fields[tier]": "title,amount_cents",
+        "page[count]": settings.PATREON_PAGE_SIZE,
     }
-    headers = {"Authorization": f"Bearer {access_token}"}
-    url = api_url.format(campaign_id=campaign_id)
 
     all_members = []
     tier_id_to_amount = {}
-    while url:
-        try:
-            patreon_logger.debug("new while url iteration")
-            r = requests.get(url, headers=headers, params=params if url == api_url else None)
-            r.raise_for_status()
-            data = r.json()
-        except requests.exceptions.HTTPError as e:
-            patreon_logger.warning(f"Couldn't get info from Patreon: {e}")
-            await bot.send_message(
-                chat_id=settings.ADMIN_CHAT_ID,
-                text=f"Couldn't get info from Patreon: {e}",
-                parse_mode="HTML")
-            return None
-        except Exception as e:
-            patreon_logger.error(f"Unexpected error while getting info from Patreon: {e}")
-            await bot.send_message(
-                chat_id=settings.ADMIN_CHAT_ID,
-                text=f"Unexpected error while getting info from Patreon: {e}",
-                parse_mode="HTML")
-            return None
-
-        for tier in data.get("included", []):
-            if tier.get("type") != "tier":
-                continue
-            attrs = tier.get("attributes", {})
-            amount = attrs.get("amount_cents")
-            if amount is not None:
-                tier_id_to_amount[tier["id"]] = amount
-        patreon_logger.debug(f"{tier_id_to_amount=}")
-
-        for m in data["data"]:
-            attrs = m["attributes"].copy()
-            relationships = m.get("relationships", {})
-            tier_ids = [
-                t["id"]
-                for t in relationships.get("currently_entitled_tiers", {}).get("data", [])
-                if t.get("type") == "tier"
-            ]
-            # just in case someone splits subscription in multiple
-            sum_of_entitled_tiers_amount_cents = sum(tier_id_to_amount.get(tid, 0) for tid in tier_ids)
-            attrs["sum_of_entitled_tiers_amount_cents"] = sum_of_entitled_tiers_amount_cents
-            all_members.append(attrs)
-
-        url = data.get("links", {}).get("next")  # go to next page if exists
+    next_page = None
+    try:
+        page = asyncio.create_task(get_page(f"/api/oauth2/v2/campaigns/{campaign_id}/members", params))
+        while page:
+            data = await page
+            # the next page is requested before this one is parsed, links.next already carries all params. Parsing
+            # runs in a thread, so the event loop sends that request meanwhile
+            url = data.get("links", {}).get("next")
+            next_page = asyncio.create_task(get_page(url)) if url else None
+            all_members.extend(await asyncio.to_thread(parse_page, data, tier_id_to_amount))
+            page, next_page = next_page, None
+    except httpx.HTTPStatusError as e:
+        patreon_logger.warning(f"Couldn't get info from Patreon: {e}")
+        await bot.send_message(
+            chat_id=settings.ADMIN_CHAT_ID,
+            text=f"Couldn't get info from Patreon: {e}",
+            parse_mode="HTML")
+        return None
+    except Exception as e:
+        patreon_logger.error(f"Unexpected error while getting info from Patreon: {e}")
+        await bot.send_message(
+            chat_id=settings.ADMIN_CHAT_ID,
+            text=f"Unexpected error while getting info from Patreon: {e}",
+            parse_mode="HTML")
+        return None
+    finally:
+        if next_page:
+            next_page.cancel()
 
     patreon_logger.info(f"Got {len(all_members)} patrons from Patreon")
     return all_members
 
 
-def clear_users_from_cache() -> None:
-    count = 0
-    for key in r.scan_iter("user:*"):
-        r.delete(key)
-        count += 1
-    patreon_logger.info(f"Deleted {count} user entries from Redis.")
-
-
-def store_to_cache(all_patrons: [dict]) -> None:
-    success_insert_count = 0
-    fail_insert_count = 0
-
+def store_to_cache(all_patrons: [dict]) -> Optional[set[str]]:
+    records = []
     for patron in all_patrons:
         try:
-            r.hset(f"user:{str(patron['email']).lower()}",
-                   mapping={
-                       "full_name": str(patron['full_name']),
-                       "patron_status": str(patron['patron_status']),
-                       "currently_entitled_amount_cents": str(patron['currently_entitled_amount_cents']),
-                       'is_gifted': str(patron['is_gifted']),
-                       'sum_of_entitled_tiers_amount_cents': str(patron['sum_of_entitled_tiers_amount_cents'])
-                   })
-            success_insert_count += 1
+            records.append(patron_cache.PatreonRecord.from_api(patron))
         except Exception as e:
-            fail_insert_count += 1
             patreon_logger.warning(f"Couldn't add patron to Redis: {e}")
-    patreon_logger.info(f"Inserted {success_insert_count} patrons to Redis, failed to insert {fail_insert_count} patrons")
+    changed_emails = patron_cache.store_patrons(records)
+    patreon_logger.info(f"Stored {len(records)} patrons in Redis, failed to store {len(all_patrons) - len(records)} "
+                        f"patrons")
+    return changed_emails
+
+
+def invalidate_linked(emails: Optional[set[str]]) -> None:
+    # None means any patron may have changed
+    if emails is None:
+        membership_cache.invalidate_all()
+        return
+    with Session(models.engine) as session:
+        for tg_id in session.scalars(select(models.PatreonLink.tg_id)
+                                     .where(models.PatreonLink.patreon_email.in_(emails))):
+            membership_cache.invalidate(tg_id)
 
 
 def get_patrons_from_redis(status_filter: str) -> list[(str, str)]:
     active_patrons = []
 
-    for key in r.scan_iter("user:*"):
-        user_data = r.hgetall(key)
-        user_data = {k.decode(): v.decode() for k, v in user_data.items()}
-
-        if user_data.get("patron_status") == status_filter:
-            patreon_logger.debug(f"active patron is {user_data}")
-            active_patron_info = [user_data.get("full_name"), user_data.get("sum_of_entitled_tiers_amount_cents")]
-            if user_data.get("is_gifted") == "True":
-                active_patron_info.append("is_gifted")
-            active_patrons.append(active_patron_info)
+    for patron in patron_cache.get_patrons_by_amount(status_filter):
+        patreon_logger.debug(f"active patron is {patron}")
+        active_patron_info = [patron.full_name, str(patron.sum_of_entitled_tiers_amount_cents)]
+        if patron.is_gifted:
+            active_patron_info.append("is_gifted")
+        active_patrons.append(active_patron_info)
 
     return active_patrons
 
 
-async def load_patrons(bot: Bot):
+async def load_patrons(bot: Bot) -> bool:
+    # False when nothing was loaded and the stored patrons are kept. Handlers go through patron_refresher instead
     patrons = await fetch_patrons(bot)
     if patrons:
-        # patrons may change email address, in this case old email should be deleted from cache
-        clear_users_from_cache()
-        store_to_cache(patrons)
+        # only patrons who were added, changed or removed since the last reload are written, a patron who changed
+        # email is removed under the old one
+        changed_emails = store_to_cache(patrons)
+        if changed_emails is None or changed_emails:
+            invalidate_linked(changed_emails)
+            await level_changes.publish(bot, effective_membership.refresh_all())
+    return bool(patrons)
+
+
+def get_patrons_summary(status_filter: str) -> patron_cache.StatusSummary:
+    # count and total amount in cents, precomputed when patrons are stored
+    return patron_cache.get_patreon_summary().get(status_filter, patron_cache.StatusSummary())
+
+
+PRO_MIN_AMOUNT_CENTS = 1500
+
 
+def get_pro_patron_emails(min_amount_cents: int = PRO_MIN_AMOUNT_CENTS) -> set[str]:
+    # the set of paying patrons is small, so it's cheap to pass it to SQL as a list
+    return patron_cache.get_patron_emails_by_amount(min_amount_cents)
 
-def get_patron_by_email(email_to_find: str) -> Optional[dict]:
-    key = f"user:{email_to_find}"
 
-    if r.exists(key):
-        user_data = r.hgetall(key)
-        user_data = {k.decode(): v.decode() for k, v in user_data.items()}
-        return user_data
-    return None
+def get_patron_by_email(email_to_find: str) -> Optional[patron_cache.PatreonRecord]:
+    return patron_cache.get_patron(email_to_find)
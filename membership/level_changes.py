@@ -0,0 +1,76 @@
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from telegram import Bot
+
+import settings
+from notifications import broadcast_engine
+from . import membership_cache
+
+level_logger = logging.getLogger(__name__)
+level_logger.setLevel(logging.INFO)
+
+# Patron reloads emit a LevelChange for every user who became Pro or lost it. Listeners get all changes of one reload
+# together: the membership cache drops those users and users who became Pro get a message. Other modules can add their
+# own with subscribe.
+
+
+@dataclass
+class LevelChange:
+    tg_id: str
+    old_level: int
+    new_level: int
+
+    @property
+    def is_upgrade(self) -> bool:
+        return self.new_level > self.old_level
+
+
+Listener = Callable[[Bot, list["LevelChange"]], Awaitable[None]]
+_listeners: list[Listener] = []
+
+# cumulative since the bot started, exported as membership_level_changes
+counts: Counter[str] = Counter()
+
+
+def subscribe(listener: Listener) -> None:
+    _listeners.append(listener)
+
+
+async def publish(bot: Bot, changes: list[LevelChange]) -> None:
+    if not changes:
+        return
+    level_logger.info(f"Membership level changed for {len(changes)} users: {changes}")
+    for change in changes:
+        counts["upgrade" if change.is_upgrade else "downgrade"] += 1
+    for listener in _listeners:
+        try:
+            await listener(bot, changes)
+        except Exception as e:
+            # one failing listener doesn't keep the others from getting the changes
+            level_logger.error(f"Level change listener {listener.__name__} failed: {e}")
+
+
+async def invalidate_cached(bot: Bot, changes: list[LevelChange]) -> None:
+    for change in changes:
+        membership_cache.invalidate(change.tg_id)
+
+
+async def congratulate_new_pro_members(bot: Bot, changes: list[LevelChange]) -> None:
+    upgrades = [change for change in changes if change.is_upgrade]
+    if len(upgrades) > settings.PRO_CONGRATULATIONS_MAX_BATCH:
+        level_logger.warning(f"{len(upgrades)} users became Pro at once, more than "
+                             f"{settings.PRO_CONGRATULATIONS_MAX_BATCH}, not congratulating them: "
+                             f"{[change.tg_id for change in upgrades]}")
+        return
+    for change in upgrades:
+        await broadcast_engine.send_with_retries(change.tg_id, lambda chat_id: bot.send_message(
+                chat_id=chat_id,
+                text="Теперь у тебя 💜Pro подписка! Спасибо, что поддерживаешь клуб ❤️\n\n"
+                     "Тебе доступны все потоки без ограничений, посмотреть активные потоки можно командой /courses."))
+
+
+subscribe(invalidate_cached)
+subscribe(congratulate_new_pro_members)
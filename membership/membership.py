@@ -1,9 +1,14 @@
 import datetime
 import logging
+import dataclasses
 from dataclasses import dataclass, field
 from datetime import date
-from typing import Optional
+from typing import Iterable, Optional
 
+import sqlalchemy
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
@@ -11,7 +16,7 @@ from telegram.ext import ContextTypes
 import constants
 import helpers
 import models
-from . import fetch_patrons, fetch_boosty_patrons
+from . import effective_membership, membership_cache, patron_cache
 
 membership_logger = logging.getLogger(__name__)
 membership_logger.setLevel(logging.INFO)
@@ -108,95 +113,130 @@ class UserMembershipInfo:
                 f"Boosty price: {self.boosty_price}")
 
 
-def load_membership_by_activity(tg_id: int, tg_username: str = None) -> tuple[MembershipLevel, date]:
-    membership_logger.debug(f"load_membership_by_activity triggered by {tg_username}")
+def pro_tg_ids_query() -> sqlalchemy.Select:
+    # the same rules as UserMembershipInfo.get_overall_level, but read from the materialized table for the whole
+    # audience at once
+    return effective_membership.pro_tg_ids_query()
 
-    level_by_activity: MembershipLevel = basic
-    level_by_activity_expiration: date = date(year=1970, month=1, day=1)
 
-    with Session(models.engine) as session:
-        result = (
-            session.query(models.MembershipByActivity.expires_at)
-            .filter(models.MembershipByActivity.tg_id == str(tg_id))
-            .one_or_none()
-        )
-        if result:
-            membership_logger.debug(f"Got member by activity for {tg_username if tg_username else tg_id} with "
-                                    f"expiration at: {result}")
-            level_by_activity = pro
-            level_by_activity_expiration = result[0]
-    return level_by_activity, level_by_activity_expiration
-
-
-def load_patreon_membership(tg_id: int, tg_username: str = None) -> tuple[str, int]:
-    membership_logger.debug(f"load_patreon_membership triggered by {tg_username}")
+# get_memberships and get_memberships_async share every step except the I/O: the cache lookup, one SQL query for the
+# links and one pipelined Redis round trip for the linked Patreon and Boosty profiles
 
-    patreon_email: str = ""
-    sum_of_entitled_tiers_amount_cents: int = 0
 
-    with Session(models.engine) as session:
-        result = (
-            session.query(models.PatreonLink.patreon_email)
-            .filter(models.PatreonLink.tg_id == str(tg_id))
-            .one_or_none()
-        )
-        if result:
-            membership_logger.debug(f"Got patreon linking for user {tg_username if tg_username else tg_id} : {result}")
-            patreon_email = result[0]
-
-    if patreon_email != "":
-        patreon_info = fetch_patrons.get_patron_by_email(patreon_email)
-        if patreon_info:
-            sum_of_entitled_tiers_amount_cents = int(patreon_info["sum_of_entitled_tiers_amount_cents"])
+def split_cached(tg_ids: Iterable) -> tuple[dict[str, UserMembershipInfo], dict[str, UserMembershipInfo]]:
+    # returns (users to load with default infos, cached users)
+    cached = {}
+    infos = {}
+    for tg_id in map(str, tg_ids):
+        info = membership_cache.get(tg_id)
+        if info is None:
+            infos[tg_id] = UserMembershipInfo()
         else:
-            membership_logger.warning(f"Patreon Linking exists in DB, but not in Redis for user "
-                                      f"{tg_username if tg_username else tg_id}, patreon email is {patreon_email}")
-    return patreon_email, sum_of_entitled_tiers_amount_cents
+            # a copy, so a caller changing it doesn't change the cache
+            cached[tg_id] = dataclasses.replace(info)
+    return infos, cached
 
 
-def load_boosty_membership(tg_id: int, tg_username: str = None) -> tuple[str, str, str, int]:
-    membership_logger.debug(f"load_boosty_membership triggered by {tg_username}")
+def links_query(tg_ids: list[str]) -> sqlalchemy.Select:
+    ids = (
+        func.unnest(sqlalchemy.bindparam("tg_ids", tg_ids, type_=ARRAY(sqlalchemy.Text)))
+        .table_valued("tg_id")
+        .render_derived()
+    )
+    return (
+        select(ids.c.tg_id,
+               models.MembershipByActivity.id.is_not(None),
+               models.MembershipByActivity.expires_at,
+               models.PatreonLink.patreon_email,
+               models.BoostyLink.boosty_user_id)
+        .select_from(ids)
+        .outerjoin(models.MembershipByActivity, models.MembershipByActivity.tg_id == ids.c.tg_id)
+        .outerjoin(models.PatreonLink, models.PatreonLink.tg_id == ids.c.tg_id)
+        .outerjoin(models.BoostyLink, models.BoostyLink.tg_id == ids.c.tg_id)
+        .where(models.MembershipByActivity.id.is_not(None) |
+               models.PatreonLink.tg_id.is_not(None) |
+               models.BoostyLink.tg_id.is_not(None))
+    )
 
-    boosty_user_id: str = ""
-    boosty_email: str = ""
-    boosty_name: str = ""
-    boosty_price: int = 0
+
+def apply_links(infos: dict[str, UserMembershipInfo], rows) -> tuple[list[str], list[str]]:
+    # fills in what's known from the DB and returns the linked profiles to read from Redis
+    emails, boosty_user_ids = [], []
+    for tg_id, has_activity, expires_at, patreon_email, boosty_user_id in rows:
+        info = infos[tg_id]
+        if has_activity:
+            info.member_level_by_activity = pro
+            info.member_level_by_activity_expiration = expires_at
+        if patreon_email:
+            info.patreon_email = patreon_email
+            emails.append(patreon_email)
+        if boosty_user_id:
+            info.boosty_user_id = boosty_user_id
+            boosty_user_ids.append(boosty_user_id)
+    return emails, boosty_user_ids
+
+
+def apply_profiles(infos: dict[str, UserMembershipInfo], rows, patreon_hashes: list[dict],
+                   boosty_hashes: list[dict]) -> None:
+    patreon_hashes, boosty_hashes = iter(patreon_hashes), iter(boosty_hashes)
+    for tg_id, _, _, patreon_email, boosty_user_id in rows:
+        info = infos[tg_id]
+        if patreon_email:
+            patreon_info = next(patreon_hashes)
+            if patreon_info:
+                info.sum_of_entitled_tiers_amount_cents = patron_cache.PatreonRecord.from_hash(
+                    patreon_email, patreon_info).sum_of_entitled_tiers_amount_cents
+            else:
+                membership_logger.warning(f"Patreon Linking exists in DB, but not in Redis for user {tg_id}, "
+                                          f"patreon email is {patreon_email}")
+        if boosty_user_id:
+            boosty_info = next(boosty_hashes)
+            if boosty_info:
+                record = patron_cache.BoostyRecord.from_hash(boosty_user_id, boosty_info)
+                info.boosty_email = record.email
+                info.boosty_name = record.name
+                info.boosty_price = record.price
+            else:
+                membership_logger.warning(f"Boosty Linking exists in DB, but not in Redis for user {tg_id}, "
+                                          f"boosty id is {boosty_user_id}")
+
+    for tg_id, info in infos.items():
+        membership_cache.put(tg_id, dataclasses.replace(info))
+
+
+def get_memberships(tg_ids: Iterable) -> dict[str, UserMembershipInfo]:
+    # Membership of any number of users keyed by tg_id as str. Users without any linking get the default basic
+    # UserMembershipInfo
+    infos, cached = split_cached(tg_ids)
+    if not infos:
+        return cached
 
     with Session(models.engine) as session:
-        result = (
-            session.query(models.BoostyLink.boosty_user_id)
-            .filter(models.BoostyLink.tg_id == str(tg_id))
-            .one_or_none()
-        )
-        if result:
-            membership_logger.debug(f"Got Boosty linking for user {tg_username if tg_username else tg_id} : {result}")
-            boosty_user_id = result[0]
-
-    if boosty_user_id != "":
-        boosty_info = fetch_boosty_patrons.get_boosty_info(boosty_user_id)
-        if boosty_info:
-            boosty_email = boosty_info["email"]
-            boosty_name = boosty_info["name"]
-            boosty_price = int(boosty_info["price"])
-        else:
-            membership_logger.warning(f"Boosty Linking exists in DB, but not in Redis for user "
-                                      f"{tg_username if tg_username else tg_id}, boosty id is {boosty_user_id}")
-    return boosty_user_id, boosty_email, boosty_name, boosty_price
+        rows = session.execute(links_query(list(infos))).all()
+    apply_profiles(infos, rows, *patron_cache.read_profiles(*apply_links(infos, rows)))
+    return infos | cached
 
 
-def get_user_membership_info(tg_id: int, tg_username: str = None) -> UserMembershipInfo:
-    membership_logger.debug(f"get_user_membership_info triggered by {tg_username}")
+async def get_memberships_async(tg_ids: Iterable) -> dict[str, UserMembershipInfo]:
+    # the same as get_memberships, but waiting for Postgres and Redis doesn't block other updates
+    infos, cached = split_cached(tg_ids)
+    if not infos:
+        return cached
+
+    async with AsyncSession(models.async_engine) as session:
+        rows = (await session.execute(links_query(list(infos)))).all()
+    apply_profiles(infos, rows, *await patron_cache.read_profiles_async(*apply_links(infos, rows)))
+    return infos | cached
 
-    info = UserMembershipInfo()
-    info.member_level_by_activity, info.member_level_by_activity_expiration = (
-        load_membership_by_activity(tg_id, tg_username))
 
-    info.patreon_email, info.sum_of_entitled_tiers_amount_cents = load_patreon_membership(tg_id, tg_username)
+def get_user_membership_info(tg_id: int, tg_username: str = None) -> UserMembershipInfo:
+    membership_logger.debug(f"get_user_membership_info triggered by {tg_username}")
+    return get_memberships([tg_id])[str(tg_id)]
 
-    info.boosty_user_id, info.boosty_email, info.boosty_name, info.boosty_price = (
-        load_boosty_membership(tg_id, tg_username))
 
-    return info
+async def get_user_membership_info_async(tg_id: int, tg_username: str = None) -> UserMembershipInfo:
+    membership_logger.debug(f"get_user_membership_info_async triggered by {tg_username}")
+    return (await get_memberships_async([tg_id]))[str(tg_id)]
 
 
 async def reply_for_patreon_members(update: Update, context: ContextTypes.DEFAULT_TYPE,
@@ -305,7 +345,7 @@ async def handle_membership(update: Update, context: ContextTypes.DEFAULT_TYPE)
     tg_user = helpers.get_user(update)
     membership_logger.info(f"handle_membership triggered by {tg_user}")
 
-    membership_info = get_user_membership_info(tg_user.id, tg_user.username)
+    membership_info = await get_user_membership_info_async(tg_user.id, tg_user.username)
 
     if membership_info.get_patreon_level() == pro:
         await reply_for_patreon_members(update, context, membership_info)
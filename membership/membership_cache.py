@@ -0,0 +1,53 @@
+import logging
+import time
+from typing import Any, Optional
+
+import settings
+
+cache_logger = logging.getLogger(__name__)
+cache_logger.setLevel(logging.INFO)
+
+# UserMembershipInfo by tg_id (as str), stored with the monotonic time it was loaded at. Entries are dropped when
+# something changes membership: linking and unlinking, days added by activity, patron reloads. The TTL only limits the
+# damage of a change that doesn't go through one of those paths, like editing the DB by hand.
+_entries: dict[str, tuple[float, Any]] = {}
+
+# cumulative since the bot started, exported as membership_cache_requests
+hits = 0
+misses = 0
+
+
+def get(tg_id) -> Optional[Any]:
+    global hits, misses
+    entry = _entries.get(str(tg_id))
+    if entry is None or time.monotonic() - entry[0] > settings.MEMBERSHIP_CACHE_TTL_SECONDS:
+        misses += 1
+        return None
+    hits += 1
+    return entry[1]
+
+
+def put(tg_id, info: Any) -> None:
+    if len(_entries) >= settings.MEMBERSHIP_CACHE_MAX_SIZE:
+        evict()
+    _entries[str(tg_id)] = (time.monotonic(), info)
+
+
+def evict() -> None:
+    now = time.monotonic()
+    for tg_id in [tg_id for tg_id, (loaded_at, _) in _entries.items()
+                  if now - loaded_at > settings.MEMBERSHIP_CACHE_TTL_SECONDS]:
+        del _entries[tg_id]
+    # still full of fresh entries: drop the oldest half, dicts keep insertion order
+    if len(_entries) >= settings.MEMBERSHIP_CACHE_MAX_SIZE:
+        for tg_id in list(_entries)[:len(_entries) // 2]:
+            del _entries[tg_id]
+
+
+def invalidate(tg_id) -> None:
+    _entries.pop(str(tg_id), None)
+
+
+def invalidate_all() -> None:
+    cache_logger.info(f"Dropping {len(_entries)} cached memberships")
+    _entries.clear()
@@ -9,7 +9,7 @@ from telegram.ext import (CallbackQueryHandler, CommandHandler, ContextTypes, Co
 import helpers
 import models
 import settings
-from membership import fetch_patrons, membership
+from membership import fetch_patrons, effective_membership, membership, patron_refresher
 from monitoring import calculate_metrics_and_report
 
 CONNECT_PATREON = 1
@@ -60,6 +60,7 @@ async def store_patreon_linking(update: Update, patron_email: str, context: Cont
                 text=f"Упс! Случилась ошибка, но проблема не в тебе! Уже оповестил @lenka_colenka"
             )
             return False
+    await effective_membership.refresh_linked_user(context.bot, user.id)
     return True
 
 
@@ -69,14 +70,18 @@ async def connect_with_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
     email_to_find = update.message.text.strip().lower()
     logging.info(f"looking for patron with email {email_to_find}")
 
-    await fetch_patrons.load_patrons(context.bot)
     patron_info = fetch_patrons.get_patron_by_email(email_to_find)
+    if not patron_info or patron_info.sum_of_entitled_tiers_amount_cents < 1500:
+        # the patron may have just subscribed or upgraded, look again in fresh data
+        await patron_refresher.refresh_if_older(context.bot, patron_refresher.PATREON,
+                                                settings.PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS)
+        patron_info = fetch_patrons.get_patron_by_email(email_to_find)
     if patron_info:
         if await store_patreon_linking(update, email_to_find, context):
             logging.info(f"Patron found for email {email_to_find}: {patron_info}")
             msg: str = f"Нашла твой профиль Patreon: {email_to_find}.\n\n"
             # todo: call reply_for_patreon_members or reply_for_basic_with_linked_patreon here
-            donate_amount_cents = int(patron_info['sum_of_entitled_tiers_amount_cents'])
+            donate_amount_cents = patron_info.sum_of_entitled_tiers_amount_cents
             if donate_amount_cents >= 1500:
                 msg += f"Ты донатишь мне ${donate_amount_cents // 100} в месяц. Спасибо! 🥹"
             elif 0 < donate_amount_cents < 1500:
@@ -134,4 +139,5 @@ async def disconnect_patreon_handler(update: Update, context: ContextTypes.DEFAU
         session.query(models.PatreonLink).filter(models.PatreonLink.tg_id == str(tg_user.id)).delete()
         session.commit()
         logging.info(f"Deleted Patreon linking for {tg_user.username}")
-        await membership.handle_membership(update, context)
+    await effective_membership.refresh_linked_user(context.bot, tg_user.id)
+    await membership.handle_membership(update, context)
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+from typing import Optional
+
+from aiohttp import web
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Bot
+
+import models
+import settings
+from . import effective_membership, fetch_patrons, level_changes, membership_cache, patron_cache
+
+webhook_logger = logging.getLogger(__name__)
+webhook_logger.setLevel(logging.INFO)
+
+# Optional receiver for Patreon members:create, members:update and members:delete webhooks, started in post_init when
+# PATREON_WEBHOOK_SECRET is set. A member from a webhook is applied to the stored patrons and the membership cache
+# right away, the periodic full reload then only reconciles what a webhook may have missed.
+# Patreon signs the raw body with HMAC-MD5 of the webhook secret and sends the hex digest in X-Patreon-Signature.
+
+MEMBER_EVENTS = {"members:create", "members:update", "members:delete"}
+
+_runner: Optional[web.AppRunner] = None
+
+
+def is_signature_valid(body: bytes, signature: str) -> bool:
+    expected = hmac.new(settings.PATREON_WEBHOOK_SECRET.encode(), body, hashlib.md5).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def parse_member(payload: dict) -> dict:
+    # a webhook carries one member in the same JSON:API shape as a page of the members API, its amount is None when
+    # the included tiers come without amounts
+    return fetch_patrons.parse_page({"data": [payload["data"]], "included": payload.get("included", [])}, {})[0]
+
+
+async def apply_member(bot: Bot, event: str, member: dict) -> None:
+    # the Redis transaction and the membership refresh are blocking, they run in threads so the webhook doesn't hold
+    # up the bot's updates
+    record = patron_cache.PatreonRecord.from_api(member)
+    # without tier amounts the stored amount is kept, the next full reload brings the right one
+    keep_amount = member["sum_of_entitled_tiers_amount_cents"] is None
+    if not await asyncio.to_thread(patron_cache.apply_patron, record.email,
+                                   None if event == "members:delete" else record, keep_amount):
+        webhook_logger.info(f"No patrons are stored yet, {record.email} comes with the first full reload")
+        return
+
+    async with AsyncSession(models.async_engine) as session:
+        tg_ids = (await session.scalars(select(models.PatreonLink.tg_id)
+                                        .where(models.PatreonLink.patreon_email == record.email))).all()
+    changes = []
+    for tg_id in tg_ids:
+        membership_cache.invalidate(tg_id)
+        changes.extend(await asyncio.to_thread(effective_membership.refresh_user, tg_id))
+    await level_changes.publish(bot, changes)
+
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    body = await request.read()
+    if not is_signature_valid(body, request.headers.get("X-Patreon-Signature", "")):
+        webhook_logger.warning(f"Rejected a Patreon webhook with a wrong signature from {request.remote}")
+        return web.Response(status=403)
+
+    event = request.headers.get("X-Patreon-Event", "")
+    if event not in MEMBER_EVENTS:
+        # pledge and post events are acknowledged, so Patreon doesn't retry them
+        webhook_logger.info(f"Ignoring Patreon webhook {event}")
+        return web.Response(status=204)
+
+    try:
+        member = parse_member(json.loads(body))
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        webhook_logger.warning(f"Couldn't parse Patreon webhook {event}: {e}")
+        return web.Response(status=400)
+    if not member.get("email"):
+        webhook_logger.warning(f"Patreon webhook {event} has no email, the client needs the identity[email] scope")
+        return web.Response(status=204)
+
+    try:
+        await apply_member(request.app["bot"], event, member)
+    except Exception as e:
+        # Patreon retries failed deliveries, and the next full reload fixes the stored patrons anyway
+        webhook_logger.error(f"Couldn't apply Patreon webhook {event} for {member['email']}: {e}")
+        return web.Response(status=500)
+    webhook_logger.info(f"Applied Patreon webhook {event} for {member['email']}")
+    return web.Response(status=204)
+
+
+def make_app(bot: Bot) -> web.Application:
+    app = web.Application()
+    app["bot"] = bot
+    app.router.add_post(settings.PATREON_WEBHOOK_PATH, handle_webhook)
+    return app
+
+
+async def start(bot: Bot) -> None:
+    global _runner
+    if not settings.PATREON_WEBHOOK_SECRET:
+        webhook_logger.info("PATREON_WEBHOOK_SECRET is not set, not receiving Patreon webhooks")
+        return
+    _runner = web.AppRunner(make_app(bot))
+    await _runner.setup()
+    await web.TCPSite(_runner, settings.PATREON_WEBHOOK_HOST, settings.PATREON_WEBHOOK_PORT).start()
+    webhook_logger.info(f"Receiving Patreon webhooks on {settings.PATREON_WEBHOOK_HOST}:"
+                        f"{settings.PATREON_WEBHOOK_PORT}{settings.PATREON_WEBHOOK_PATH}")
+
+
+async def stop() -> None:
+    if _runner:
+        await _runner.cleanup()
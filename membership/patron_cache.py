@@ -0,0 +1,587 @@
+import dataclasses
+import itertools
+import json
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import redis
+import redis.asyncio
+
+import settings
+
+cache_logger = logging.getLogger(__name__)
+cache_logger.setLevel(logging.INFO)
+
+# The one place that knows how Patreon and Boosty patrons are stored in Redis. Both clients share a connection pool
+# each and decode responses to str. Bulk reads and writes go through pipelines, CHUNK_SIZE commands per round trip.
+#
+# The first load writes a generation of keys like patreon:{generation}:user:{email} and publishes it by switching the
+# patreon:generation pointer with one SET. Later reloads compare the new snapshot with the current generation and write
+# only the patrons and derived entries that were added, changed or removed, in one MULTI/EXEC transaction. Readers
+# always see either the whole old or the whole new state, never an empty or half-written one.
+
+r = redis.Redis(connection_pool=redis.ConnectionPool(
+    host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB,
+    max_connections=settings.REDIS_MAX_CONNECTIONS, decode_responses=True))
+async_r = redis.asyncio.Redis(connection_pool=redis.asyncio.ConnectionPool(
+    host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB,
+    max_connections=settings.REDIS_MAX_CONNECTIONS, decode_responses=True))
+
+CHUNK_SIZE = 500
+
+
+@dataclass(frozen=True)
+class Keyspace:
+    name: str
+    # keys of the layout from before generations, removed on the first reload
+    legacy_prefix: str
+
+    @property
+    def pointer(self) -> str:
+        return f"{self.name}:generation"
+
+    @property
+    def counter(self) -> str:
+        return f"{self.name}:generation_counter"
+
+    def key(self, generation: str, patron_id: str) -> str:
+        return f"{self.name}:{generation}:user:{patron_id}"
+
+    def ids_key(self, generation: str) -> str:
+        # ids of all patrons in a generation, so reading all of them or dropping the generation needs no SCAN
+        return f"{self.name}:{generation}:ids"
+
+    def derived_key(self, generation: str, derived: str) -> str:
+        # lookup indexes, summaries and sorted sets built from the patrons at ingest time
+        return f"{self.name}:{generation}:{derived}"
+
+    def derived_keys_key(self, generation: str) -> str:
+        return f"{self.name}:{generation}:derived"
+
+
+patreon = Keyspace(name="patreon", legacy_prefix="user:")
+boosty = Keyspace(name="boosty", legacy_prefix="boosty:user:")
+
+# Reads Patreon and Boosty profiles from the current generations in one round trip, the pointers are resolved on the
+# server. KEYS are the two pointers, ARGV[1] is how many of the following ARGV are Patreon emails, the rest are Boosty
+# user ids. Returns HGETALL replies in the same order, empty for missing profiles.
+read_profiles_lua = """
+local patreon = redis.call('GET', KEYS[1])
+local boosty = redis.call('GET', KEYS[2])
+local patreon_count = tonumber(ARGV[1])
+local result = {}
+for i = 2, #ARGV do
+    local name, generation = 'patreon', patreon
+    if i - 1 > patreon_count then
+        name, generation = 'boosty', boosty
+    end
+    if generation then
+        result[i - 1] = redis.call('HGETALL', name .. ':' .. generation .. ':user:' .. ARGV[i])
+    else
+        result[i - 1] = {}
+    end
+end
+return result
+"""
+read_profiles_script = r.register_script(read_profiles_lua)
+read_profiles_script_async = async_r.register_script(read_profiles_lua)
+
+# Finds Boosty profiles by lowercased email, or by lowercased name when no email matches, in one round trip. KEYS[1] is
+# the pointer, ARGV[1] the value. Index values are comma separated ids, more than one id means the value is ambiguous.
+# Returns a flat [id, HGETALL reply, ...] list.
+find_boosty_lua = """
+local generation = redis.call('GET', KEYS[1])
+if not generation then
+    return {}
+end
+local prefix = 'boosty:' .. generation .. ':'
+local ids = redis.call('HGET', prefix .. 'by_email', ARGV[1])
+if not ids then
+    ids = redis.call('HGET', prefix .. 'by_name', ARGV[1])
+end
+local result = {}
+if ids then
+    for id in string.gmatch(ids, '[^,]+') do
+        table.insert(result, id)
+        table.insert(result, redis.call('HGETALL', prefix .. 'user:' .. id))
+    end
+end
+return result
+"""
+find_boosty_script = r.register_script(find_boosty_lua)
+
+
+def to_int(value) -> int:
+    # older entries may hold "None" for amounts Patreon didn't return
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+@dataclass
+class PatreonRecord:
+    email: str
+    full_name: str
+    patron_status: str
+    currently_entitled_amount_cents: int
+    is_gifted: bool
+    sum_of_entitled_tiers_amount_cents: int
+
+    @classmethod
+    def from_api(cls, member: dict) -> "PatreonRecord":
+        return cls(
+            email=str(member["email"]).lower(),
+            full_name=str(member["full_name"]),
+            patron_status=str(member["patron_status"]),
+            currently_entitled_amount_cents=to_int(member["currently_entitled_amount_cents"]),
+            is_gifted=bool(member["is_gifted"]),
+            sum_of_entitled_tiers_amount_cents=to_int(member["sum_of_entitled_tiers_amount_cents"]),
+        )
+
+    @classmethod
+    def from_hash(cls, email: str, data: dict[str, str]) -> "PatreonRecord":
+        return cls(
+            email=email,
+            full_name=data.get("full_name", ""),
+            patron_status=data.get("patron_status", ""),
+            currently_entitled_amount_cents=to_int(data.get("currently_entitled_amount_cents")),
+            is_gifted=data.get("is_gifted") == "True",
+            sum_of_entitled_tiers_amount_cents=to_int(data.get("sum_of_entitled_tiers_amount_cents")),
+        )
+
+    def to_hash(self) -> dict[str, str]:
+        return {
+            "full_name": self.full_name,
+            "patron_status": self.patron_status,
+            "currently_entitled_amount_cents": str(self.currently_entitled_amount_cents),
+            "is_gifted": str(self.is_gifted),
+            "sum_of_entitled_tiers_amount_cents": str(self.sum_of_entitled_tiers_amount_cents),
+        }
+
+
+@dataclass
+class BoostyRecord:
+    id: str
+    # Boosty email is optional, stored as an empty string when it's missing
+    email: str
+    name: str
+    price: int
+
+    @classmethod
+    def from_api(cls, subscriber: dict) -> "BoostyRecord":
+        return cls(
+            id=str(subscriber["id"]),
+            email=subscriber["email"] or "",
+            name=subscriber["name"] or "",
+            price=to_int(subscriber["price"]),
+        )
+
+    @classmethod
+    def from_hash(cls, boosty_user_id: str, data: dict[str, str]) -> "BoostyRecord":
+        return cls(
+            id=boosty_user_id,
+            email=data.get("email", ""),
+            name=data.get("name", ""),
+            price=to_int(data.get("price")),
+        )
+
+    def to_hash(self) -> dict[str, str]:
+        return {"email": self.email, "name": self.name, "price": str(self.price)}
+
+
+@dataclass
+class StatusSummary:
+    count: int = 0
+    # cents for Patreon, rubles for Boosty
+    total: int = 0
+
+
+def make_summary(records: Iterable[tuple[str, int]]) -> dict[str, str]:
+    # (status, amount) pairs to a summary hash, values are StatusSummary as JSON
+    summaries = defaultdict(StatusSummary)
+    for status, amount in records:
+        summaries[status].count += 1
+        summaries[status].total += amount
+    return {status: json.dumps(dataclasses.asdict(summary)) for status, summary in summaries.items()}
+
+
+def to_dicts(replies: list[list[str]]) -> list[dict[str, str]]:
+    # HGETALL replies from Lua come as flat [field, value, ...] lists
+    return [dict(zip(reply[::2], reply[1::2])) for reply in replies]
+
+
+def split_profiles(emails: list[str], replies: list[list[str]]) -> tuple[list[dict], list[dict]]:
+    hashes = to_dicts(replies)
+    return hashes[:len(emails)], hashes[len(emails):]
+
+
+def read_profiles(emails: list[str], boosty_user_ids: list[str]) -> tuple[list[dict], list[dict]]:
+    # returns Patreon and Boosty hashes in the order of emails and boosty_user_ids, empty for missing ones
+    if not emails and not boosty_user_ids:
+        return [], []
+    replies = read_profiles_script(keys=[patreon.pointer, boosty.pointer],
+                                   args=[len(emails), *emails, *boosty_user_ids], client=r)
+    return split_profiles(emails, replies)
+
+
+async def read_profiles_async(emails: list[str], boosty_user_ids: list[str]) -> tuple[list[dict], list[dict]]:
+    if not emails and not boosty_user_ids:
+        return [], []
+    replies = await read_profiles_script_async(keys=[patreon.pointer, boosty.pointer],
+                                               args=[len(emails), *emails, *boosty_user_ids], client=async_r)
+    return split_profiles(emails, replies)
+
+
+def read_all(space: Keyspace) -> dict[str, dict[str, str]]:
+    generation = r.get(space.pointer)
+    if generation is None:
+        return {}
+    # the generation may be dropped by a concurrent reload between the reads, then it reads as empty
+    return read_patrons(space, generation, sorted(r.smembers(space.ids_key(generation))))
+
+
+def read_patrons(space: Keyspace, generation: str, ids: list[str]) -> dict[str, dict[str, str]]:
+    hashes = []
+    for chunk in itertools.batched(ids, CHUNK_SIZE):
+        pipe = r.pipeline(transaction=False)
+        for patron_id in chunk:
+            pipe.hgetall(space.key(generation, patron_id))
+        hashes.extend(pipe.execute())
+    return {patron_id: data for patron_id, data in zip(ids, hashes) if data}
+
+
+def replace_all(space: Keyspace, mappings: list[tuple[str, dict[str, str]]],
+                hashes: Optional[dict[str, dict[str, str]]] = None,
+                sorted_sets: Optional[dict[str, dict[str, int]]] = None) -> int:
+    generation = str(r.incr(space.counter))
+    for chunk in itertools.batched(mappings, CHUNK_SIZE):
+        pipe = r.pipeline(transaction=False)
+        for patron_id, mapping in chunk:
+            pipe.hset(space.key(generation, patron_id), mapping=mapping)
+        pipe.sadd(space.ids_key(generation), *(patron_id for patron_id, _ in chunk))
+        pipe.execute()
+    derived_keys = []
+    for derived, values in (hashes or {}).items():
+        derived_keys.append(space.derived_key(generation, derived))
+        for chunk in itertools.batched(values.items(), CHUNK_SIZE):
+            r.hset(derived_keys[-1], mapping=dict(chunk))
+    for derived, scores in (sorted_sets or {}).items():
+        derived_keys.append(space.derived_key(generation, derived))
+        for chunk in itertools.batched(scores.items(), CHUNK_SIZE):
+            r.zadd(derived_keys[-1], dict(chunk))
+    if derived_keys:
+        r.sadd(space.derived_keys_key(generation), *derived_keys)
+
+    # SET with GET switches the pointer and returns the previous generation atomically
+    previous = r.set(space.pointer, generation, get=True)
+    cache_logger.info(f"Published {space.name} generation {generation} with {len(mappings)} patrons, "
+                      f"previous was {previous}")
+    if previous is None:
+        delete_by_prefix(space.legacy_prefix)
+    else:
+        drop_generation(space, previous)
+    return len(mappings)
+
+
+def read_derived(space: Keyspace, generation: str) -> tuple[dict[str, dict], dict[str, dict]]:
+    # derived hashes and derived sorted sets as {member: score} dicts, by derived name
+    keys = sorted(r.smembers(space.derived_keys_key(generation)))
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    types = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for key, key_type in zip(keys, types):
+        if key_type == "zset":
+            pipe.zrange(key, 0, -1, withscores=True)
+        else:
+            pipe.hgetall(key)
+    prefix_length = len(space.derived_key(generation, ""))
+    hashes, sorted_sets = {}, {}
+    for key, key_type, values in zip(keys, types, pipe.execute()):
+        (sorted_sets if key_type == "zset" else hashes)[key[prefix_length:]] = dict(values)
+    return hashes, sorted_sets
+
+
+def diff(old: dict, new: dict) -> tuple[dict, set]:
+    # entries to write and keys to delete to turn old into new
+    return {k: v for k, v in new.items() if old.get(k) != v}, old.keys() - new.keys()
+
+
+def sync(space: Keyspace, mappings: list[tuple[str, dict[str, str]]],
+         hashes: Optional[dict[str, dict[str, str]]] = None,
+         sorted_sets: Optional[dict[str, dict[str, int]]] = None) -> Optional[set[str]]:
+    # Makes the current generation match the snapshot, returns ids of added, changed and removed patrons. Without a
+    # current generation everything is written with replace_all and None is returned, as any patron may have changed.
+    hashes, sorted_sets = hashes or {}, sorted_sets or {}
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(space.pointer)
+                generation = pipe.get(space.pointer)
+                if generation is None:
+                    pipe.reset()
+                    replace_all(space, mappings, hashes, sorted_sets)
+                    return None
+
+                # Everything the diff is made from is watched before it's read, so a webhook applying a patron
+                # meanwhile aborts the transaction and the diff is made again, instead of being reverted by it. The
+                # reads themselves go through plain pipelines, WATCH only has to come first on the connection.
+                pipe.watch(space.ids_key(generation), space.derived_keys_key(generation))
+                ids = sorted(r.smembers(space.ids_key(generation)))
+                for chunk in itertools.batched(ids, CHUNK_SIZE):
+                    pipe.watch(*(space.key(generation, patron_id) for patron_id in chunk))
+                if derived_keys := r.smembers(space.derived_keys_key(generation)):
+                    pipe.watch(*derived_keys)
+                changed, removed = diff(read_patrons(space, generation, ids), dict(mappings))
+                old_hashes, old_sorted_sets = read_derived(space, generation)
+
+                pipe.multi()
+                write_diff(pipe, space, generation, changed, removed, hashes, sorted_sets, old_hashes,
+                           old_sorted_sets)
+                pipe.execute()
+                break
+            except redis.WatchError:
+                cache_logger.info(f"{space.name} patrons changed while syncing, syncing again")
+                continue
+
+    cache_logger.info(f"Synced {space.name} generation {generation}: {len(mappings)} patrons, {len(changed)} added or "
+                      f"changed, {len(removed)} removed")
+    return changed.keys() | removed
+
+
+def write_diff(pipe: redis.client.Pipeline, space: Keyspace, generation: str, changed: dict, removed: set,
+               hashes: dict[str, dict[str, str]], sorted_sets: dict[str, dict[str, int]],
+               old_hashes: dict[str, dict], old_sorted_sets: dict[str, dict]) -> None:
+    for patron_id, mapping in changed.items():
+        key = space.key(generation, patron_id)
+        pipe.unlink(key)
+        pipe.hset(key, mapping=mapping)
+    if changed:
+        pipe.sadd(space.ids_key(generation), *changed)
+    if removed:
+        pipe.unlink(*(space.key(generation, patron_id) for patron_id in removed))
+        pipe.srem(space.ids_key(generation), *removed)
+
+    # an empty hash or sorted set disappears, it stays registered in derived and is dropped with the generation
+    for derived in hashes.keys() | old_hashes.keys():
+        key = space.derived_key(generation, derived)
+        updated, stale = diff(old_hashes.get(derived, {}), hashes.get(derived, {}))
+        if updated:
+            pipe.hset(key, mapping=updated)
+        if stale:
+            pipe.hdel(key, *stale)
+    for derived in sorted_sets.keys() | old_sorted_sets.keys():
+        key = space.derived_key(generation, derived)
+        updated, stale = diff(old_sorted_sets.get(derived, {}), sorted_sets.get(derived, {}))
+        if updated:
+            pipe.zadd(key, updated)
+        if stale:
+            pipe.zrem(key, *stale)
+    if new_derived := (hashes.keys() | sorted_sets.keys()) - old_hashes.keys() - old_sorted_sets.keys():
+        pipe.sadd(space.derived_keys_key(generation), *(space.derived_key(generation, derived)
+                                                         for derived in new_derived))
+
+
+def drop_generation(space: Keyspace, generation: str) -> None:
+    # UNLINK frees memory in a background thread on the Redis side
+    ids_key = space.ids_key(generation)
+    for chunk in itertools.batched(r.sscan_iter(ids_key, count=CHUNK_SIZE), CHUNK_SIZE):
+        r.unlink(*(space.key(generation, patron_id) for patron_id in chunk))
+    derived_keys_key = space.derived_keys_key(generation)
+    r.unlink(ids_key, derived_keys_key, *r.smembers(derived_keys_key))
+
+
+def current_generation(space: Keyspace) -> Optional[str]:
+    return r.get(space.pointer)
+
+
+def get_summary(space: Keyspace) -> dict[str, StatusSummary]:
+    generation = current_generation(space)
+    if generation is None:
+        return {}
+    return {status: StatusSummary(**json.loads(summary))
+            for status, summary in r.hgetall(space.derived_key(generation, "summary")).items()}
+
+
+def ids_by_amount(space: Keyspace, sorted_set: str, min_amount: int) -> list[tuple[str, int]]:
+    # ids with an amount of at least min_amount, the biggest amounts first
+    generation = current_generation(space)
+    if generation is None:
+        return []
+    return [(patron_id, int(amount)) for patron_id, amount in r.zrange(
+        space.derived_key(generation, sorted_set), "+inf", min_amount, desc=True, byscore=True, withscores=True)]
+
+
+def count_by_amount(space: Keyspace, sorted_set: str, min_amount: int) -> int:
+    generation = current_generation(space)
+    if generation is None:
+        return 0
+    return r.zcount(space.derived_key(generation, sorted_set), min_amount, "+inf")
+
+
+def delete_by_prefix(prefix: str) -> int:
+    count = 0
+    for chunk in itertools.batched(r.scan_iter(f"{prefix}*", count=CHUNK_SIZE), CHUNK_SIZE):
+        r.unlink(*chunk)
+        count += len(chunk)
+    return count
+
+
+# Patreon
+#
+# A summary of count and total amount per patron_status, and a by_amount:{patron_status} sorted set of emails scored by
+# sum_of_entitled_tiers_amount_cents, so metrics and admin commands don't read every patron.
+
+def store_patrons(records: list[PatreonRecord]) -> Optional[set[str]]:
+    by_amount = defaultdict(dict)
+    for record in records:
+        by_amount[f"by_amount:{record.patron_status}"][record.email] = record.sum_of_entitled_tiers_amount_cents
+    summary = make_summary((record.patron_status, record.sum_of_entitled_tiers_amount_cents) for record in records)
+    return sync(patreon, [(record.email, record.to_hash()) for record in records],
+                hashes={"summary": summary}, sorted_sets=by_amount)
+
+
+def get_patreon_summary() -> dict[str, StatusSummary]:
+    return get_summary(patreon)
+
+
+def get_patrons_by_amount(patron_status: str, min_amount_cents: int = 0) -> list[PatreonRecord]:
+    emails = [email for email, _ in ids_by_amount(patreon, f"by_amount:{patron_status}", min_amount_cents)]
+    patrons = get_patrons(emails)
+    return [patrons[email] for email in emails if email in patrons]
+
+
+def get_patron_emails_by_amount(min_amount_cents: int) -> set[str]:
+    return {email for patron_status in get_patreon_summary()
+            for email, _ in ids_by_amount(patreon, f"by_amount:{patron_status}", min_amount_cents)}
+
+
+def get_patron(email: str) -> Optional[PatreonRecord]:
+    return get_patrons([email]).get(email)
+
+
+def get_patrons(emails: list[str]) -> dict[str, PatreonRecord]:
+    hashes, _ = read_profiles(emails, [])
+    return {email: PatreonRecord.from_hash(email, data) for email, data in zip(emails, hashes) if data}
+
+
+def all_patrons() -> list[PatreonRecord]:
+    return [PatreonRecord.from_hash(email, data) for email, data in read_all(patreon).items()]
+
+
+def apply_patron(email: str, record: Optional[PatreonRecord], keep_amount: bool = False) -> bool:
+    # Writes one patron, or removes it when record is None, into the current generation together with the summary and
+    # sorted sets. Used for webhooks between full reloads. False when nothing is stored yet, the first full load brings
+    # the patron then. With keep_amount the stored sum_of_entitled_tiers_amount_cents stays, 0 for a new patron
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(patreon.pointer)
+                generation = pipe.get(patreon.pointer)
+                if generation is None:
+                    return False
+                key = patreon.key(generation, email)
+                summary_key = patreon.derived_key(generation, "summary")
+                pipe.watch(key, summary_key)
+                old_data = pipe.hgetall(key)
+                summaries = {status: StatusSummary(**json.loads(summary))
+                             for status, summary in pipe.hgetall(summary_key).items()}
+
+                pipe.multi()
+                if record and keep_amount:
+                    record = dataclasses.replace(record, sum_of_entitled_tiers_amount_cents=to_int(
+                        old_data.get("sum_of_entitled_tiers_amount_cents")))
+                if old_data:
+                    old = PatreonRecord.from_hash(email, old_data)
+                    summary = summaries.setdefault(old.patron_status, StatusSummary())
+                    summary.count -= 1
+                    summary.total -= old.sum_of_entitled_tiers_amount_cents
+                    pipe.zrem(patreon.derived_key(generation, f"by_amount:{old.patron_status}"), email)
+                pipe.unlink(key)
+                if record:
+                    pipe.hset(key, mapping=record.to_hash())
+                    pipe.sadd(patreon.ids_key(generation), email)
+                    summary = summaries.setdefault(record.patron_status, StatusSummary())
+                    summary.count += 1
+                    summary.total += record.sum_of_entitled_tiers_amount_cents
+                    by_amount_key = patreon.derived_key(generation, f"by_amount:{record.patron_status}")
+                    pipe.zadd(by_amount_key, {email: record.sum_of_entitled_tiers_amount_cents})
+                    pipe.sadd(patreon.derived_keys_key(generation), by_amount_key, summary_key)
+                else:
+                    pipe.srem(patreon.ids_key(generation), email)
+                # the same as make_summary, statuses without patrons are left out
+                if empty := [status for status, summary in summaries.items() if summary.count <= 0]:
+                    pipe.hdel(summary_key, *empty)
+                if present := {status: json.dumps(dataclasses.asdict(summary))
+                               for status, summary in summaries.items() if summary.count > 0}:
+                    pipe.hset(summary_key, mapping=present)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                # a reload or another webhook changed the patron meanwhile, read it again
+                continue
+
+
+# Boosty
+#
+# Boosty has no statuses, subscribers are "paid" or "free" by price. The by_amount sorted set holds all user ids
+# scored by price.
+
+def make_index(records: list[BoostyRecord], field: str) -> dict[str, str]:
+    ids_by_value = defaultdict(list)
+    for record in records:
+        value = getattr(record, field).strip().lower()
+        if value:
+            ids_by_value[value].append(record.id)
+    return {value: ",".join(ids) for value, ids in ids_by_value.items()}
+
+
+def store_boosty_patrons(records: list[BoostyRecord]) -> Optional[set[str]]:
+    summary = make_summary(("paid" if record.price > 0 else "free", record.price) for record in records)
+    return sync(boosty, [(record.id, record.to_hash()) for record in records],
+                hashes={"by_email": make_index(records, "email"), "by_name": make_index(records, "name"),
+                        "summary": summary},
+                sorted_sets={"by_amount": {record.id: record.price for record in records}})
+
+
+def get_boosty_summary() -> dict[str, StatusSummary]:
+    return get_summary(boosty)
+
+
+def count_boosty_patrons(min_price_rub: int) -> int:
+    return count_by_amount(boosty, "by_amount", min_price_rub)
+
+
+def get_boosty_patrons_by_price(min_price_rub: int) -> list[BoostyRecord]:
+    boosty_user_ids = [boosty_user_id for boosty_user_id, _ in ids_by_amount(boosty, "by_amount", min_price_rub)]
+    boosty_patrons = get_boosty_patrons(boosty_user_ids)
+    return [boosty_patrons[boosty_user_id] for boosty_user_id in boosty_user_ids if boosty_user_id in boosty_patrons]
+
+
+def get_boosty_user_ids_by_price(min_price_rub: int) -> set[str]:
+    return {boosty_user_id for boosty_user_id, _ in ids_by_amount(boosty, "by_amount", min_price_rub)}
+
+
+def get_boosty_patron(boosty_user_id: str) -> Optional[BoostyRecord]:
+    return get_boosty_patrons([boosty_user_id]).get(boosty_user_id)
+
+
+def get_boosty_patrons(boosty_user_ids: list[str]) -> dict[str, BoostyRecord]:
+    _, hashes = read_profiles([], boosty_user_ids)
+    return {boosty_user_id: BoostyRecord.from_hash(boosty_user_id, data)
+            for boosty_user_id, data in zip(boosty_user_ids, hashes) if data}
+
+
+def all_boosty_patrons() -> list[BoostyRecord]:
+    return [BoostyRecord.from_hash(boosty_user_id, data) for boosty_user_id, data in read_all(boosty).items()]
+
+
+def find_boosty_patrons(email_or_name: str) -> list[BoostyRecord]:
+    # all profiles with this email, or with this name if no profile has it as email
+    reply = find_boosty_script(keys=[boosty.pointer], args=[email_or_name.strip().lower()], client=r)
+    return [BoostyRecord.from_hash(boosty_user_id, data)
+            for boosty_user_id, data in zip(reply[::2], to_dicts(reply[1::2]))]
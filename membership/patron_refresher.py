@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from telegram import Bot
+from telegram.ext import ContextTypes
+
+import settings
+from . import fetch_boosty_patrons, fetch_patrons
+
+refresher_logger = logging.getLogger(__name__)
+refresher_logger.setLevel(logging.INFO)
+
+# Patreon and Boosty patrons are reloaded in the background every PATRON_REFRESH_INTERVAL_SECONDS, with jitter.
+# Handlers read whatever is stored, even while a reload runs. When a handler needs fresher data, it asks for a refresh
+# no older than some age. If a reload of that source is already running, it waits for that one instead of starting its
+# own.
+# Neither API can look up a single member by email or id, so a "targeted" refresh still reloads the whole source. It
+# only happens when the stored answer would disappoint the user, and concurrent callers share it.
+
+PATREON = "patreon"
+BOOSTY = "boosty"
+
+loaders: dict[str, Callable[[Bot], Awaitable[bool]]] = {
+    PATREON: fetch_patrons.load_patrons,
+    BOOSTY: fetch_boosty_patrons.load_boosty_patrons,
+}
+
+_in_flight: dict[str, asyncio.Task] = {}
+# monotonic time the last successful reload started at
+_refreshed_at: dict[str, float] = {}
+
+
+def get_age(source: str) -> Optional[float]:
+    # seconds since the stored patrons were fetched, None if they weren't fetched since the bot started
+    refreshed_at = _refreshed_at.get(source)
+    return None if refreshed_at is None else time.monotonic() - refreshed_at
+
+
+async def run(bot: Bot, source: str) -> None:
+    started = time.monotonic()
+    try:
+        if await loaders[source](bot):
+            _refreshed_at[source] = started
+    except Exception as e:
+        # the stored patrons stay as they are until the next refresh
+        refresher_logger.error(f"Couldn't refresh {source} patrons: {e}")
+
+
+async def refresh(bot: Bot, source: str) -> None:
+    task = _in_flight.get(source)
+    if task is None:
+        task = asyncio.create_task(run(bot, source))
+        _in_flight[source] = task
+        task.add_done_callback(lambda _: _in_flight.pop(source, None))
+    # a handler that stops waiting doesn't cancel the refresh for everyone else
+    await asyncio.shield(task)
+
+
+async def refresh_if_older(bot: Bot, source: str, max_age_seconds: float) -> None:
+    age = get_age(source)
+    if source in _in_flight or age is None or age > max_age_seconds:
+        await refresh(bot, source)
+
+
+async def refresh_all(bot: Bot) -> None:
+    await asyncio.gather(*(refresh(bot, source) for source in loaders))
+
+
+async def refresh_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    await refresh_all(context.bot)
+
+
+def register(app) -> None:
+    app.job_queue.run_repeating(
+        callback=refresh_job,
+        interval=settings.PATRON_REFRESH_INTERVAL_SECONDS,
+        first=settings.PATRON_REFRESH_INTERVAL_SECONDS,
+        name="refresh_patrons",
+        # spreads the reloads out, so they don't hit Patreon and Boosty at the same second every time
+        job_kwargs={"jitter": settings.PATRON_REFRESH_JITTER_SECONDS},
+    )
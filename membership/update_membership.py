@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy.dialects.postgresql import insert
 
 import models
+from . import effective_membership, membership_cache
 
 
 def do_add_days(tg_id: str, days_count: int) -> tuple[int, datetime.date | None]:
@@ -39,6 +40,8 @@ def do_add_days(tg_id: str, days_count: int) -> tuple[int, datetime.date | None]
 
         session.execute(stmt)
         session.commit()
+        membership_cache.invalidate(tg_id)
+        effective_membership.refresh_user(tg_id)
         logging.info(f"new membership expiry for {tg_id}: {new_expiry}")
         return days_count, new_expiry
 
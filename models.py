@@ -1,8 +1,9 @@
 from sqlalchemy.orm import declarative_base
 import sqlalchemy
 from sqlalchemy import Column, create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from settings import DATABASE_URL
+from settings import ASYNC_DATABASE_URL, DATABASE_URL
 
 Base = declarative_base()
 
@@ -17,9 +18,6 @@ class User(Base):
     last_name = Column(sqlalchemy.Text, nullable=True)
     date_joined = Column(sqlalchemy.JSON, nullable=True)
     date_membership_started = Column(sqlalchemy.JSON, nullable=True)
-    is_last_message_successful = Column(sqlalchemy.Boolean, nullable=True)
-    # time in UTC
-    last_message_try_time = Column(sqlalchemy.DateTime, nullable=True)
 
     __table_args__ = (
         sqlalchemy.UniqueConstraint('tg_id', name='Users_unique_tg_id'),
@@ -29,6 +27,23 @@ class User(Base):
         return f"User(username={self.tg_username}, telegram_id={self.tg_id})"
 
 
+# Result of the last message the bot tried to send to a user. Kept out of Users so a broadcast only writes narrow rows
+class DeliveryStatus(Base):
+    __tablename__ = 'DeliveryStatus'
+
+    tg_id = Column(sqlalchemy.Text, primary_key=True)
+    is_last_message_successful = Column(sqlalchemy.Boolean, nullable=False)
+    # time in UTC
+    last_message_try_time = Column(sqlalchemy.DateTime, nullable=False)
+    last_error = Column(sqlalchemy.Text, nullable=True)
+    # failures in a row that may go away by themselves, like network errors
+    temporary_failure_count = Column(sqlalchemy.Integer, nullable=False, default=0)
+    # the broadcast that failed with a temporary error sends to the user again at this time (UTC)
+    next_attempt_at = Column(sqlalchemy.DateTime, nullable=True)
+    # the user blocked the bot or the chat is gone, skipped by broadcasts until they talk to the bot again
+    is_suppressed = Column(sqlalchemy.Boolean, nullable=False, default=False)
+
+
 class UserEmail(Base):
     __tablename__ = "UserEmail"
     tg_id = Column(sqlalchemy.Text, nullable=False, primary_key=True)
@@ -182,6 +197,24 @@ class MembershipByActivity(Base):
     expires_at = Column(sqlalchemy.Date, nullable=True)
 
 
+# Rebuilt by membership.effective_membership after patron reloads and membership changes, one row per user who has
+# Pro by any source. Users without a row are Basic
+class EffectiveMembership(Base):
+    __tablename__ = 'EffectiveMembership'
+
+    tg_id = Column(sqlalchemy.Text, primary_key=True)
+    # MembershipLevel.number
+    level = Column(sqlalchemy.Integer, nullable=False)
+    # the level is effective until this date inclusive, null if it doesn't expire
+    expires_at = Column(sqlalchemy.Date, nullable=True)
+    # Pro by Patreon or Boosty
+    is_paid = Column(sqlalchemy.Boolean, nullable=False)
+    has_activity = Column(sqlalchemy.Boolean, nullable=False)
+    activity_expires_at = Column(sqlalchemy.Date, nullable=True)
+    # time in UTC
+    refreshed_at = Column(sqlalchemy.DateTime, nullable=False)
+
+
 class ClubPoints(Base):
     __tablename__ = 'ClubPoints'
 
@@ -222,7 +255,93 @@ class UserLocation(Base):
     )
 
 
+# One row per broadcast. Payload holds everything needed to render the message again after a restart.
+class BroadcastJob(Base):
+    __tablename__ = 'BroadcastJob'
+
+    id = Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=True)
+    name = Column(sqlalchemy.Text, nullable=False)
+    # the same broadcast triggered twice (re-delivered update, job re-run) gets the same key and is not duplicated
+    idempotency_key = Column(sqlalchemy.Text, nullable=False)
+    payload = Column(sqlalchemy.JSON, nullable=False)
+    # spec for notifications.audience.resolve, recipients are resolved again if the bot restarts before it's done
+    audience = Column(sqlalchemy.JSON, nullable=True)
+    is_audience_resolved = Column(sqlalchemy.Boolean, nullable=False)
+    # broadcast_engine priority lane, reminders go before course and club broadcasts
+    priority = Column(sqlalchemy.Integer, nullable=False)
+    status = Column(sqlalchemy.Text, nullable=False)
+    report_chat_id = Column(sqlalchemy.Text, nullable=True)
+    # time in UTC. Reminders are useless after the call is over, so they are not resumed after expiration
+    created_at = Column(sqlalchemy.DateTime, nullable=False)
+    expires_at = Column(sqlalchemy.DateTime, nullable=True)
+    # reminders should be delivered before the call starts, later deliveries are reported to admin
+    deadline_at = Column(sqlalchemy.DateTime, nullable=True)
+    # when a planned job should start
+    start_at = Column(sqlalchemy.DateTime, nullable=True)
+    # digest of everything a planned job was built from, to check cheaply at start time that nothing changed
+    plan_fingerprint = Column(sqlalchemy.Text, nullable=True)
+    finished_at = Column(sqlalchemy.DateTime, nullable=True)
+    # measured by the broadcast engine, summed over all runs of the job. Used to estimate how long a reminder takes
+    attempted_count = Column(sqlalchemy.Integer, nullable=False, default=0)
+    send_duration_seconds = Column(sqlalchemy.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('idempotency_key', name='Unique_broadcast_idempotency_key'),
+    )
+
+    def __repr__(self):
+        return f"BroadcastJob(id={self.id}, name={self.name}, status={self.status})"
+
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'BroadcastRecipient'
+
+    job_id = Column(sqlalchemy.BigInteger, nullable=False, primary_key=True)
+    tg_id = Column(sqlalchemy.Text, nullable=False, primary_key=True)
+    status = Column(sqlalchemy.Text, nullable=False)
+    # a recipient that failed with a temporary error goes back to pending until DELIVERY_MAX_ATTEMPTS, and is not
+    # claimed before retry_at (UTC)
+    attempt_count = Column(sqlalchemy.Integer, nullable=False, default=0)
+    retry_at = Column(sqlalchemy.DateTime, nullable=True)
+
+    __table_args__ = (
+        sqlalchemy.ForeignKeyConstraint(['job_id'], ['BroadcastJob.id'], name='fk_valid_broadcast_job_id',
+                                        ondelete='CASCADE'),
+        sqlalchemy.Index('ix_broadcast_recipient_job_id_status', 'job_id', 'status'),
+    )
+
+
+# One row per email and recipient, drained by notifications.email_outbox in the background
+class EmailOutbox(Base):
+    __tablename__ = 'EmailOutbox'
+
+    id = Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=True)
+    # broadcast job the email goes with, the same job doesn't enqueue the same recipient twice
+    job_id = Column(sqlalchemy.BigInteger, nullable=True)
+    recipient = Column(sqlalchemy.Text, nullable=False)
+    subject = Column(sqlalchemy.Text, nullable=False)
+    body = Column(sqlalchemy.Text, nullable=False)
+    status = Column(sqlalchemy.Text, nullable=False)
+    attempts = Column(sqlalchemy.Integer, nullable=False, default=0)
+    last_error = Column(sqlalchemy.Text, nullable=True)
+    # time in UTC
+    created_at = Column(sqlalchemy.DateTime, nullable=False)
+    next_attempt_at = Column(sqlalchemy.DateTime, nullable=False)
+    # reminders are useless after the call is over, they are not sent after this time
+    expires_at = Column(sqlalchemy.DateTime, nullable=True)
+    sent_at = Column(sqlalchemy.DateTime, nullable=True)
+
+    __table_args__ = (
+        sqlalchemy.UniqueConstraint('job_id', 'recipient', name='Unique_email_outbox_job_id_recipient'),
+        sqlalchemy.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f"EmailOutbox(id={self.id}, recipient={self.recipient}, status={self.status})"
+
+
 engine = create_engine(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
 
 # todo: these are essentially feature flags, but are not persisted across restarts. Need a nicer way to work with
 #  feature flags.
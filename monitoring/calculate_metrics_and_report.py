@@ -6,7 +6,9 @@ from monitoring.push_monitoring import metrics
 from sqlalchemy import distinct, func
 from sqlalchemy.orm import Session
 from telegram import Bot
-from membership import fetch_boosty_patrons, fetch_patrons, membership
+from membership import effective_membership, fetch_boosty_patrons, fetch_patrons, level_changes, membership_cache
+from monitoring import delivery_ledger
+from notifications import email_outbox
 from monitoring.zoom_attendance import set_zoom_attendance_for_active_courses
 
 import models
@@ -28,8 +30,7 @@ def users_started_bot_count() -> int:
 
 
 def users_failed_broadcast_count() -> int:
-    with Session(models.engine) as session:
-        failed_users_count = session.query(models.User).filter(models.User.is_last_message_successful.is_(False)).count()
+    failed_users_count = delivery_ledger.get_failed_count()
     logger.info(f"users_failed_broadcast_count: {failed_users_count}")
     return failed_users_count
 
@@ -107,25 +108,25 @@ def set_enrolled_users_map() -> None:
         )
 
 
-def set_enrolled_users_paid_map() -> None:
+def count_enrolled_per_active_course(tg_ids_query) -> dict[str, int]:
+    # users from tg_ids_query enrolled in each active course, counted in one query
     with Session(models.engine) as session:
         results = (
             session.query(
                 models.Course.name,
-                models.Enrollment.tg_id,
+                func.count(models.Enrollment.tg_id),
             )
             .join(models.Course, models.Course.id == models.Enrollment.course_id)
             .filter(models.Course.is_active.is_(True))
+            .filter(models.Enrollment.tg_id.in_(tg_ids_query))
+            .group_by(models.Course.name)
             .all()
         )
+    return dict(results)
 
-    course_paid_map: dict[str, int] = {}
-
-    for course_name, tg_id in results:
-        membership_info = membership.get_user_membership_info(tg_id)
 
-        if membership_info.get_patreon_level() == membership.pro or membership_info.get_boosty_level() == membership.pro:
-            course_paid_map[course_name] = course_paid_map.get(course_name, 0) + 1
+def set_enrolled_users_paid_map() -> None:
+    course_paid_map = count_enrolled_per_active_course(effective_membership.paid_tg_ids_query())
 
     logger.info(f"{course_paid_map=}")
     for course_name, enrolled_count in course_paid_map.items():
@@ -136,25 +137,9 @@ def set_enrolled_users_paid_map() -> None:
         )
 
 
-# todo: forgive me gods of performance and DRY
 def set_enrolled_users_activity_membership_map() -> None:
-    with Session(models.engine) as session:
-        results = (
-            session.query(
-                models.Course.name,
-                models.Enrollment.tg_id,
-            )
-            .join(models.Course, models.Course.id == models.Enrollment.course_id)
-            .filter(models.Course.is_active.is_(True))
-            .all()
-        )
-
-    course_activity_membership_map: dict[str, int] = {}
-
-    for course_name, tg_id in results:
-        membership_info = membership.get_user_membership_info(tg_id)
-        if membership_info.get_activity_level() == membership.pro:
-            course_activity_membership_map[course_name] = course_activity_membership_map.get(course_name, 0) + 1
+    course_activity_membership_map = count_enrolled_per_active_course(
+        effective_membership.pro_by_activity_tg_ids_query())
 
     logger.info(f"{course_activity_membership_map=}")
 
@@ -171,10 +156,17 @@ async def calculate_metrics_and_report(bot: Bot = None) -> None:
     try:
         metrics.set("users_started_bot", users_started_bot_count())
         metrics.set("users_failed_broadcast", users_failed_broadcast_count())
+        metrics.set("users_suppressed", delivery_ledger.get_suppressed_count())
+        metrics.set("membership_cache_requests", membership_cache.hits, result="hit")
+        metrics.set("membership_cache_requests", membership_cache.misses, result="miss")
+        for change in ("upgrade", "downgrade"):
+            metrics.set("membership_level_changes", level_changes.counts[change], change=change)
+        for status, count in email_outbox.get_status_counts().items():
+            metrics.set("email_outbox", count, status=status)
 
         # membership
-        metrics.set("patreon_patrons", len(fetch_patrons.get_patrons_from_redis("active_patron")))
-        metrics.set("boosty_patrons", len(fetch_boosty_patrons.get_boosty_patrons_from_redis(1)))
+        metrics.set("patreon_patrons", fetch_patrons.get_patrons_summary("active_patron").count)
+        metrics.set("boosty_patrons", fetch_boosty_patrons.count_boosty_patrons(1))
         set_activity_members()
 
         # users enrolled to any course
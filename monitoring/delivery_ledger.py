@@ -0,0 +1,115 @@
+import datetime
+import itertools
+import logging
+
+import sqlalchemy
+from sqlalchemy import select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import models
+from notifications import broadcast_engine
+import settings
+
+ledger_logger = logging.getLogger(__name__)
+ledger_logger.setLevel(logging.INFO)
+
+# rows per statement, so one write never holds a long IN list or a long lock
+CHUNK_SIZE = 1000
+
+# Results are sent as arrays and unnested on the server: one statement per chunk instead of one per user.
+# A temporary failure pushes next_attempt_at out exponentially, a permanent one suppresses the user, a success resets
+# both. Other errors (like a bad message) say nothing about the user and leave the schedule as it is.
+# next_attempt_at is when the broadcast that failed retries its message, other broadcasts still send to the user.
+# Parameters are cast explicitly, asyncpg doesn't guess their types when the statement runs from an AsyncSession.
+upsert_statuses = text('''
+    INSERT INTO "DeliveryStatus" AS ds (tg_id, is_last_message_successful, last_message_try_time, last_error,
+                                        temporary_failure_count, next_attempt_at, is_suppressed)
+    SELECT tg_id, error IS NULL, CAST(:tried_at AS TIMESTAMP), error,
+           CASE WHEN is_temporary THEN 1 ELSE 0 END,
+           CASE WHEN is_temporary
+                THEN CAST(:tried_at AS TIMESTAMP) + make_interval(mins => CAST(:retry_base_minutes AS INT)) END,
+           is_permanent
+    FROM unnest(CAST(:tg_ids AS TEXT[]), CAST(:errors AS TEXT[]), CAST(:is_temporary AS BOOLEAN[]),
+                CAST(:is_permanent AS BOOLEAN[])) AS delivery(tg_id, error, is_temporary, is_permanent)
+    ON CONFLICT (tg_id) DO UPDATE SET
+        is_last_message_successful = excluded.is_last_message_successful,
+        last_message_try_time = excluded.last_message_try_time,
+        last_error = excluded.last_error,
+        temporary_failure_count = CASE
+            WHEN excluded.last_error IS NULL THEN 0
+            WHEN excluded.temporary_failure_count > 0 THEN ds.temporary_failure_count + 1
+            ELSE ds.temporary_failure_count END,
+        next_attempt_at = CASE
+            WHEN excluded.last_error IS NULL THEN NULL
+            WHEN excluded.temporary_failure_count > 0 THEN excluded.last_message_try_time + make_interval(
+                mins => LEAST(CAST(:retry_max_minutes AS INT),
+                              CAST(:retry_base_minutes AS INT) * power(2, LEAST(ds.temporary_failure_count, 20)))::int)
+            ELSE ds.next_attempt_at END,
+        is_suppressed = CASE
+            WHEN excluded.last_error IS NULL THEN FALSE
+            ELSE ds.is_suppressed OR excluded.is_suppressed END
+''')
+
+
+def write_deliveries(session: Session, success_ids: list[str], failures: dict[str, str]) -> None:
+    # flood control is bot-wide, it says nothing about the users who happened to get it
+    failures = {tg_id: error for tg_id, error in failures.items() if error != broadcast_engine.RATE_LIMITED}
+    tried_at = datetime.datetime.utcnow()
+    deliveries = itertools.chain(((str(tg_id), None) for tg_id in success_ids),
+                                 ((str(tg_id), error) for tg_id, error in failures.items()))
+    for chunk in itertools.batched(deliveries, CHUNK_SIZE):
+        tg_ids, errors = zip(*chunk)
+        session.execute(upsert_statuses, {
+            "tg_ids": list(tg_ids),
+            "errors": list(errors),
+            "is_temporary": [error in broadcast_engine.TEMPORARY_ERRORS for error in errors],
+            "is_permanent": [error in broadcast_engine.PERMANENT_ERRORS for error in errors],
+            "tried_at": tried_at,
+            "retry_base_minutes": settings.DELIVERY_RETRY_BASE_MINUTES,
+            "retry_max_minutes": settings.DELIVERY_RETRY_MAX_MINUTES,
+        })
+    ledger_logger.debug(f"Recorded {len(success_ids)} successful and {len(failures)} failed deliveries")
+
+
+def record_deliveries(success_ids: list[str], failures: dict[str, str]) -> None:
+    with Session(models.engine) as session:
+        write_deliveries(session, success_ids, failures)
+        session.commit()
+
+
+def suppressed_tg_ids_query() -> sqlalchemy.Select:
+    # users that broadcasts should skip until they talk to the bot again
+    return select(models.DeliveryStatus.tg_id).where(models.DeliveryStatus.is_suppressed.is_(True))
+
+
+def set_suppressed(tg_id: str, is_suppressed: bool) -> None:
+    # called when a user blocks the bot or talks to it again
+    with Session(models.engine) as session:
+        if is_suppressed:
+            session.execute(
+                insert(models.DeliveryStatus)
+                .values(tg_id=str(tg_id), is_last_message_successful=False,
+                        last_message_try_time=datetime.datetime.utcnow(), last_error="blocked",
+                        temporary_failure_count=0, is_suppressed=True)
+                .on_conflict_do_update(index_elements=["tg_id"], set_={"is_suppressed": True})
+            )
+        else:
+            session.execute(
+                update(models.DeliveryStatus)
+                .where(models.DeliveryStatus.tg_id == str(tg_id))
+                .values(is_suppressed=False, next_attempt_at=None, temporary_failure_count=0)
+            )
+        session.commit()
+    ledger_logger.info(f"User {tg_id} is {'suppressed' if is_suppressed else 'reachable'} now")
+
+
+def get_failed_count() -> int:
+    with Session(models.engine) as session:
+        return session.query(models.DeliveryStatus).filter(
+            models.DeliveryStatus.is_last_message_successful.is_(False)).count()
+
+
+def get_suppressed_count() -> int:
+    with Session(models.engine) as session:
+        return session.query(models.DeliveryStatus).filter(models.DeliveryStatus.is_suppressed.is_(True)).count()
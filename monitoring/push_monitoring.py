@@ -20,6 +20,10 @@ class MetricsPusher:
                 'users_failed_broadcast',
                 'Users failed during a broadcast out of all users who started the bot',
                 registry=self.registry),
+            "users_suppressed": Gauge(
+                'users_suppressed',
+                'Users who blocked the bot or whose chat is gone, skipped by broadcasts',
+                registry=self.registry),
             "patreon_patrons": Gauge(
                 'patreon_patrons',
                 'Active paying > 0 Patreon patrons',
@@ -66,9 +70,34 @@ class MetricsPusher:
                 'Users with membership by activity',
                 ['temporary'],
                 registry=self.registry),
+            "broadcast_recipients": Gauge(
+                'broadcast_recipients',
+                'Recipients of the last broadcast with this name by delivery status',
+                ['broadcast', 'status'],
+                registry=self.registry),
+            "broadcast_send_rate": Gauge(
+                'broadcast_send_rate',
+                'Messages per second sent during the last broadcast with this name',
+                ['broadcast'],
+                registry=self.registry),
+            "membership_cache_requests": Gauge(
+                'membership_cache_requests',
+                'Membership lookups since the bot started, served from the in-process cache or not',
+                ['result'],
+                registry=self.registry),
+            "membership_level_changes": Gauge(
+                'membership_level_changes',
+                'Users who became Pro (upgrade) or lost it (downgrade) on patron reloads since the bot started',
+                ['change'],
+                registry=self.registry),
+            "email_outbox": Gauge(
+                'email_outbox',
+                'Emails in the outbox by status',
+                ['status'],
+                registry=self.registry),
         }
 
-    def set(self, metric_name: str, value: int, **labels):
+    def set(self, metric_name: str, value: int | float, **labels):
         if metric_name not in self._gauges:
             raise ValueError(f"Unknown metric: {metric_name}")
 
@@ -0,0 +1,141 @@
+import datetime
+import logging
+from typing import AsyncIterator, Callable
+
+import sqlalchemy
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import models
+from membership import membership
+from monitoring import delivery_ledger
+import settings
+
+audience_logger = logging.getLogger(__name__)
+audience_logger.setLevel(logging.DEBUG)
+
+# Audience is stored in a broadcast job as a spec like {"kind": "course", "course_id": 3, "level": 2}, so an interrupted
+# job can resolve it again after a restart. Level is MembershipLevel.number.
+
+
+def filter_by_level(stmt: sqlalchemy.Select, tg_id_column, level: int = None) -> sqlalchemy.Select:
+    if level is None:
+        return stmt
+    pro_tg_ids = membership.pro_tg_ids_query()
+    if level == membership.pro.number:
+        return stmt.where(tg_id_column.in_(pro_tg_ids))
+    if level == membership.basic.number:
+        return stmt.where(tg_id_column.not_in(pro_tg_ids))
+    raise ValueError(f"Unknown membership level {level}")
+
+
+def all_users_query(level: int = None, without_active_course: bool = False) -> sqlalchemy.Select:
+    stmt = select(models.User.tg_id)
+    if without_active_course:
+        active_tg_ids = (
+            select(models.Enrollment.tg_id)
+            .join(models.Course, models.Course.id == models.Enrollment.course_id)
+            .where(models.Course.is_active.is_(True))
+        )
+        stmt = stmt.where(models.User.tg_id.not_in(active_tg_ids))
+    return filter_by_level(stmt, models.User.tg_id, level)
+
+
+def course_members_query(course_id: int, level: int = None) -> sqlalchemy.Select:
+    stmt = select(models.Enrollment.tg_id).where(models.Enrollment.course_id == course_id)
+    return filter_by_level(stmt, models.Enrollment.tg_id, level)
+
+
+def course_members_without_mock_sign_up_query(course_id: int) -> sqlalchemy.Select:
+    signed_up_this_week = (
+        select(models.MockSignUp.tg_id)
+        .where(models.MockSignUp.week_number == datetime.date.today().isocalendar().week)
+    )
+    stmt = (
+        select(models.Enrollment.tg_id)
+        .where((models.Enrollment.course_id == course_id) & models.Enrollment.tg_id.not_in(signed_up_this_week))
+    )
+    return stmt
+
+
+def combination_query(include: list[dict], exclude: list[dict] = None) -> sqlalchemy.Select:
+    # users who are in every `include` audience and in none of `exclude`
+    stmt = build_query(include[0])
+    tg_id_column = stmt.selected_columns[0]
+    for spec in include[1:]:
+        stmt = stmt.where(tg_id_column.in_(build_query(spec)))
+    for spec in exclude or []:
+        stmt = stmt.where(tg_id_column.not_in(build_query(spec)))
+    return stmt
+
+
+queries: dict[str, Callable[..., sqlalchemy.Select]] = {
+    "all_users": all_users_query,
+    "course": course_members_query,
+    "course_without_mock_sign_up": course_members_without_mock_sign_up_query,
+    "combination": combination_query,
+}
+
+
+def build_query(spec: dict) -> sqlalchemy.Select:
+    kwargs = dict(spec)
+    kind = kwargs.pop("kind")
+    return queries[kind](**kwargs)
+
+
+def reachable_query(spec: dict) -> sqlalchemy.Select:
+    # users of the audience a broadcast job will actually send to, it skips the ones who blocked the bot
+    stmt = build_query(spec)
+    tg_id_column = stmt.selected_columns[0]
+    return stmt.where(tg_id_column.not_in(delivery_ledger.suppressed_tg_ids_query()))
+
+
+async def resolve(spec: dict, chunk_size: int) -> AsyncIterator[list[str]]:
+    audience_logger.info(f"resolving audience {spec}")
+    # suppressed users are resolved too, the job skips them when it claims them: a job planned ahead still sends to
+    # users who talked to the bot again since then
+    stmt = build_query(spec)
+    # Only tg_id is selected and rows come from a server-side cursor, so memory doesn't grow with the audience. The
+    # cursor is read through the async engine, so waiting for the next rows doesn't block other updates
+    async with AsyncSession(models.async_engine) as session:
+        result = await session.stream_scalars(stmt.execution_options(yield_per=settings.AUDIENCE_YIELD_PER))
+        async for chunk in result.partitions(chunk_size):
+            yield list(chunk)
+
+
+def fingerprint(spec: dict) -> str:
+    # Digest of who is in the audience, computed in Postgres: the count and the sum of tg_id hashes change when someone
+    # joins or leaves. Order doesn't matter, so the audience isn't sorted or concatenated, and only two numbers travel
+    # over the network. Delivery results don't change it, they are applied when the job sends
+    stmt = build_query(spec).subquery()
+    with Session(models.engine) as session:
+        size, hash_sum = session.execute(
+            select(func.count(), func.coalesce(func.sum(func.hashtextextended(stmt.c.tg_id, 0)), 0))
+        ).one()
+    return f"{size}:{hash_sum}"
+
+
+def count(spec: dict) -> int:
+    with Session(models.engine) as session:
+        return session.execute(select(func.count()).select_from(reachable_query(spec).subquery())).scalar_one()
+
+
+def find_overlaps(specs: dict[int, dict]) -> list[tuple[int, ...]]:
+    # Groups of keys whose audiences share users, like (3, 5) if some users are enrolled in both course 3 and 5.
+    # Computed in one query, tg_ids don't leave Postgres
+    if len(specs) < 2:
+        return []
+    memberships = sqlalchemy.union_all(*[
+        select(sqlalchemy.literal(key).label("key"), audience.c.tg_id.label("tg_id"))
+        for key, audience in ((key, build_query(spec).subquery()) for key, spec in specs.items())
+    ]).subquery()
+    keys_per_user = (
+        select(func.array_agg(aggregate_order_by(memberships.c.key, memberships.c.key)).label("audience_keys"))
+        .group_by(memberships.c.tg_id)
+        .having(func.count() > 1)
+        .subquery()
+    )
+    with Session(models.engine) as session:
+        return [tuple(keys) for keys in session.execute(select(keys_per_user.c.audience_keys).distinct()).scalars()]
@@ -0,0 +1,279 @@
+import asyncio
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterable, Awaitable, Callable, Iterable
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import settings
+
+broadcast_logger = logging.getLogger(__name__)
+broadcast_logger.setLevel(logging.DEBUG)
+
+# Telegram allows one message per second to the same chat
+PER_CHAT_INTERVAL_SECONDS = 1.0
+
+# Priority lanes, a lower number goes first. All broadcasts share one rate limit, so while a reminder is being sent,
+# course and club broadcasts only get the tokens the reminder can't use.
+REMINDER_PRIORITY = 0
+COURSE_PRIORITY = 1
+CLUB_PRIORITY = 2
+
+# send outcomes
+SENT = "sent"
+BLOCKED = "blocked"  # the user blocked the bot or deleted their account
+CHAT_NOT_FOUND = "chat_not_found"
+RATE_LIMITED = "rate_limited"  # still got flood control after all attempts, the limit is bot-wide, not per user
+NETWORK_ERROR = "network_error"
+BAD_REQUEST = "bad_request"  # the message itself is wrong, nothing is wrong with the user
+UNEXPECTED_ERROR = "unexpected_error"
+
+# these users won't get any message until they talk to the bot again
+PERMANENT_ERRORS = {BLOCKED, CHAT_NOT_FOUND}
+# these users may be reachable later, the broadcast retries them on an exponential schedule
+TEMPORARY_ERRORS = {NETWORK_ERROR}
+
+
+class TokenBucket:
+    # Telegram lets a bot send about 30 messages per second to different chats. The bucket refills at `rate` tokens per
+    # second. On 429 the rate is halved and sending is paused for `retry_after`, then the rate slowly recovers back to
+    # `max_rate`.
+    # Senders take turns to get a token. Waiting senders are ordered by priority, then by arrival, so a reminder waits
+    # for at most one token behind a club broadcast, never for the whole club queue.
+    def __init__(self, max_rate: float, capacity: int, recovery_per_second: float):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.capacity = capacity
+        self.recovery_per_second = recovery_per_second
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_last_sent: dict[str, float] = {}
+        self._is_turn_taken = False
+        self._waiting: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + elapsed * self.recovery_per_second)
+        self.tokens = min(float(self.capacity), self.tokens + elapsed * self.rate)
+
+    async def _take_turn(self, priority: int) -> None:
+        if not self._is_turn_taken:
+            self._is_turn_taken = True
+            return
+
+        turn = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._arrivals), turn))
+        try:
+            await turn
+        except asyncio.CancelledError:
+            if turn.done() and not turn.cancelled():
+                # got the turn right when cancelled, hand it over so other senders don't wait forever
+                self._pass_turn()
+            raise
+
+    def _pass_turn(self) -> None:
+        while self._waiting:
+            _, _, turn = heapq.heappop(self._waiting)
+            if not turn.done():
+                turn.set_result(None)
+                return
+        self._is_turn_taken = False
+
+    async def acquire(self, chat_id: str, priority: int = CLUB_PRIORITY) -> None:
+        # waiters queue up in turns instead of all waking up at once after a pause
+        await self._take_turn(priority)
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self._pass_turn()
+
+        chat_wait = self.chat_last_sent.get(chat_id, 0.0) + PER_CHAT_INTERVAL_SECONDS - time.monotonic()
+        if chat_wait > 0:
+            await asyncio.sleep(chat_wait)
+        self.chat_last_sent[chat_id] = time.monotonic()
+        if len(self.chat_last_sent) > 10_000:
+            self._forget_old_chats()
+
+    def back_off(self, retry_after_seconds: float) -> None:
+        self.rate = max(self.max_rate / 8, self.rate / 2)
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after_seconds)
+        broadcast_logger.warning(f"Got flood control from Telegram, pausing for {retry_after_seconds}s, new rate is "
+                                 f"{self.rate:.1f} msg/s")
+
+    def _forget_old_chats(self) -> None:
+        threshold = time.monotonic() - PER_CHAT_INTERVAL_SECONDS
+        self.chat_last_sent = {chat_id: sent_at for chat_id, sent_at in self.chat_last_sent.items()
+                               if sent_at > threshold}
+
+
+# one bucket for the whole bot: Telegram limits are per bot token, not per broadcast
+limiter = TokenBucket(
+    max_rate=settings.BROADCAST_MAX_RATE_PER_SECOND,
+    capacity=settings.BROADCAST_BURST,
+    recovery_per_second=settings.BROADCAST_RATE_RECOVERY_PER_SECOND,
+)
+
+
+# chat ids finished since the last checkpoint
+@dataclass
+class BroadcastResult:
+    success_ids: list[str] = field(default_factory=list)
+    # chat id -> error outcome
+    failures: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def failed_ids(self) -> list[str]:
+        return list(self.failures)
+
+    def count(self) -> int:
+        return len(self.success_ids) + len(self.failures)
+
+
+@dataclass
+class BroadcastStats:
+    successful_count: int = 0
+    failed_count: int = 0
+    duration_seconds: float = 0.0
+    errors: collections.Counter = field(default_factory=collections.Counter)
+
+    def count(self) -> int:
+        return self.successful_count + self.failed_count
+
+    def send_rate(self) -> float:
+        return self.count() / self.duration_seconds if self.duration_seconds else 0.0
+
+
+def get_retry_after_seconds(e: RetryAfter) -> float:
+    retry_after = e.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def get_jittered_backoff(attempt: int) -> float:
+    # full jitter: random delay between 0 and base * 2^attempt
+    return random.uniform(0, settings.BROADCAST_RETRY_BASE_SECONDS * 2 ** attempt)
+
+
+def classify_error(e: Exception) -> str:
+    if isinstance(e, Forbidden):
+        return BLOCKED
+    if isinstance(e, BadRequest):
+        # BadRequest is a subclass of NetworkError, so it has to be checked first
+        return CHAT_NOT_FOUND if "chat not found" in e.message.lower() else BAD_REQUEST
+    if isinstance(e, RetryAfter):
+        return RATE_LIMITED
+    if isinstance(e, NetworkError):
+        return NETWORK_ERROR
+    return UNEXPECTED_ERROR
+
+
+async def send_with_retries(chat_id: str, send: Callable[[str], Awaitable], priority: int = CLUB_PRIORITY) -> str:
+    outcome = UNEXPECTED_ERROR
+    for attempt in range(settings.BROADCAST_MAX_ATTEMPTS):
+        await limiter.acquire(chat_id, priority)
+        try:
+            await send(chat_id)
+            return SENT
+        except Exception as e:
+            outcome = classify_error(e)
+            if outcome == RATE_LIMITED:
+                limiter.back_off(get_retry_after_seconds(e) + random.uniform(0, 1))
+            elif outcome == NETWORK_ERROR:
+                delay = get_jittered_backoff(attempt)
+                broadcast_logger.debug(f"Network error while sending to {chat_id}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+            elif outcome == UNEXPECTED_ERROR:
+                broadcast_logger.warning(f"Unexpected error while sending to {chat_id}: {e}")
+                return outcome
+            else:
+                # retrying won't help
+                broadcast_logger.debug(f"Couldn't send to {chat_id}: {e}")
+                return outcome
+    broadcast_logger.info(f"Giving up on {chat_id} after {settings.BROADCAST_MAX_ATTEMPTS} attempts: {outcome}")
+    return outcome
+
+
+async def send_to_all(chat_ids: Iterable[str] | AsyncIterable[str], send: Callable[[str], Awaitable], name: str,
+                      checkpoint: Callable[[BroadcastResult], Awaitable],
+                      priority: int = CLUB_PRIORITY) -> BroadcastStats:
+    # Chat ids are streamed through a bounded queue, so sending starts as soon as the first ids are known and the whole
+    # audience never has to be in memory. `checkpoint` gets every batch of finished sends while the broadcast runs.
+    stats = BroadcastStats()
+    unsaved = BroadcastResult()
+    queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize=settings.BROADCAST_CONCURRENCY * 2)
+
+    async def feed() -> None:
+        try:
+            if isinstance(chat_ids, AsyncIterable):
+                async for chat_id in chat_ids:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in chat_ids:
+                    await queue.put(chat_id)
+        finally:
+            for _ in range(settings.BROADCAST_CONCURRENCY):
+                await queue.put(None)
+
+    async def save() -> None:
+        nonlocal unsaved
+        # swap before awaiting, so sends finished by other workers meanwhile go to the next checkpoint
+        finished, unsaved = unsaved, BroadcastResult()
+        if finished.count():
+            try:
+                await checkpoint(finished)
+            except Exception as e:
+                # keep sending and save these with the next checkpoint, otherwise they would be sent to again
+                broadcast_logger.error(f"Couldn't checkpoint {name} broadcast: {e}")
+                unsaved.success_ids.extend(finished.success_ids)
+                unsaved.failures.update(finished.failures)
+
+    async def worker() -> None:
+        while (chat_id := await queue.get()) is not None:
+            outcome = await send_with_retries(chat_id, send, priority)
+            if outcome == SENT:
+                stats.successful_count += 1
+                unsaved.success_ids.append(chat_id)
+            else:
+                stats.failed_count += 1
+                stats.errors[outcome] += 1
+                unsaved.failures[chat_id] = outcome
+
+            if unsaved.count() >= settings.BROADCAST_JOB_BATCH_SIZE:
+                await save()
+            if stats.count() % 50 == 0:
+                broadcast_logger.info(f"{name} broadcast in progress: {stats.successful_count} successful, "
+                                      f"{stats.failed_count} failed so far")
+
+    started_at = time.monotonic()
+    workers = [asyncio.create_task(worker()) for _ in range(settings.BROADCAST_CONCURRENCY)]
+    try:
+        await feed()
+    finally:
+        await asyncio.gather(*workers)
+        await save()
+        stats.duration_seconds = time.monotonic() - started_at
+    broadcast_logger.info(f"{name} broadcast finished in {stats.duration_seconds:.1f}s: "
+                          f"{stats.successful_count} successful, {stats.failed_count} failed {dict(stats.errors)}")
+    return stats
@@ -0,0 +1,437 @@
+import asyncio
+import contextlib
+import datetime
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import sqlalchemy
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from telegram import Bot
+
+import models
+from monitoring import delivery_ledger, push_monitoring
+import settings
+from . import audience, broadcast_engine, rendering
+
+jobs_logger = logging.getLogger(__name__)
+jobs_logger.setLevel(logging.DEBUG)
+
+# job statuses
+# built ahead of time with the audience already resolved, waiting for its start time
+PLANNED = "planned"
+RUNNING = "running"
+PAUSED = "paused"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+DONE = "done"
+
+# recipient statuses
+PENDING = "pending"
+# claimed by a runner but not confirmed yet. If the bot dies here we don't know if the message was delivered, so the
+# recipient is sent to again when the job resumes: a batch may get the message twice, but nobody in it misses it
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+# blocked the bot by the time the job got to them
+SKIPPED = "skipped"
+
+# failed recipients with these errors go back to pending and the same job sends to them again later
+RETRIED_ERRORS = broadcast_engine.TEMPORARY_ERRORS | {broadcast_engine.RATE_LIMITED}
+# how long a job waiting for retries sleeps at most before checking if it was paused or cancelled
+RETRY_POLL_SECONDS = 30
+
+# jobs currently sent by this process, so pause + resume doesn't start a second runner for the same job
+running_job_ids: set[int] = set()
+
+
+# A broadcast is a pipeline of three stages: the audience resolver yields tg_ids, the renderer turns the payload into a
+# send function and the broadcast engine sends. Resolved tg_ids are stored in chunks and the sender picks them up right
+# away, so sending starts before the whole audience is resolved.
+def create_job(name: str, idempotency_key: str, payload: dict, audience_spec: dict, priority: int,
+               report_chat_id: str = None, expires_at: datetime.datetime = None,
+               deadline_at: datetime.datetime = None, status: str = RUNNING, start_at: datetime.datetime = None,
+               plan_fingerprint: str = None) -> Optional[int]:
+    now = datetime.datetime.utcnow()
+    with Session(models.engine) as session:
+        job_id = session.execute(
+            insert(models.BroadcastJob)
+            .values(name=name, idempotency_key=idempotency_key, payload=payload, audience=audience_spec,
+                    is_audience_resolved=False, priority=priority, status=status, report_chat_id=report_chat_id,
+                    created_at=now, expires_at=expires_at, deadline_at=deadline_at, start_at=start_at,
+                    plan_fingerprint=plan_fingerprint, attempted_count=0, send_duration_seconds=0.0)
+            .on_conflict_do_nothing(constraint='Unique_broadcast_idempotency_key')
+            .returning(models.BroadcastJob.id)
+        ).scalar_one_or_none()
+        session.commit()
+
+    if job_id is None:
+        jobs_logger.warning(f"Broadcast job with key {idempotency_key} already exists, not creating a new one")
+        return None
+    jobs_logger.info(f"Created broadcast job {job_id} for {name} with audience {audience_spec}")
+    return job_id
+
+
+async def store_recipients(job_id: int, tg_ids: list[str]) -> None:
+    # resolving again after a restart must not reset recipients that already got the message
+    async with AsyncSession(models.async_engine) as session:
+        # one cached statement with the rows as parameters, compiling a new multi-row VALUES per chunk would hold the
+        # event loop
+        await session.execute(
+            insert(models.BroadcastRecipient).on_conflict_do_nothing(),
+            [{"job_id": job_id, "tg_id": str(tg_id), "status": PENDING, "attempt_count": 0} for tg_id in tg_ids],
+        )
+        await session.commit()
+
+
+async def mark_audience_resolved(job_id: int) -> None:
+    async with AsyncSession(models.async_engine) as session:
+        await session.execute(
+            update(models.BroadcastJob).where(models.BroadcastJob.id == job_id).values(is_audience_resolved=True))
+        await session.commit()
+
+
+async def resolve_audience(job: models.BroadcastJob, chunk_stored: asyncio.Event) -> None:
+    count = 0
+    try:
+        # closed right away when the job is cancelled, so the cursor doesn't keep its connection
+        async with contextlib.aclosing(audience.resolve(job.audience, settings.BROADCAST_JOB_BATCH_SIZE)) as chunks:
+            async for tg_ids in chunks:
+                await store_recipients(job.id, tg_ids)
+                count += len(tg_ids)
+                chunk_stored.set()
+        await mark_audience_resolved(job.id)
+        jobs_logger.info(f"Resolved audience of {count} users for broadcast job {job.id}")
+    finally:
+        chunk_stored.set()
+
+
+async def resolve_ahead(job_id: int) -> None:
+    await resolve_audience(await asyncio.to_thread(get_job, job_id), asyncio.Event())
+
+
+def replan(job_id: int, payload: dict, plan_fingerprint: str) -> None:
+    # the plan is outdated: nothing was sent yet, so recipients are dropped and resolved again when the job runs
+    with Session(models.engine) as session:
+        session.execute(delete(models.BroadcastRecipient).where(models.BroadcastRecipient.job_id == job_id))
+        session.execute(
+            update(models.BroadcastJob)
+            .where(models.BroadcastJob.id == job_id)
+            .values(payload=payload, plan_fingerprint=plan_fingerprint, is_audience_resolved=False)
+        )
+        session.commit()
+    jobs_logger.info(f"Broadcast job {job_id} was planned with outdated data, it will be resolved again")
+
+
+def get_job(job_id: int) -> Optional[models.BroadcastJob]:
+    with Session(models.engine) as session:
+        return session.get(models.BroadcastJob, job_id)
+
+
+def set_job_status(job_id: int, status: str) -> None:
+    values = {"status": status}
+    if status in (CANCELLED, EXPIRED, DONE):
+        values["finished_at"] = datetime.datetime.utcnow()
+    with Session(models.engine) as session:
+        session.execute(update(models.BroadcastJob).where(models.BroadcastJob.id == job_id).values(**values))
+        session.commit()
+    jobs_logger.info(f"Broadcast job {job_id} is {status} now")
+
+
+def get_recipient_counts(job_id: int) -> dict[str, int]:
+    with Session(models.engine) as session:
+        rows = session.execute(
+            select(models.BroadcastRecipient.status, func.count())
+            .where(models.BroadcastRecipient.job_id == job_id)
+            .group_by(models.BroadcastRecipient.status)
+        ).all()
+    return {status: count for status, count in rows}
+
+
+def get_unfinished_jobs() -> list[models.BroadcastJob]:
+    with Session(models.engine) as session:
+        return session.query(models.BroadcastJob).filter(
+            models.BroadcastJob.status.in_([PLANNED, RUNNING, PAUSED])).order_by(models.BroadcastJob.id).all()
+
+
+def get_planned_jobs() -> list[models.BroadcastJob]:
+    with Session(models.engine) as session:
+        return session.query(models.BroadcastJob).filter(models.BroadcastJob.status == PLANNED).all()
+
+
+async def count_unfinished(job_id: int, expires_at: datetime.datetime = None) -> int:
+    condition = (models.BroadcastRecipient.job_id == job_id) & models.BroadcastRecipient.status.in_([PENDING, SENDING])
+    if expires_at:
+        # a retry scheduled after the job expires never happens
+        condition &= models.BroadcastRecipient.retry_at.is_(None) | (models.BroadcastRecipient.retry_at < expires_at)
+    async with AsyncSession(models.async_engine) as session:
+        return (await session.execute(select(func.count()).where(condition))).scalar_one()
+
+
+async def get_next_retry_at(job_id: int) -> Optional[datetime.datetime]:
+    async with AsyncSession(models.async_engine) as session:
+        return (await session.execute(
+            select(func.min(func.coalesce(models.BroadcastRecipient.retry_at, datetime.datetime.utcnow())))
+            .where((models.BroadcastRecipient.job_id == job_id) & (models.BroadcastRecipient.status == PENDING))
+        )).scalar_one()
+
+
+async def requeue_unconfirmed(job_id: int) -> None:
+    # only called when no runner of this job is sending, so every SENDING recipient was left by a crash or a lost
+    # checkpoint
+    async with AsyncSession(models.async_engine) as session:
+        result = await session.execute(
+            update(models.BroadcastRecipient)
+            .where((models.BroadcastRecipient.job_id == job_id) & (models.BroadcastRecipient.status == SENDING))
+            .values(status=PENDING)
+        )
+        await session.commit()
+    if result.rowcount:
+        jobs_logger.warning(f"Broadcast job {job_id} has {result.rowcount} recipients with unknown delivery status, "
+                            f"sending to them again")
+
+
+async def claim_batch(job_id: int) -> list[sqlalchemy.Row]:
+    # returns (tg_id, status) of claimed recipients, suppressed users are skipped right here
+    async with AsyncSession(models.async_engine) as session:
+        pending = (
+            select(models.BroadcastRecipient.tg_id)
+            .where((models.BroadcastRecipient.job_id == job_id) & (models.BroadcastRecipient.status == PENDING) &
+                   (models.BroadcastRecipient.retry_at.is_(None) |
+                    (models.BroadcastRecipient.retry_at <= datetime.datetime.utcnow())))
+            .limit(settings.BROADCAST_JOB_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            # a locking CTE runs once, as a subquery it's scanned again for every row and the limit is lost
+            .cte("pending")
+        )
+        recipients = (await session.execute(
+            update(models.BroadcastRecipient)
+            .where((models.BroadcastRecipient.job_id == job_id) &
+                   (models.BroadcastRecipient.tg_id.in_(select(pending.c.tg_id))))
+            .values(status=sqlalchemy.case(
+                        (models.BroadcastRecipient.tg_id.in_(delivery_ledger.suppressed_tg_ids_query()), SKIPPED),
+                        else_=SENDING),
+                    attempt_count=models.BroadcastRecipient.attempt_count + 1)
+            .returning(models.BroadcastRecipient.tg_id, models.BroadcastRecipient.status)
+        )).all()
+        await session.commit()
+    return list(recipients)
+
+
+async def checkpoint(job_id: int, result: broadcast_engine.BroadcastResult) -> None:
+    temporary_ids = [tg_id for tg_id, error in result.failures.items()
+                     if error in broadcast_engine.TEMPORARY_ERRORS]
+    rate_limited_ids = [tg_id for tg_id, error in result.failures.items() if error == broadcast_engine.RATE_LIMITED]
+    # the ledger is written in the same transaction, so the retry below reads the schedule it has just set
+    ledger_retry_at = (
+        select(models.DeliveryStatus.next_attempt_at)
+        .where(models.DeliveryStatus.tg_id == models.BroadcastRecipient.tg_id)
+        .scalar_subquery()
+    )
+    async with AsyncSession(models.async_engine) as session:
+        for status, tg_ids in ((SENT, result.success_ids), (FAILED, result.failed_ids)):
+            if tg_ids:
+                await session.execute(
+                    update(models.BroadcastRecipient)
+                    .where((models.BroadcastRecipient.job_id == job_id) & (models.BroadcastRecipient.tg_id.in_(tg_ids)))
+                    .values(status=status)
+                )
+        await session.run_sync(delivery_ledger.write_deliveries, result.success_ids, result.failures)
+        # flood control already paused the whole engine, so these go again as soon as they are claimed
+        for tg_ids, retry_at in ((temporary_ids, ledger_retry_at), (rate_limited_ids, None)):
+            if tg_ids:
+                await session.execute(
+                    update(models.BroadcastRecipient)
+                    .where((models.BroadcastRecipient.job_id == job_id) & models.BroadcastRecipient.tg_id.in_(tg_ids) &
+                           (models.BroadcastRecipient.attempt_count < settings.DELIVERY_MAX_ATTEMPTS))
+                    .values(status=PENDING, retry_at=retry_at)
+                )
+        await session.commit()
+
+
+async def claimed_recipients(job_id: int, resolver: asyncio.Task, chunk_stored: asyncio.Event,
+                             expires_at: datetime.datetime = None) -> AsyncIterator[str]:
+    while True:
+        # status is re-read between batches so pause and cancel from admin commands take effect quickly
+        status = (await asyncio.to_thread(get_job, job_id)).status
+        if status != RUNNING:
+            jobs_logger.info(f"Stopping broadcast job {job_id} because it is {status}")
+            return
+
+        chunk_stored.clear()
+        recipients = await claim_batch(job_id)
+        if recipients:
+            for tg_id, recipient_status in recipients:
+                if recipient_status == SENDING:
+                    yield tg_id
+        elif not resolver.done():
+            await chunk_stored.wait()
+        else:
+            # only recipients waiting for a retry are left
+            retry_at = await get_next_retry_at(job_id)
+            if retry_at is None or (expires_at and retry_at >= expires_at):
+                return
+            delay = (retry_at - datetime.datetime.utcnow()).total_seconds()
+            await asyncio.sleep(min(max(delay, 1), RETRY_POLL_SECONDS))
+
+
+async def record_send_rate(job_id: int, stats: broadcast_engine.BroadcastStats) -> None:
+    async with AsyncSession(models.async_engine) as session:
+        await session.execute(
+            update(models.BroadcastJob)
+            .where(models.BroadcastJob.id == job_id)
+            .values(attempted_count=models.BroadcastJob.attempted_count + stats.count(),
+                    send_duration_seconds=models.BroadcastJob.send_duration_seconds + stats.duration_seconds)
+        )
+        await session.commit()
+
+
+def estimate_send_rate() -> float:
+    # messages per second over the last reminders. Reminders go first in the engine, so other broadcasts don't slow
+    # them down and their rate is what the next reminder will get
+    recent = (
+        select(models.BroadcastJob.attempted_count, models.BroadcastJob.send_duration_seconds)
+        .where((models.BroadcastJob.priority == broadcast_engine.REMINDER_PRIORITY) &
+               (models.BroadcastJob.status == DONE) & (models.BroadcastJob.attempted_count > 0))
+        .order_by(models.BroadcastJob.id.desc())
+        .limit(settings.SEND_RATE_ESTIMATE_JOBS)
+        .subquery()
+    )
+    with Session(models.engine) as session:
+        attempted_count, duration_seconds = session.execute(
+            select(func.sum(recent.c.attempted_count), func.sum(recent.c.send_duration_seconds))).one()
+    if not attempted_count or not duration_seconds:
+        return settings.BROADCAST_MAX_RATE_PER_SECOND
+    return min(attempted_count / duration_seconds, settings.BROADCAST_MAX_RATE_PER_SECOND)
+
+
+def estimate_duration(audience_size: int) -> datetime.timedelta:
+    send_rate = estimate_send_rate()
+    duration = datetime.timedelta(seconds=audience_size / send_rate * settings.REMINDER_DURATION_SAFETY_FACTOR)
+    jobs_logger.info(f"Estimated {duration} to send to {audience_size} users at {send_rate:.1f} msg/s")
+    return duration
+
+
+def report_metrics(job: models.BroadcastJob, stats: broadcast_engine.BroadcastStats) -> None:
+    try:
+        push_monitoring.metrics.set("broadcast_recipients", stats.successful_count, broadcast=job.name, status=SENT)
+        push_monitoring.metrics.set("broadcast_recipients", stats.failed_count, broadcast=job.name, status=FAILED)
+        for error, count in stats.errors.items():
+            push_monitoring.metrics.set("broadcast_recipients", count, broadcast=job.name, status=error)
+        push_monitoring.metrics.set("broadcast_send_rate", stats.send_rate(), broadcast=job.name)
+        push_monitoring.metrics.push()
+    except Exception as e:
+        jobs_logger.warning(f"Couldn't push metrics for broadcast job {job.id}: {e}")
+
+
+async def report(bot: Bot, job: models.BroadcastJob, status: str) -> None:
+    counts = await asyncio.to_thread(get_recipient_counts, job.id)
+    text = (f"Broadcast job #{job.id} {job.name} is {status}: sent to {counts.get(SENT, 0)} users, failed "
+            f"{counts.get(FAILED, 0)} users, skipped {counts.get(SKIPPED, 0)} who blocked the bot, "
+            f"{counts.get(PENDING, 0)} not sent.")
+    jobs_logger.info(text)
+    await bot.send_message(chat_id=job.report_chat_id or settings.ADMIN_CHAT_ID, text=text)
+
+
+def count_late_sends(send: Callable[[str], Awaitable], deadline_at: datetime.datetime,
+                     late_ids: list[str]) -> Callable[[str], Awaitable]:
+    async def send_and_check_deadline(chat_id: str) -> None:
+        await send(chat_id)
+        if datetime.datetime.utcnow() > deadline_at:
+            late_ids.append(chat_id)
+
+    return send_and_check_deadline
+
+
+async def report_missed_deadline(bot: Bot, job: models.BroadcastJob, late_ids: list[str],
+                                 stats: broadcast_engine.BroadcastStats) -> None:
+    text = (f"Broadcast job #{job.id} {job.name} missed the deadline: {len(late_ids)} of {stats.successful_count} "
+            f"messages were delivered after {job.deadline_at:%H:%M} UTC. It took {stats.duration_seconds:.0f}s at "
+            f"{stats.send_rate():.1f} msg/s.")
+    jobs_logger.warning(text)
+    await bot.send_message(chat_id=job.report_chat_id or settings.ADMIN_CHAT_ID, text=text)
+
+
+async def run_job(bot: Bot, job_id: int) -> None:
+    if job_id in running_job_ids:
+        jobs_logger.info(f"Broadcast job {job_id} is already running")
+        return
+
+    running_job_ids.add(job_id)
+    try:
+        job = await asyncio.to_thread(get_job, job_id)
+        if not job or job.status != RUNNING:
+            jobs_logger.info(f"Not running broadcast job {job_id}: {job}")
+            return
+        if job.expires_at and job.expires_at < datetime.datetime.utcnow():
+            await asyncio.to_thread(set_job_status, job_id, EXPIRED)
+            await report(bot, job, EXPIRED)
+            return
+
+        chunk_stored = asyncio.Event()
+        if job.is_audience_resolved:
+            resolver = asyncio.create_task(asyncio.sleep(0))
+        else:
+            resolver = asyncio.create_task(resolve_audience(job, chunk_stored))
+        # wakes up the sender waiting for a chunk when there is nothing left to resolve
+        resolver.add_done_callback(lambda _: chunk_stored.set())
+
+        send = rendering.make_send(bot, job.payload)
+        late_ids = []
+        if job.deadline_at:
+            send = count_late_sends(send, job.deadline_at, late_ids)
+
+        try:
+            while True:
+                await requeue_unconfirmed(job_id)
+                stats = await broadcast_engine.send_to_all(
+                    claimed_recipients(job_id, resolver, chunk_stored, job.expires_at),
+                    send,
+                    job.name,
+                    checkpoint=lambda result: checkpoint(job_id, result),
+                    priority=job.priority,
+                )
+                await record_send_rate(job_id, stats)
+                report_metrics(job, stats)
+
+                status = (await asyncio.to_thread(get_job, job_id)).status
+                is_resolver_failed = resolver.done() and not resolver.cancelled() and resolver.exception()
+                is_finished = resolver.done() and not await count_unfinished(job_id, job.expires_at)
+                if status != RUNNING or is_resolver_failed or is_finished:
+                    break
+                # Failed sends of the last batch were put back for a retry, or the job was paused and resumed while
+                # this runner was still finishing its sends: the resumed run_job returned right away because this one
+                # was running, so this one goes on with the rest
+                jobs_logger.info(f"Broadcast job {job_id} still has recipients to send to, continuing")
+        finally:
+            if not resolver.done():
+                resolver.cancel()
+        if late_ids:
+            await report_missed_deadline(bot, job, late_ids, stats)
+
+        if status == RUNNING and not resolver.cancelled() and resolver.exception():
+            jobs_logger.error(f"Couldn't resolve audience for broadcast job {job_id}", exc_info=resolver.exception())
+            await asyncio.to_thread(set_job_status, job_id, PAUSED)
+            await bot.send_message(
+                chat_id=job.report_chat_id or settings.ADMIN_CHAT_ID,
+                text=f"Couldn't resolve audience for broadcast job #{job_id} {job.name}, paused it: "
+                     f"{resolver.exception()}"
+            )
+        elif status == RUNNING:
+            await asyncio.to_thread(set_job_status, job_id, DONE)
+            await report(bot, job, DONE)
+        elif status == CANCELLED:
+            await report(bot, job, CANCELLED)
+    finally:
+        running_job_ids.discard(job_id)
+
+
+async def resume_unfinished_jobs(app) -> None:
+    for job in get_unfinished_jobs():
+        if job.status == RUNNING:
+            jobs_logger.info(f"Resuming broadcast job {job.id} {job.name} after restart")
+            app.create_task(run_job(app.bot, job.id), name=f"broadcast_job_{job.id}")
+        else:
+            jobs_logger.info(f"Broadcast job {job.id} {job.name} is {job.status}, not resuming")
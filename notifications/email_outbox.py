@@ -0,0 +1,194 @@
+import asyncio
+import datetime
+import itertools
+import logging
+from collections import defaultdict
+from typing import Optional
+
+import sqlalchemy
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+import models
+import settings
+from . import email_sender
+
+outbox_logger = logging.getLogger(__name__)
+outbox_logger.setLevel(logging.DEBUG)
+
+# Notifications only put emails into the EmailOutbox table, the worker started in post_init sends them in the
+# background. SMTP being slow or down doesn't hold back Telegram broadcasts, and nothing is lost on a restart.
+
+# email statuses
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+# failed EMAIL_OUTBOX_MAX_ATTEMPTS times, not retried anymore
+DEAD = "dead"
+# wasn't sent before expires_at
+EXPIRED = "expired"
+
+# rows per insert statement
+CHUNK_SIZE = 1000
+
+_wake_up = asyncio.Event()
+_worker: Optional[asyncio.Task] = None
+
+
+def enqueue(recipients: list[str], subject: str, body: str, job_id: Optional[int] = None,
+            expires_at: Optional[datetime.datetime] = None) -> None:
+    now = datetime.datetime.utcnow()
+    with Session(models.engine) as session:
+        for chunk in itertools.batched(recipients, CHUNK_SIZE):
+            session.execute(
+                insert(models.EmailOutbox)
+                .values([{"job_id": job_id, "recipient": recipient, "subject": subject, "body": body,
+                          "status": PENDING, "attempts": 0, "created_at": now, "next_attempt_at": now,
+                          "expires_at": expires_at} for recipient in chunk])
+                .on_conflict_do_nothing()
+            )
+        session.commit()
+    outbox_logger.info(f"Enqueued '{subject}' for {len(recipients)} emails")
+    _wake_up.set()
+
+
+def give_up_on_unconfirmed() -> None:
+    # emails that were being sent when the bot stopped may have been delivered, don't send them twice
+    with Session(models.engine) as session:
+        result = session.execute(
+            update(models.EmailOutbox)
+            .where(models.EmailOutbox.status == SENDING)
+            .values(status=DEAD, last_error="unknown delivery status after restart")
+        )
+        session.commit()
+    if result.rowcount:
+        outbox_logger.warning(f"{result.rowcount} emails have unknown delivery status, not sending them again")
+
+
+def expire() -> None:
+    with Session(models.engine) as session:
+        result = session.execute(
+            update(models.EmailOutbox)
+            .where((models.EmailOutbox.status == PENDING) &
+                   (models.EmailOutbox.expires_at < datetime.datetime.utcnow()))
+            .values(status=EXPIRED)
+        )
+        session.commit()
+    if result.rowcount:
+        outbox_logger.warning(f"{result.rowcount} emails expired before they were sent")
+
+
+def claim_batch() -> list[sqlalchemy.Row]:
+    with Session(models.engine) as session:
+        due = (
+            select(models.EmailOutbox.id)
+            .where((models.EmailOutbox.status == PENDING) &
+                   (models.EmailOutbox.next_attempt_at <= datetime.datetime.utcnow()))
+            .order_by(models.EmailOutbox.next_attempt_at)
+            .limit(settings.EMAIL_OUTBOX_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+            # a locking CTE runs once, as a subquery it's scanned again for every row and the limit is lost
+            .cte("due")
+        )
+        emails = session.execute(
+            update(models.EmailOutbox)
+            .where(models.EmailOutbox.id.in_(select(due.c.id)))
+            .values(status=SENDING, attempts=models.EmailOutbox.attempts + 1)
+            .returning(models.EmailOutbox.id, models.EmailOutbox.recipient, models.EmailOutbox.subject,
+                       models.EmailOutbox.body)
+        ).all()
+        session.commit()
+    return list(emails)
+
+
+def record(ids_by_recipient: dict[str, list[int]], result: email_sender.EmailResult) -> None:
+    now = datetime.datetime.utcnow()
+    failed_ids_by_error = defaultdict(list)
+    for recipient, error in result.failures.items():
+        failed_ids_by_error[error].extend(ids_by_recipient[recipient])
+
+    # a failed email is retried after an exponentially growing delay until it runs out of attempts
+    retry_delay_seconds = settings.EMAIL_OUTBOX_RETRY_BASE_SECONDS * func.power(
+        2, func.least(models.EmailOutbox.attempts - 1, 20))
+    with Session(models.engine) as session:
+        sent_ids = [email_id for recipient in result.sent for email_id in ids_by_recipient[recipient]]
+        if sent_ids:
+            session.execute(
+                update(models.EmailOutbox)
+                .where(models.EmailOutbox.id.in_(sent_ids))
+                .values(status=SENT, sent_at=now, last_error=None)
+            )
+        for error, ids in failed_ids_by_error.items():
+            session.execute(
+                update(models.EmailOutbox)
+                .where(models.EmailOutbox.id.in_(ids))
+                .values(
+                    status=sqlalchemy.case(
+                        (models.EmailOutbox.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS, DEAD), else_=PENDING),
+                    last_error=error,
+                    next_attempt_at=sqlalchemy.literal(now) + func.make_interval(
+                        0, 0, 0, 0, 0, 0, retry_delay_seconds),
+                )
+            )
+        session.commit()
+
+
+async def send_batch(emails: list[sqlalchemy.Row]) -> None:
+    # The same notification goes to many recipients, those are sent together in Bcc chunks. An address that has the
+    # same email queued more than once (by two jobs, or enqueued again) gets it once, and all its rows are recorded
+    by_message = defaultdict(lambda: defaultdict(list))
+    for email in emails:
+        by_message[(email.subject, email.body)][email.recipient].append(email.id)
+
+    async def send(subject: str, body: str, ids_by_recipient: dict[str, list[int]]) -> None:
+        # retries are scheduled through the outbox, so a failing chunk doesn't hold back the batch
+        result = await email_sender.send_in_chunks(subject, body, list(ids_by_recipient), max_attempts=1)
+        await asyncio.to_thread(record, ids_by_recipient, result)
+
+    await asyncio.gather(*[send(subject, body, ids_by_recipient)
+                           for (subject, body), ids_by_recipient in by_message.items()])
+
+
+async def drain() -> None:
+    # the outbox queries run in a thread, so a long drain doesn't hold Telegram updates and broadcasts
+    await asyncio.to_thread(expire)
+    while emails := await asyncio.to_thread(claim_batch):
+        outbox_logger.info(f"Sending {len(emails)} emails from the outbox")
+        await send_batch(emails)
+
+
+async def run_worker() -> None:
+    await asyncio.to_thread(give_up_on_unconfirmed)
+    while True:
+        _wake_up.clear()
+        try:
+            await drain()
+        except Exception as e:
+            outbox_logger.error(f"Failed to drain the email outbox: {e}")
+        # new emails wake the worker up right away, the timeout picks up retries that became due
+        try:
+            await asyncio.wait_for(_wake_up.wait(), timeout=settings.EMAIL_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_worker() -> None:
+    global _worker
+    _worker = asyncio.create_task(run_worker())
+
+
+async def stop_worker() -> None:
+    if _worker is None:
+        return
+    _worker.cancel()
+    try:
+        await _worker
+    except asyncio.CancelledError:
+        pass
+
+
+def get_status_counts() -> dict[str, int]:
+    with Session(models.engine) as session:
+        return dict(session.execute(
+            select(models.EmailOutbox.status, func.count()).group_by(models.EmailOutbox.status)).all())
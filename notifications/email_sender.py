@@ -0,0 +1,120 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import random
+from dataclasses import dataclass, field
+from email.message import EmailMessage
+from typing import AsyncIterator
+
+import aiosmtplib
+
+import settings
+
+email_logger = logging.getLogger(__name__)
+email_logger.setLevel(logging.DEBUG)
+
+
+class SmtpPool:
+    # Connections are opened lazily and reused across messages and notifications: STARTTLS and login cost a few
+    # round trips each, more than sending a message over an open connection
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: list[aiosmtplib.SMTP] = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(
+            hostname=settings.SMTP_HOST,
+            port=int(settings.SMTP_PORT),
+            username=settings.SMTP_USERNAME,
+            password=settings.SMTP_PASSWORD,
+            start_tls=True,
+            timeout=settings.EMAIL_TIMEOUT_SECONDS,
+        )
+        await smtp.connect()
+        return smtp
+
+    @contextlib.asynccontextmanager
+    async def connection(self) -> AsyncIterator[aiosmtplib.SMTP]:
+        async with self._slots:
+            smtp = self._idle.pop() if self._idle else None
+            if smtp is None or not smtp.is_connected:
+                smtp = await self._connect()
+            try:
+                yield smtp
+            except Exception:
+                # the connection may be in a broken state, don't give it to the next sender
+                smtp.close()
+                raise
+            self._idle.append(smtp)
+
+    async def close(self) -> None:
+        while self._idle:
+            smtp = self._idle.pop()
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+
+pool = SmtpPool(settings.EMAIL_POOL_SIZE)
+
+
+@dataclass
+class EmailResult:
+    sent: list[str] = field(default_factory=list)
+    # recipient -> error
+    failures: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def failed(self) -> list[str]:
+        return list(self.failures)
+
+
+def make_message(subject: str, body: str, recipients: tuple[str, ...]) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = settings.EMAIL_FROM
+    message["To"] = settings.EMAIL_FROM
+    message["Subject"] = subject
+    message.set_content(body)
+    message["Bcc"] = ", ".join(recipients)
+    return message
+
+
+async def send_chunk(subject: str, body: str, recipients: tuple[str, ...],
+                     max_attempts: int = settings.EMAIL_MAX_ATTEMPTS) -> dict[str, str]:
+    # returns errors for recipients that didn't get the message, empty if all of them did
+    error = None
+    for attempt in range(max_attempts):
+        if attempt:
+            delay = random.uniform(0, settings.EMAIL_RETRY_BASE_SECONDS * 2 ** attempt)
+            email_logger.warning(f"Couldn't send email to {len(recipients)} recipients (attempt {attempt}), "
+                                 f"retrying in {delay:.1f}s: {error}")
+            await asyncio.sleep(delay)
+        try:
+            async with pool.connection() as smtp:
+                refused, _ = await smtp.send_message(make_message(subject, body, recipients))
+            # the server may accept the message for some recipients and refuse it for others
+            return {recipient: str(response) for recipient, response in refused.items()}
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            return {refused.recipient: str(refused) for refused in e.recipients}
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+            error = f"{type(e).__name__}: {e}"
+    return {recipient: error for recipient in recipients}
+
+
+async def send_in_chunks(subject: str, body: str, recipients: list[str],
+                         max_attempts: int = settings.EMAIL_MAX_ATTEMPTS) -> EmailResult:
+    # Every chunk is one message with its recipients in Bcc, retried on its own. Chunks go through the pool in
+    # parallel, so one slow chunk doesn't hold back the rest
+    result = EmailResult()
+
+    async def send(chunk: tuple[str, ...]) -> None:
+        failures = await send_chunk(subject, body, chunk, max_attempts)
+        result.sent.extend(recipient for recipient in chunk if recipient not in failures)
+        result.failures.update(failures)
+
+    await asyncio.gather(*[send(chunk) for chunk in itertools.batched(recipients, settings.EMAIL_BCC_CHUNK_SIZE)])
+    email_logger.info(f"Sent '{subject}' to {len(result.sent)} emails, failed {len(result.failures)}")
+    return result
@@ -1,10 +1,9 @@
 import datetime
+import hashlib
 import logging
 import os
-from dotenv import load_dotenv
 from zoneinfo import ZoneInfo
 
-from sqlalchemy import select
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import NoResultFound
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
@@ -13,10 +12,10 @@ from telegram.ext import ContextTypes
 import constants
 from courses import course_helpers
 import models
-from models import Enrollment, ScheduledPartMessages, engine
+from models import ScheduledPartMessages, engine
 from membership import membership
 import settings
-from . import notifications_helpers
+from . import audience, broadcast_engine, broadcast_jobs, notifications_helpers, rendering
 
 notifications_logger = logging.getLogger(__name__)
 notifications_logger.setLevel(logging.DEBUG)
@@ -43,62 +42,18 @@ async def handle_leetcode_reminder(context: ContextTypes.DEFAULT_TYPE):
 
     message: str = context.job.data["message"]
     menu: InlineKeyboardMarkup = context.job.data["menu"] if "menu" in context.job.data else None
-    with Session(engine) as session:
-        subquery = (
-            select(models.MockSignUp.tg_id)
-            .where(models.MockSignUp.week_number == datetime.date.today().isocalendar().week)
-        )
-
-        result = (
-            session.query(Enrollment.tg_id)
-            .filter(Enrollment.course_id == course_id)
-            .filter(~Enrollment.tg_id.in_(subquery))
-            .all()
-        )
+    notifications_logger.debug(f"handling {course_helpers.get_course_name(course_id)} notification for users "
+                               f"enrolled to Leetcode and not signed for this week")
 
-    notification_chat_ids = [item[0] for item in result]
-    notifications_logger.debug(f"handling {course_helpers.get_course_name(course_id)} notification, "
-                               f"got {len(notification_chat_ids)} chat ids that are enrolled to Leetcode and not signed "
-                               f"for this week")
-
-    await notifications_helpers.do_send_notifications(context, notification_chat_ids, message, menu,
+    audience_spec = {"kind": "course_without_mock_sign_up", "course_id": course_id}
+    await notifications_helpers.do_send_notifications(context, audience_spec, message, menu,
                                                       course_helpers.get_course_name(course_id))
 
 
-async def handle_send_zoom(context: ContextTypes.DEFAULT_TYPE):
-    course_id: int = context.job.data["course_id"]
-    is_zoom_link_only_to_pro: bool = context.job.data["is_zoom_link_only_to_pro"]
-
-    if "message" not in context.job.data:
-        admin_chat_id = int(os.getenv('ADMIN_CHAT_ID'))
-        notifications_logger.error(
-            f"Can't handle notification, there's no message in context.job.data: {context.job.data}")
-        await context.bot.send_message(
-            chat_id=admin_chat_id,
-            text=f"Can't handle notification, there's no message in context.job.data: {context.job.data}"
-        )
-        return
-
-    message: str = context.job.data["message"]
-    menu: InlineKeyboardMarkup = context.job.data["menu"] if "menu" in context.job.data else None
-    with Session(engine) as session:
-        result = session.query(Enrollment.tg_id).filter(Enrollment.course_id == course_id).all()
-        notification_chat_ids = [item[0] for item in result]
-    course_name = course_helpers.get_course_name(course_id)
-    notifications_logger.debug(f"handling {course_name} notification, got {len(notification_chat_ids)} chat ids that "
-                               f"are subscribed to the course")
-
+def get_zoom_audience_spec(course_id: int, is_zoom_link_only_to_pro: bool) -> dict:
     if is_zoom_link_only_to_pro:
-        notification_chat_ids = [tg_id for tg_id in notification_chat_ids
-                                 if membership.get_user_membership_info(tg_id).get_overall_level() == membership.pro]
-        notifications_logger.debug(f"handling {course_name} notification, got {len(notification_chat_ids)} PRO "
-                                   f"subscribers")
-    else:
-        notifications_logger.debug(f"Sending a link to everyone because is_zoom_link_only_to_pro for {course_id} is "
-                                   f"False")
-
-    await notifications_helpers.do_send_notifications(context, notification_chat_ids, message, menu, course_name)
-    await notifications_helpers.email_notifications(context, notification_chat_ids, message, menu, course_name)
+        return {"kind": "course", "course_id": course_id, "level": membership.pro.number}
+    return {"kind": "course", "course_id": course_id}
 
 
 async def handle_aoc_notification(context: ContextTypes.DEFAULT_TYPE):
@@ -117,37 +72,151 @@ async def handle_aoc_notification(context: ContextTypes.DEFAULT_TYPE):
         notifications_logger.info("AoC notification is turned off, skipping sending notifications")
 
 
-async def get_zoom_link_and_send_for_course(context: ContextTypes.DEFAULT_TYPE):
-    course_id: int = context.job.data["course_id"]
-    course_name: str = course_helpers.get_course_name(course_id)
+def get_zoom_link(course_id: int) -> str:
     current_week: int = datetime.date.today().isocalendar().week
-    with (Session(engine) as session):
-        try:
-            call_link = session.query(ScheduledPartMessages.text) \
-                .filter(
-                    (ScheduledPartMessages.course_id == course_id) &
-                    (ScheduledPartMessages.week_number == current_week)) \
-                .one()[0]
-        except NoResultFound as e:
-            load_dotenv(override=True)
-            admin_chat_id = int(os.getenv('ADMIN_CHAT_ID'))
-            notifications_logger.debug(f"reloaded admin chat id: {admin_chat_id}")
+    with Session(engine) as session:
+        return session.query(ScheduledPartMessages.text) \
+            .filter(
+                (ScheduledPartMessages.course_id == course_id) &
+                (ScheduledPartMessages.week_number == current_week)) \
+            .one()[0]
 
-            await context.bot.send_message(
-                chat_id=admin_chat_id,
-                text=f"Zoom link for {course_name} not found for today!"
-            )
-            notifications_logger.error(f'Zoom link for {course_name} not found for today!', exc_info=e)
-            return
 
-        notifications_logger.info(f'call_link is {call_link}')
+def get_zoom_link_or_empty(course_id: int) -> str:
+    try:
+        return get_zoom_link(course_id)
+    except NoResultFound:
+        return ""
 
+
+def render_zoom_reminder(course_name: str, call_link: str, minutes_left: int) -> str:
+    reminder = constants.before_call_reminder.format(course_name)
+    if minutes_left > 5:
+        reminder = constants.before_call_reminder_in_minutes.format(course_name, minutes_left)
     if call_link:
-        context.job.data["message"] = \
-            f"{constants.before_call_reminder.format(course_name)}\n\n{call_link}"
-    else:
-        context.job.data["message"] = constants.before_call_reminder.format(course_name)
-    await handle_send_zoom(context)
+        return f"{reminder}\n\n{call_link}"
+    return reminder
+
+
+def render_zoom_reminder_subject(name: str, minutes_left: int) -> str:
+    # says the same as the reminder text
+    if minutes_left > 5:
+        return f"Звонок {name} через {minutes_left} мин!"
+    return f"Звонок {name} через 5 минут!"
+
+
+def get_reminder_course_ids(audience_spec: dict) -> list[int]:
+    # a digest goes to users enrolled in all of the "include" courses
+    if audience_spec["kind"] == "combination":
+        return [spec["course_id"] for spec in audience_spec["include"]]
+    return [audience_spec["course_id"]]
+
+
+def render_zoom_reminders(course_ids: list[int], minutes_left: int) -> str:
+    return "\n\n".join(
+        render_zoom_reminder(course_helpers.get_course_name(course_id), get_zoom_link_or_empty(course_id), minutes_left)
+        for course_id in course_ids)
+
+
+def get_zoom_plan_fingerprint(audience_spec: dict) -> str:
+    links = "\n".join(get_zoom_link_or_empty(course_id) for course_id in get_reminder_course_ids(audience_spec))
+    return f"{audience.fingerprint(audience_spec)}:{hashlib.md5(links.encode()).hexdigest()}"
+
+
+def to_utc(moment: datetime.datetime) -> datetime.datetime:
+    # broadcast jobs keep time in UTC
+    return moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def split_overlapping_audiences(audience_specs: dict[int, dict]) -> list[dict]:
+    # A user enrolled in several courses at the same hour gets one digest instead of a message per course: every
+    # group of courses that shares users gets its own job, and these users are excluded from single-course jobs
+    overlaps = audience.find_overlaps(audience_specs)
+    if not overlaps:
+        return list(audience_specs.values())
+
+    notifications_logger.info(f"Courses {overlaps} have common users, they will get a digest")
+    split_specs = []
+    for course_ids in [(course_id,) for course_id in audience_specs] + overlaps:
+        split_specs.append({
+            "kind": "combination",
+            "include": [audience_specs[course_id] for course_id in course_ids],
+            "exclude": [spec for course_id, spec in audience_specs.items() if course_id not in course_ids],
+        })
+    return split_specs
+
+
+async def plan_zoom_reminder(context: ContextTypes.DEFAULT_TYPE, audience_spec: dict, call_at: datetime.datetime,
+                             deadline_at: datetime.datetime, start_at: datetime.datetime) -> None:
+    course_ids = get_reminder_course_ids(audience_spec)
+    name = " + ".join(course_helpers.get_course_name(course_id) for course_id in course_ids)
+    message = render_zoom_reminders(course_ids, round((call_at - start_at).total_seconds() / 60))
+    job_id = broadcast_jobs.create_job(
+        name=name,
+        idempotency_key=f"zoom_reminder:{'+'.join(map(str, course_ids))}:{call_at:%Y-%m-%d %H}",
+        payload=rendering.text_payload(message, parse_mode="HTML"),
+        audience_spec=audience_spec,
+        priority=broadcast_engine.REMINDER_PRIORITY,
+        report_chat_id=str(settings.ADMIN_CHAT_ID),
+        # the reminder is useless after the call has started
+        expires_at=to_utc(call_at),
+        deadline_at=to_utc(deadline_at),
+        status=broadcast_jobs.PLANNED,
+        start_at=to_utc(start_at),
+        plan_fingerprint=get_zoom_plan_fingerprint(audience_spec),
+    )
+    if job_id is None:
+        notifications_logger.info(f"Zoom reminder for {name} at {call_at} is already planned")
+        return
+
+    await broadcast_jobs.resolve_ahead(job_id)
+    notifications_logger.info(f"Zoom reminder for {name} will start at {start_at:%H:%M:%S} to finish before "
+                              f"{deadline_at:%H:%M}")
+    schedule_zoom_reminder(context.job_queue, job_id, start_at)
+
+
+def schedule_zoom_reminder(job_queue, job_id: int, start_at: datetime.datetime) -> None:
+    job_queue.run_once(
+        callback=send_zoom_reminder,
+        # a start time in the past (after a restart) means the reminder should go right away
+        when=max(start_at, datetime.datetime.now(datetime.timezone.utc)),
+        name=f"zoom_reminder_{job_id}",
+        data={"job_id": job_id},
+    )
+
+
+async def send_zoom_reminder(context: ContextTypes.DEFAULT_TYPE):
+    job_id: int = context.job.data["job_id"]
+    job = broadcast_jobs.get_job(job_id)
+    if not job or job.status != broadcast_jobs.PLANNED:
+        notifications_logger.info(f"Not sending Zoom reminder job {job_id}, it's not planned anymore: {job}")
+        return
+
+    # Everything was resolved and rendered by the plan. Only check that nobody enrolled, got or lost Pro and the link
+    # didn't change since then: one digest query instead of resolving the audience again
+    fingerprint = get_zoom_plan_fingerprint(job.audience)
+    course_ids = get_reminder_course_ids(job.audience)
+    # planned reminders expire when the call starts
+    minutes_left = round((job.expires_at - datetime.datetime.utcnow()).total_seconds() / 60)
+    if fingerprint != job.plan_fingerprint:
+        message = render_zoom_reminders(course_ids, minutes_left)
+        broadcast_jobs.replan(job_id, rendering.text_payload(message, parse_mode="HTML"), fingerprint)
+
+    broadcast_jobs.set_job_status(job_id, broadcast_jobs.RUNNING)
+    # Emails are only queued here, the outbox worker sends them in parallel with the Telegram fan-out. Their subject and
+    # text count the minutes from now, not from when the plan was made
+    await notifications_helpers.email_notifications(context, job_id,
+                                                    render_zoom_reminder_subject(job.name, minutes_left),
+                                                    render_zoom_reminders(course_ids, minutes_left), None, job.name)
+    await broadcast_jobs.run_job(context.bot, job_id)
+
+
+async def reschedule_planned_zoom_reminders(app) -> None:
+    # job queue lives in memory, planned reminders are scheduled again after a restart
+    for job in broadcast_jobs.get_planned_jobs():
+        start_at = job.start_at.replace(tzinfo=datetime.timezone.utc)
+        notifications_logger.info(f"Rescheduling planned Zoom reminder {job.id} {job.name} at {start_at}")
+        schedule_zoom_reminder(app.job_queue, job.id, start_at)
 
 
 async def prompt_to_connect_patreon_notifications(context: ContextTypes.DEFAULT_TYPE):
@@ -173,20 +242,12 @@ async def prompt_to_connect_patreon_notifications(context: ContextTypes.DEFAULT_
                               callback_data=f"unenroll:{course_id}")],
     ])
 
-    with Session(engine) as session:
-        result = session.query(Enrollment.tg_id).filter(Enrollment.course_id == course_id).all()
-        notification_chat_ids = [item[0] for item in result]
-    notifications_logger.info(f"handling Patreon prompt for {course_name}, got "
-                              f"{len(notification_chat_ids)} chat ids that are subscribed to the course")
-
     # only Basic subscribers will get a prompt to subscribe to Patreon
-    notification_chat_ids = [tg_id for tg_id in notification_chat_ids
-                             if membership.get_user_membership_info(tg_id).get_overall_level() == membership.basic]
-    notifications_logger.info(f"handling Patreon prompt for {course_name}, got "
-                              f"{len(notification_chat_ids)} Basic subscribers to {course_name}")
-
-    await notifications_helpers.do_send_notifications(context, notification_chat_ids, message, menu,
-                                                      f"{course_name} Patreon prompt")
+    audience_spec = {"kind": "course", "course_id": course_id, "level": membership.basic.number}
+    # the prompt is sent in the morning, it can wait for reminders
+    await notifications_helpers.do_send_notifications(context, audience_spec, message, menu,
+                                                      f"{course_name} Patreon prompt",
+                                                      priority=broadcast_engine.COURSE_PRIORITY)
 
 # no matter winter or summer time in Europe.
 # In theory should work without restart when the time changes
@@ -240,15 +301,40 @@ def get_active_courses_today(hour: int = None) -> list[tuple[models.Course, mode
     return active_courses_with_notification_today
 
 
-async def get_active_courses_and_send_zoom(context: ContextTypes.DEFAULT_TYPE):
-    notifications_logger.info(f"triggered get_active_courses_and_send_zoom")
+async def plan_zoom_reminders_for_active_courses(context: ContextTypes.DEFAULT_TYPE):
+    notifications_logger.info(f"triggered plan_zoom_reminders_for_active_courses")
 
-    active_courses_today: list[tuple[models.Course, models.CourseNotification]] = (
-        get_active_courses_today(context.job.data["hour"]))
+    hour: int = context.job.data["hour"]
+    call_at = datetime.datetime.combine(datetime.datetime.now(berlin_tz).date(), datetime.time(hour=hour),
+                                        tzinfo=berlin_tz)
+    audience_specs: dict[int, dict] = {}
+    active_courses_today: list[tuple[models.Course, models.CourseNotification]] = get_active_courses_today(hour)
     for course, notification in active_courses_today:
-        context.job.data["course_id"] = course.id
-        context.job.data["is_zoom_link_only_to_pro"] = notification.is_zoom_link_only_to_pro
-        await get_zoom_link_and_send_for_course(context)
+        try:
+            call_link = get_zoom_link(course.id)
+        except NoResultFound as e:
+            await context.bot.send_message(
+                chat_id=settings.ADMIN_CHAT_ID,
+                text=f"Zoom link for {course.name} not found for today!"
+            )
+            notifications_logger.error(f'Zoom link for {course.name} not found for today!', exc_info=e)
+            continue
+        notifications_logger.info(f'call_link for {course.name} is {call_link}')
+        audience_specs[course.id] = get_zoom_audience_spec(course.id, notification.is_zoom_link_only_to_pro)
+    if not audience_specs:
+        return
+
+    split_specs = split_overlapping_audiences(audience_specs)
+
+    # all reminders of the hour share the rate limit, so they start together early enough for all of them
+    audience_size = sum(audience.count(spec) for spec in split_specs)
+    deadline_at = call_at - datetime.timedelta(minutes=settings.REMINDER_DEADLINE_MINUTES_BEFORE_CALL)
+    start_at = min(call_at - datetime.timedelta(minutes=settings.REMINDER_LEAD_MINUTES),
+                   deadline_at - broadcast_jobs.estimate_duration(audience_size))
+    start_at = max(start_at, datetime.datetime.now(berlin_tz))
+
+    for spec in split_specs:
+        await plan_zoom_reminder(context, spec, call_at, deadline_at, start_at)
 
 
 async def get_active_courses_and_prompt_to_get_pro(context: ContextTypes.DEFAULT_TYPE):
@@ -263,26 +349,23 @@ async def get_active_courses_and_prompt_to_get_pro(context: ContextTypes.DEFAULT
             notifications_logger.info(f"skipping patreon prompt for {course} since send_patreon_reminder is False")
 
 
-# every day the job checks for active courses with today's day of the week
-# and send a notification at 17:53 Berlin time.
-# No need to restart when changing the set of active courses
+# every day the job checks for active courses with today's day of the week and calls at 18:00 and 19:00 Berlin time.
+# It runs REMINDER_PLANNING_MINUTES_BEFORE_CALL before the call, resolves audiences and Zoom links, renders reminders
+# and schedules each one so that it finishes in time, usually at 17:53 and 18:53. No need to restart when changing
+# the set of active courses
 async def register_daily_send_zoom_for_active_courses(app):
-    app.job_queue.run_daily(
-        callback=get_active_courses_and_send_zoom,
-        time=datetime.time(hour=17, minute=53, tzinfo=berlin_tz),
-        name=f"get_active_courses_and_send_zoom_1753",
-        data={
-            "hour": 18,
-        }
-    )
-    app.job_queue.run_daily(
-        callback=get_active_courses_and_send_zoom,
-        time=datetime.time(hour=18, minute=53, tzinfo=berlin_tz),
-        name=f"get_active_courses_and_send_zoom_1853",
-        data={
-            "hour": 19,
-        }
-    )
+    await reschedule_planned_zoom_reminders(app)
+    for hour in (18, 19):
+        plan_at = (datetime.datetime.combine(datetime.date.today(), datetime.time(hour=hour))
+                   - datetime.timedelta(minutes=settings.REMINDER_PLANNING_MINUTES_BEFORE_CALL))
+        app.job_queue.run_daily(
+            callback=plan_zoom_reminders_for_active_courses,
+            time=plan_at.time().replace(tzinfo=berlin_tz),
+            name=f"plan_zoom_reminders_for_active_courses_{plan_at:%H%M}",
+            data={
+                "hour": hour,
+            }
+        )
 
 
 # every morning the job checks for active courses with today's day of the week
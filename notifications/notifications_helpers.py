@@ -1,84 +1,67 @@
+import datetime
 import logging
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
-import aiosmtplib
-from email.message import EmailMessage
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from telegram import InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 import models
-from monitoring import update_users_in_db
 import settings
+from . import audience, broadcast_engine, broadcast_jobs, email_outbox, rendering
 
 notifications_logger = logging.getLogger(__name__)
 notifications_logger.setLevel(logging.DEBUG)
 
 
-async def do_send_notifications(context: ContextTypes.DEFAULT_TYPE, notification_chat_ids: list[str], message: str,
-                                menu: InlineKeyboardMarkup, notification_name: str) -> None:
-    successful_count = 0
-    failed_ids = []
-    for chat_id in notification_chat_ids:
-        if (successful_count + len(failed_ids)) % 50 == 0:
-            notifications_logger.info(f"Notification broadcast in progress: {successful_count} successful, "
-                                      f"{len(failed_ids)} failed so far")
-        try:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=message,
-                parse_mode="HTML",
-                reply_markup=menu)
-            successful_count += 1
-        except Exception as e:
-            failed_ids.append(chat_id)
-
-    notifications_logger.info(f"Successfully sent {notification_name} notification to {successful_count} users, "
-                              f"failed {len(failed_ids)} users.")
-
-    success_ids = list(set(notification_chat_ids) - set(failed_ids))
-    await update_users_in_db.update_users_after_broadcast(success_ids, failed_ids)
-
+async def do_send_notifications(context: ContextTypes.DEFAULT_TYPE, audience_spec: dict, message: str,
+                                menu: InlineKeyboardMarkup, notification_name: str,
+                                priority: int = broadcast_engine.REMINDER_PRIORITY,
+                                deadline_at: datetime.datetime = None) -> Optional[int]:
     load_dotenv(override=True)
     admin_chat_id = int(os.getenv('ADMIN_CHAT_ID'))
     notifications_logger.debug(f"reloaded admin chat id: {admin_chat_id}")
 
-    await context.bot.send_message(
-        chat_id=admin_chat_id,
-        text=f"Successfully sent {notification_name} notifications to {successful_count} users, "
-             f"failed {len(failed_ids)} users."
+    now = datetime.datetime.now()
+    job_id = broadcast_jobs.create_job(
+        name=notification_name,
+        # the same notification can't be sent twice within an hour, even if the job queue triggers it again
+        idempotency_key=f"notification:{notification_name}:{now:%Y-%m-%d %H}",
+        payload=rendering.text_payload(message, menu, parse_mode="HTML"),
+        audience_spec=audience_spec,
+        priority=priority,
+        report_chat_id=str(admin_chat_id),
+        expires_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=settings.NOTIFICATION_JOB_TTL_MINUTES),
+        deadline_at=deadline_at,
     )
+    if job_id is None:
+        await context.bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"{notification_name} notification was already sent this hour, not sending it again."
+        )
+        return None
 
+    await broadcast_jobs.run_job(context.bot, job_id)
+    return job_id
 
-async def send_emails(subject: str, body: str, recipients: list[str]) -> None:
-    notifications_logger.info(f"triggered send_emails for {', '.join(recipients)}")
-    message = EmailMessage()
-    message["From"] = settings.EMAIL_FROM
-    message["To"] = settings.EMAIL_FROM
-    message["Subject"] = subject
-    message.set_content(body)
-
-    message["Bcc"] = ", ".join(recipients)
-
-    await aiosmtplib.send(
-        message,
-        hostname=settings.SMTP_HOST,
-        port=settings.SMTP_PORT,
-        username=settings.SMTP_USERNAME,
-        password=settings.SMTP_PASSWORD,
-        start_tls=True
-    )
 
-
-async def email_notifications(context: ContextTypes.DEFAULT_TYPE, notification_chat_ids: list[str], message: str,
+async def email_notifications(context: ContextTypes.DEFAULT_TYPE, job_id: Optional[int], subject: str, message: str,
                               menu: InlineKeyboardMarkup, notification_name: str) -> None:
     notifications_logger.info(f"triggered email_notifications for {notification_name}")
+    if job_id is None:
+        notifications_logger.info(f"no broadcast job for {notification_name}, not sending emails")
+        return
+
+    # Emails go to the whole audience of the broadcast job, even to users the Telegram fan-out skips because they
+    # blocked the bot
+    job = broadcast_jobs.get_job(job_id)
     with Session(models.engine) as session:
         stmt = (
             select(models.UserEmail.contact_email)
-            .where(models.UserEmail.tg_id.in_(notification_chat_ids))
+            .where(models.UserEmail.tg_id.in_(audience.build_query(job.audience)))
         )
         result = session.execute(stmt).scalars().all()
         emails = list(result)
@@ -87,13 +70,16 @@ async def email_notifications(context: ContextTypes.DEFAULT_TYPE, notification_c
     admin_chat_id = int(os.getenv('ADMIN_CHAT_ID'))
 
     if emails:
-        await send_emails(
-            subject=f"Звонок {notification_name} через 5 минут!",
+        # sent by the outbox worker, the notification job doesn't wait for SMTP
+        email_outbox.enqueue(
+            emails,
+            subject=subject,
             body=message,
-            recipients=emails
+            job_id=job_id,
+            expires_at=job.expires_at,
         )
     await context.bot.send_message(
         chat_id=admin_chat_id,
-        text=f"Sent {notification_name} notification to {len(emails)} emails",
+        text=f"Queued {notification_name} notification for {len(emails)} emails",
         parse_mode="HTML",
         reply_markup=menu)
@@ -0,0 +1,87 @@
+from typing import Awaitable, Callable, Optional
+
+from telegram import Bot, InlineKeyboardMarkup, Message, MessageEntity
+
+
+def markup_to_dict(reply_markup: Optional[InlineKeyboardMarkup]) -> Optional[dict]:
+    return reply_markup.to_dict() if reply_markup else None
+
+
+def entities_to_list(entities: Optional[tuple[MessageEntity, ...]]) -> Optional[list[dict]]:
+    return [entity.to_dict() for entity in entities] if entities else None
+
+
+def entities_from_list(entities: Optional[list[dict]], bot: Bot) -> Optional[tuple[MessageEntity, ...]]:
+    return MessageEntity.de_list(entities, bot) if entities else None
+
+
+def copy_payload(message: Message, reply_markup: InlineKeyboardMarkup = None) -> dict:
+    return {
+        "type": "copy",
+        "from_chat_id": message.chat_id,
+        "message_id": message.message_id,
+        "reply_markup": markup_to_dict(reply_markup),
+    }
+
+
+def text_payload(text: str, reply_markup: InlineKeyboardMarkup = None, parse_mode: str = None,
+                 entities: tuple[MessageEntity, ...] = None) -> dict:
+    return {
+        "type": "text",
+        "text": text,
+        "parse_mode": parse_mode,
+        "entities": entities_to_list(entities),
+        "reply_markup": markup_to_dict(reply_markup),
+    }
+
+
+def photo_payload(file_id: str, caption: str, caption_entities: tuple[MessageEntity, ...] = None,
+                  reply_markup: InlineKeyboardMarkup = None) -> dict:
+    return {
+        "type": "photo",
+        "photo": file_id,
+        "caption": caption,
+        "caption_entities": entities_to_list(caption_entities),
+        "reply_markup": markup_to_dict(reply_markup),
+    }
+
+
+def render_message(message: Message, signature: str = "", reply_markup: InlineKeyboardMarkup = None) -> dict:
+    if message.photo:
+        return photo_payload(message.photo[-1].file_id, (message.caption or "") + signature, message.caption_entities,
+                             reply_markup)
+    return text_payload((message.text or "") + signature, reply_markup, entities=message.entities)
+
+
+def make_send(bot: Bot, payload: dict) -> Callable[[str], Awaitable]:
+    reply_markup = InlineKeyboardMarkup.de_json(payload["reply_markup"], bot) if payload.get("reply_markup") else None
+
+    async def send(chat_id: str) -> None:
+        match payload["type"]:
+            case "copy":
+                await bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=payload["from_chat_id"],
+                    message_id=payload["message_id"],
+                    reply_markup=reply_markup
+                )
+            case "photo":
+                await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=payload["photo"],
+                    caption=payload["caption"],
+                    caption_entities=entities_from_list(payload["caption_entities"], bot),
+                    reply_markup=reply_markup
+                )
+            case "text":
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=payload["text"],
+                    parse_mode=payload["parse_mode"],
+                    entities=entities_from_list(payload["entities"], bot),
+                    reply_markup=reply_markup
+                )
+            case _:
+                raise ValueError(f"Unknown broadcast payload type: {payload['type']}")
+
+    return send
@@ -0,0 +1,87 @@
+# Fetches subscribers with membership.fetch_boosty_patrons from a local stand-in for the Boosty API and compares
+# fetching one page at a time with concurrent page fetches. The stand-in serves synthetic subscribers with a delay per
+# response, nothing goes to Boosty.
+#
+#   python scripts/benchmark_boosty_fetch.py --subscribers 5000 --delay 0.2 --concurrency 1 4 8
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Add parent directory to Python path so we can import membership
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from membership import fetch_boosty_patrons  # noqa: E402
+import settings  # noqa: E402
+
+BLOG_HREF = "benchmark"
+
+
+def make_subscribers(count: int) -> list[dict]:
+    return [{"id": i, "email": f"subscriber{i}@example.com" if i % 3 else None, "name": f"Subscriber {i}",
+             "price": [0, 300, 1500, 3000][i % 4]} for i in range(count)]
+
+
+def make_app(subscribers: list[dict], delay: float, max_limit: int) -> web.Application:
+    async def handle_subscribers(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        offset = int(request.query.get("offset", 0))
+        limit = min(int(request.query.get("limit", 20)), max_limit)
+        return web.json_response({"total": len(subscribers), "data": subscribers[offset:offset + limit]})
+
+    app = web.Application()
+    app.router.add_get(f"/v1/blog/{BLOG_HREF}/subscribers", handle_subscribers)
+    return app
+
+
+class StubBoostyAPI:
+    # the parts of BoostyAPI that fetch_boosty_patrons uses
+    def __init__(self, base_api_url: str):
+        self.BASE_API_URL = base_api_url
+        self.session = aiohttp.ClientSession()
+
+    def get_bearer(self) -> str:
+        return "benchmark"
+
+
+class AdminChat:
+    async def send_message(self, chat_id, text, **kwargs):
+        print(f"Message to admin: {text}")
+
+
+async def run(args: argparse.Namespace) -> None:
+    runner = web.AppRunner(make_app(make_subscribers(args.subscribers), args.delay, args.max_limit))
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", args.port).start()
+
+    fetch_boosty_patrons.boosty_api = StubBoostyAPI(f"http://localhost:{args.port}")
+    fetch_boosty_patrons.blog_href = BLOG_HREF
+    print(f"{args.subscribers} subscribers, pages of {settings.BOOSTY_PAGE_SIZE}, {args.delay}s per response\n")
+    try:
+        for concurrency in args.concurrency:
+            settings.BOOSTY_FETCH_CONCURRENCY = concurrency
+            started = time.perf_counter()
+            subscribers = await fetch_boosty_patrons.fetch_boosty_patrons(AdminChat())
+            elapsed = time.perf_counter() - started
+            print(f"concurrency {concurrency:>3}: {len(subscribers or []):>8} subscribers {elapsed:>8.2f}s")
+    finally:
+        await fetch_boosty_patrons.boosty_api.session.close()
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds before every response")
+    parser.add_argument("--max-limit", type=int, default=100, help="most subscribers the stand-in returns per page")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--port", type=int, default=8082)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
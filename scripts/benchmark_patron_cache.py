@@ -0,0 +1,109 @@
+# Compares Redis round trips and time per operation for the old per-key patron cache access and membership.patron_cache.
+# Needs a running Redis. Uses a separate database (15 by default) and refuses to run if it already has patron keys.
+#
+#   python scripts/benchmark_patron_cache.py --patrons 2000 --db 15
+import argparse
+import os
+import sys
+import time
+
+import redis
+
+# Add parent directory to Python path so we can import membership
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from membership import patron_cache  # noqa: E402
+import settings  # noqa: E402
+
+
+class CountingConnection(redis.Connection):
+    # one send_packed_command is one request to Redis: a single command or a whole pipeline
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def make_client(db: int, decode_responses: bool) -> redis.Redis:
+    return redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=CountingConnection, host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=db,
+        decode_responses=decode_responses))
+
+
+def make_patrons(count: int) -> list[patron_cache.PatreonRecord]:
+    return [patron_cache.PatreonRecord(
+        email=f"patron{i}@example.com", full_name=f"Patron {i}", patron_status="active_patron",
+        currently_entitled_amount_cents=500 * (i % 5), is_gifted=False,
+        sum_of_entitled_tiers_amount_cents=500 * (i % 5)) for i in range(count)]
+
+
+# the way fetch_patrons used the cache before the shared layer
+
+def old_store(r: redis.Redis, patrons: list[patron_cache.PatreonRecord]) -> None:
+    for patron in patrons:
+        r.hset(f"user:{patron.email}", mapping=patron.to_hash())
+
+
+def old_lookup(r: redis.Redis, emails: list[str]) -> None:
+    for email in emails:
+        key = f"user:{email}"
+        if r.exists(key):
+            {k.decode(): v.decode() for k, v in r.hgetall(key).items()}
+
+
+def old_scan(r: redis.Redis) -> None:
+    for key in r.scan_iter("user:*"):
+        {k.decode(): v.decode() for k, v in r.hgetall(key).items()}
+
+
+def old_clear(r: redis.Redis) -> None:
+    for key in r.scan_iter("user:*"):
+        r.delete(key)
+
+
+def measure(name: str, operation) -> None:
+    CountingConnection.round_trips = 0
+    started = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<32} {CountingConnection.round_trips:>8} round trips {elapsed * 1000:>10.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patrons", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--db", type=int, default=15)
+    args = parser.parse_args()
+
+    old_client = make_client(args.db, decode_responses=False)
+    # the shared layer is pointed at the benchmark database
+    patron_cache.r = make_client(args.db, decode_responses=True)
+    if (next(old_client.scan_iter(f"{patron_cache.patreon.legacy_prefix}*"), None) is not None or
+            old_client.exists(patron_cache.patreon.pointer)):
+        sys.exit(f"Redis db {args.db} already has patron keys, pick an empty database with --db")
+
+    patrons = make_patrons(args.patrons)
+    emails = [patron.email for patron in patrons[:args.lookups]]
+    print(f"{args.patrons} patrons, {args.lookups} lookups, Redis at {settings.REDIS_HOST}:{settings.REDIS_PORT}/"
+          f"{args.db}\n")
+
+    measure("before: store", lambda: old_store(old_client, patrons))
+    measure("before: lookup by email", lambda: old_lookup(old_client, emails))
+    measure("before: scan all patrons", lambda: old_scan(old_client))
+    measure("before: clear", lambda: old_clear(old_client))
+    print()
+    measure("after: store", lambda: patron_cache.store_patrons(patrons))
+    measure("after: lookup by email", lambda: [patron_cache.get_patron(email) for email in emails])
+    measure("after: bulk lookup by email", lambda: patron_cache.get_patrons(emails))
+    measure("after: scan all patrons", patron_cache.all_patrons)
+    # a reload compares the snapshot with what's stored and writes only the differences
+    measure("after: reload, nothing changed", lambda: patron_cache.store_patrons(patrons))
+    patrons[0].sum_of_entitled_tiers_amount_cents += 100
+    measure("after: reload, one changed", lambda: patron_cache.store_patrons(patrons))
+    patron_cache.delete_by_prefix(f"{patron_cache.patreon.name}:")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# A local stand-in for the Patreon members API, to run membership.fetch_patrons without touching Patreon.
+# It serves recorded pages from a directory, or synthetic members when no directory is given, with an optional delay
+# per response and 503s now and then to exercise retries.
+#
+# Record the real pages once (uses PATREON_ACCESS_TOKEN and PATREON_CAMPAIGN_ID from .env):
+#   python scripts/patreon_stub_server.py --record recorded_pages/
+# Serve them, or synthetic ones, and fetch them through the bot's client:
+#   python scripts/patreon_stub_server.py --pages recorded_pages/ --delay 0.3 --fetch
+#   python scripts/patreon_stub_server.py --members 3000 --delay 0.3 --fail-every 5 --fetch
+# Check that the next page is requested while the current one is parsed: with --parse-delay every page takes that long
+# to parse, and the fetch prints how much of the parsing overlapped with the next request
+#   python scripts/patreon_stub_server.py --members 5000 --delay 0.3 --parse-delay 0.3 --fetch
+# Or run the server alone and start the bot with PATREON_API_URL=http://localhost:8081
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+from dotenv import load_dotenv
+
+TIERS = [("tier-5", 500), ("tier-15", 1500), ("tier-30", 3000)]
+STATUSES = ["active_patron", "active_patron", "active_patron", "declined_patron", "former_patron"]
+
+
+def make_pages(members_count: int, page_size: int) -> list[dict]:
+    members = []
+    for i in range(members_count):
+        tier_id, amount = TIERS[i % len(TIERS)]
+        members.append({
+            "type": "member",
+            "id": f"member-{i}",
+            "attributes": {
+                "full_name": f"Patron {i}",
+                "email": f"patron{i}@example.com",
+                "patron_status": STATUSES[i % len(STATUSES)],
+                "currently_entitled_amount_cents": amount,
+                "is_gifted": i % 50 == 0,
+            },
+            "relationships": {"currently_entitled_tiers": {"data": [{"type": "tier", "id": tier_id}]}},
+        })
+    included = [{"type": "tier", "id": tier_id, "attributes": {"title": tier_id, "amount_cents": amount}}
+                for tier_id, amount in TIERS]
+    return [{"data": list(chunk), "included": included, "links": {}}
+            for chunk in itertools.batched(members, page_size)] or [{"data": [], "included": [], "links": {}}]
+
+
+def load_pages(pages_dir: str) -> list[dict]:
+    return [json.loads(path.read_text()) for path in sorted(Path(pages_dir).glob("page-*.json"),
+                                                            key=lambda path: int(path.stem.split("-")[1]))]
+
+
+def record_pages(pages_dir: str) -> None:
+    load_dotenv()
+    Path(pages_dir).mkdir(parents=True, exist_ok=True)
+    url = f"https://www.patreon.com/api/oauth2/v2/campaigns/{os.getenv('PATREON_CAMPAIGN_ID')}/members"
+    params = {
+        "include": "currently_entitled_tiers",
+        "fields[member]": "full_name,email,patron_status,currently_entitled_amount_cents,is_gifted",
+        "fields[tier]": "title,amount_cents",
+    }
+    headers = {"Authorization": f"Bearer {os.getenv('PATREON_ACCESS_TOKEN')}"}
+    with httpx.Client(timeout=30) as client:
+        for number in itertools.count(1):
+            response = client.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            data = response.json()
+            Path(pages_dir, f"page-{number}.json").write_text(json.dumps(data))
+            print(f"Recorded page {number} with {len(data['data'])} members")
+            url, params = data.get("links", {}).get("next"), None
+            if not url:
+                break
+
+
+def make_handler(pages: list[dict], delay: float, fail_every: int, request_times: list[float]):
+    requests_count = itertools.count(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            request_times.append(time.perf_counter())
+            time.sleep(delay)
+            if fail_every and next(requests_count) % fail_every == 0:
+                self.send_error(503)
+                return
+            query = parse_qs(urlparse(self.path).query)
+            number = int(query.get("cursor", ["0"])[0])
+            page = dict(pages[number])
+            host = f"http://{self.headers['Host']}"
+            page["links"] = ({"next": f"{host}{urlparse(self.path).path}?cursor={number + 1}"}
+                             if number + 1 < len(pages) else {})
+            body = json.dumps(page).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class AdminChat:
+    # fetch_patrons reports errors to the admin chat, here they are printed
+    async def send_message(self, chat_id, text, **kwargs):
+        print(f"Message to admin: {text}")
+
+
+async def fetch(port: int, parse_delay: float, request_times: list[float]) -> None:
+    os.environ["PATREON_API_URL"] = f"http://localhost:{port}"
+    # Add parent directory to Python path so we can import membership
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from membership import fetch_patrons
+
+    parse_page = fetch_patrons.parse_page
+    parse_spans = []
+
+    def timed_parse_page(data: dict, tier_id_to_amount: dict[str, int]) -> list[dict]:
+        started = time.perf_counter()
+        # stands in for parsing a much bigger page
+        time.sleep(parse_delay)
+        members = parse_page(data, tier_id_to_amount)
+        parse_spans.append((started, time.perf_counter()))
+        return members
+
+    fetch_patrons.parse_page = timed_parse_page
+    await fetch_patrons.init()
+    started = time.perf_counter()
+    patrons = await fetch_patrons.fetch_patrons(AdminChat())
+    print(f"Fetched {len(patrons or [])} patrons in {time.perf_counter() - started:.2f}s")
+    await fetch_patrons.close()
+
+    # a page is prefetched if the server got its request before the previous page was parsed
+    prefetched = sum(1 for (_, parsed_at), requested_at in zip(parse_spans, request_times[1:])
+                     if requested_at < parsed_at)
+    print(f"{prefetched} of {len(parse_spans) - 1} next pages were requested while the previous one was parsed")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--pages", help="directory with recorded page-N.json files")
+    parser.add_argument("--record", help="save the real Patreon pages to this directory and exit")
+    parser.add_argument("--members", type=int, default=1000, help="synthetic members when --pages is not given")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--fail-every", type=int, default=0, help="answer every Nth request with 503")
+    parser.add_argument("--parse-delay", type=float, default=0.0, help="extra seconds to parse every page on --fetch")
+    parser.add_argument("--fetch", action="store_true", help="fetch all pages with membership.fetch_patrons and exit")
+    args = parser.parse_args()
+
+    if args.record:
+        record_pages(args.record)
+        return
+
+    pages = load_pages(args.pages) if args.pages else make_pages(args.members, args.page_size)
+    request_times = []
+    server = ThreadingHTTPServer(("localhost", args.port),
+                                 make_handler(pages, args.delay, args.fail_every, request_times))
+    print(f"Serving {len(pages)} pages on http://localhost:{args.port}")
+    if not args.fetch:
+        server.serve_forever()
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    asyncio.run(fetch(args.port, args.parse_delay, request_times))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
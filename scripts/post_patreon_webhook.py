@@ -0,0 +1,46 @@
+# Posts recorded Patreon webhook payloads to the bot's webhook receiver (membership/patreon_webhook.py), signed with
+# PATREON_WEBHOOK_SECRET from .env the way Patreon signs them. The event comes from the file name, members_update.json
+# is sent as members:update. Bad signatures can be checked with --secret.
+#
+#   python scripts/post_patreon_webhook.py scripts/patreon_webhooks/members_create.json \
+#       scripts/patreon_webhooks/members_update.json scripts/patreon_webhooks/members_delete.json
+import argparse
+import hashlib
+import hmac
+import os
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+
+
+def post(url: str, secret: str, path: Path, event: str) -> None:
+    body = path.read_bytes()
+    signature = hmac.new(secret.encode(), body, hashlib.md5).hexdigest()
+    response = httpx.post(url, content=body, headers={
+        "Content-Type": "application/json",
+        "X-Patreon-Event": event,
+        "X-Patreon-Signature": signature,
+    })
+    print(f"{path.name} as {event}: {response.status_code}")
+
+
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("payloads", nargs="+", type=Path)
+    parser.add_argument("--url", default=f"http://{os.getenv('PATREON_WEBHOOK_HOST', '127.0.0.1')}:"
+                                         f"{os.getenv('PATREON_WEBHOOK_PORT', 8085)}"
+                                         f"{os.getenv('PATREON_WEBHOOK_PATH', '/patreon/webhook')}")
+    parser.add_argument("--secret", default=os.getenv("PATREON_WEBHOOK_SECRET"))
+    parser.add_argument("--event", help="send every payload as this event instead of the one from its file name")
+    args = parser.parse_args()
+    if not args.secret:
+        parser.error("set PATREON_WEBHOOK_SECRET in .env or pass --secret")
+
+    for path in args.payloads:
+        post(args.url, args.secret, path, args.event or path.stem.replace("_", ":", 1))
+
+
+if __name__ == "__main__":
+    main()
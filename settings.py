@@ -13,6 +13,14 @@ DB_HOST = 'localhost'
 DB_PORT = '5432'
 DB_NAME = 'nelenkin_club'
 DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+# the same database for handlers that use async sessions, so a slow query doesn't block other updates
+ASYNC_DATABASE_URL = f'postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+
+# Redis keeps the Patreon and Boosty patrons, membership.patron_cache owns the connection pools
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 20))
 
 ADMIN_CHAT_ID = int(os.getenv('ADMIN_CHAT_ID'))
 
@@ -25,6 +33,41 @@ AOC_TOPIC_ID = int(os.getenv("AOC_TOPIC_ID"))
 
 LEETCODE_MOCKS_THREAD_ID = int(os.getenv('LEETCODE_MOCKS_THREAD_ID'))
 
+# Patreon API client. Pages of PATREON_PAGE_SIZE members are fetched one ahead of parsing, failed requests are retried
+# PATREON_MAX_ATTEMPTS times with exponential backoff. PATREON_API_URL can point to scripts/patreon_stub_server.py
+PATREON_API_URL = os.getenv("PATREON_API_URL", "https://www.patreon.com")
+PATREON_PAGE_SIZE = int(os.getenv("PATREON_PAGE_SIZE", 500))
+PATREON_TIMEOUT_SECONDS = float(os.getenv("PATREON_TIMEOUT_SECONDS", 30))
+PATREON_MAX_ATTEMPTS = int(os.getenv("PATREON_MAX_ATTEMPTS", 4))
+PATREON_RETRY_BASE_SECONDS = float(os.getenv("PATREON_RETRY_BASE_SECONDS", 1))
+
+# Patreon webhooks are received only when PATREON_WEBHOOK_SECRET is set. The secret comes from the webhook settings of
+# the Patreon client, the endpoint is expected behind a reverse proxy. With webhooks on, the periodic reload only
+# reconciles and PATRON_REFRESH_INTERVAL_SECONDS can be raised to hours
+PATREON_WEBHOOK_SECRET = os.getenv("PATREON_WEBHOOK_SECRET")
+PATREON_WEBHOOK_HOST = os.getenv("PATREON_WEBHOOK_HOST", "127.0.0.1")
+PATREON_WEBHOOK_PORT = int(os.getenv("PATREON_WEBHOOK_PORT", 8085))
+PATREON_WEBHOOK_PATH = os.getenv("PATREON_WEBHOOK_PATH", "/patreon/webhook")
+
+# Patrons are reloaded in the background every PATRON_REFRESH_INTERVAL_SECONDS plus up to PATRON_REFRESH_JITTER_SECONDS.
+# Handlers that need fresher data reload a source at most once per PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS
+PATRON_REFRESH_INTERVAL_SECONDS = int(os.getenv("PATRON_REFRESH_INTERVAL_SECONDS", 15 * 60))
+PATRON_REFRESH_JITTER_SECONDS = int(os.getenv("PATRON_REFRESH_JITTER_SECONDS", 60))
+PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS = int(os.getenv("PATRON_REFRESH_ON_DEMAND_MAX_AGE_SECONDS", 60))
+
+# Boosty subscribers are fetched in pages of BOOSTY_PAGE_SIZE, at most BOOSTY_FETCH_CONCURRENCY pages at once
+BOOSTY_PAGE_SIZE = int(os.getenv("BOOSTY_PAGE_SIZE", 100))
+BOOSTY_FETCH_CONCURRENCY = int(os.getenv("BOOSTY_FETCH_CONCURRENCY", 4))
+BOOSTY_TIMEOUT_SECONDS = float(os.getenv("BOOSTY_TIMEOUT_SECONDS", 30))
+
+# memberships are cached in process for this long, changes made by the bot itself invalidate them right away
+MEMBERSHIP_CACHE_TTL_SECONDS = int(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", 10 * 60))
+MEMBERSHIP_CACHE_MAX_SIZE = int(os.getenv("MEMBERSHIP_CACHE_MAX_SIZE", 10000))
+
+# more users becoming Pro in one patron reload than this is taken for a data glitch (like a partial Patreon reload being
+# fixed by the next one), they are logged and not congratulated
+PRO_CONGRATULATIONS_MAX_BATCH = int(os.getenv("PRO_CONGRATULATIONS_MAX_BATCH", 20))
+
 # SMTP email settings
 SMTP_USERNAME = os.getenv("SMTP_USERNAME")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
@@ -32,3 +75,47 @@ SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SMTP_HOST = os.getenv("SMTP_HOST", "email-smtp.eu-north-1.amazonaws.com")
 SMTP_PORT = os.getenv("SMTP_PORT", 587)
 EMAIL_FROM = os.getenv("EMAIL_FROM", "hello@nelenkin.club")
+# SMTP connections are pooled and reused, each message carries at most EMAIL_BCC_CHUNK_SIZE recipients in Bcc
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE", 4))
+EMAIL_BCC_CHUNK_SIZE = int(os.getenv("EMAIL_BCC_CHUNK_SIZE", 50))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 3))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv("EMAIL_RETRY_BASE_SECONDS", 2))
+EMAIL_TIMEOUT_SECONDS = float(os.getenv("EMAIL_TIMEOUT_SECONDS", 30))
+# Emails are queued in the EmailOutbox table and sent by a background worker. Failed ones are retried
+# EMAIL_OUTBOX_MAX_ATTEMPTS times with exponential backoff, then left as dead
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", 500))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv("EMAIL_OUTBOX_MAX_ATTEMPTS", 5))
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = int(os.getenv("EMAIL_OUTBOX_RETRY_BASE_SECONDS", 15))
+EMAIL_OUTBOX_POLL_SECONDS = float(os.getenv("EMAIL_OUTBOX_POLL_SECONDS", 10))
+
+# Telegram broadcast settings. Telegram allows about 30 messages per second to different chats
+BROADCAST_MAX_RATE_PER_SECOND = float(os.getenv("BROADCAST_MAX_RATE_PER_SECOND", 25))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", 25))
+BROADCAST_RATE_RECOVERY_PER_SECOND = float(os.getenv("BROADCAST_RATE_RECOVERY_PER_SECOND", 0.5))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 32))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", 4))
+BROADCAST_RETRY_BASE_SECONDS = float(os.getenv("BROADCAST_RETRY_BASE_SECONDS", 1))
+# broadcast workers plus some headroom for handlers answering users while a broadcast is running
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", BROADCAST_CONCURRENCY + 16))
+# how many recipients of a durable broadcast job are claimed and checkpointed at once
+BROADCAST_JOB_BATCH_SIZE = int(os.getenv("BROADCAST_JOB_BATCH_SIZE", 200))
+# a broadcast retries a message that failed with a temporary error in
+# DELIVERY_RETRY_BASE_MINUTES * 2^(failures in a row - 1), but not later than DELIVERY_RETRY_MAX_MINUTES, and gives up
+# on the user after DELIVERY_MAX_ATTEMPTS or when the broadcast expires
+DELIVERY_RETRY_BASE_MINUTES = int(os.getenv("DELIVERY_RETRY_BASE_MINUTES", 1))
+DELIVERY_RETRY_MAX_MINUTES = int(os.getenv("DELIVERY_RETRY_MAX_MINUTES", 60))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", 5))
+# Zoom reminders normally go out REMINDER_LEAD_MINUTES before the call. For a big audience they start earlier, so the
+# last message is delivered REMINDER_DEADLINE_MINUTES_BEFORE_CALL before the call, but never earlier than
+# REMINDER_PLANNING_MINUTES_BEFORE_CALL
+REMINDER_LEAD_MINUTES = int(os.getenv("REMINDER_LEAD_MINUTES", 7))
+REMINDER_DEADLINE_MINUTES_BEFORE_CALL = int(os.getenv("REMINDER_DEADLINE_MINUTES_BEFORE_CALL", 0))
+REMINDER_PLANNING_MINUTES_BEFORE_CALL = int(os.getenv("REMINDER_PLANNING_MINUTES_BEFORE_CALL", 40))
+# estimated send duration is multiplied by this, the estimate comes from previous reminders and may be optimistic
+REMINDER_DURATION_SAFETY_FACTOR = float(os.getenv("REMINDER_DURATION_SAFETY_FACTOR", 1.5))
+# how many recent reminder jobs the send rate estimate is based on
+SEND_RATE_ESTIMATE_JOBS = int(os.getenv("SEND_RATE_ESTIMATE_JOBS", 10))
+# audience tg_ids are read through a server-side cursor in chunks of this size
+AUDIENCE_YIELD_PER = int(os.getenv("AUDIENCE_YIELD_PER", 1000))
+# reminders that could not be finished before this are not resumed after a restart
+NOTIFICATION_JOB_TTL_MINUTES = int(os.getenv("NOTIFICATION_JOB_TTL_MINUTES", 30))
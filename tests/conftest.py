@@ -0,0 +1,22 @@
+import os
+
+import pytest
+import sqlalchemy
+
+# settings reads these at import, tests don't use them
+for name in ("ADMIN_CHAT_ID", "CLUB_GROUP_CHAT_ID", "AOC_TOPIC_ID", "LEETCODE_MOCKS_THREAD_ID"):
+    os.environ.setdefault(name, "0")
+os.environ.setdefault("PATREON_WEBHOOK_SECRET", "test-secret")
+
+
+@pytest.fixture
+def db():
+    # tests that need Postgres run against the database from settings, migrated with alembic, the one from
+    # docker-compose.yml locally
+    import models
+    try:
+        with models.engine.connect() as connection:
+            connection.execute(sqlalchemy.text("SELECT 1"))
+    except sqlalchemy.exc.OperationalError as e:
+        pytest.skip(f"Postgres is not available: {e}")
+    return models.engine
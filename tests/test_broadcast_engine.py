@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from notifications import broadcast_engine
+
+
+@pytest.mark.parametrize("error, outcome", [
+    (Forbidden("Forbidden: bot was blocked by the user"), broadcast_engine.BLOCKED),
+    (BadRequest("Chat not found"), broadcast_engine.CHAT_NOT_FOUND),
+    (BadRequest("Message is too long"), broadcast_engine.BAD_REQUEST),
+    (RetryAfter(5), broadcast_engine.RATE_LIMITED),
+    (TimedOut(), broadcast_engine.NETWORK_ERROR),
+    (NetworkError("Connection reset"), broadcast_engine.NETWORK_ERROR),
+    (ValueError("oops"), broadcast_engine.UNEXPECTED_ERROR),
+])
+def test_classify_error(error, outcome):
+    assert broadcast_engine.classify_error(error) == outcome
+
+
+async def acquire_in_order(senders: list[tuple[str, int]], late_senders: list[tuple[str, int]]) -> list[str]:
+    # one token to start with and one more every 20ms, so every sender after the first waits for its turn
+    bucket = broadcast_engine.TokenBucket(max_rate=50, capacity=1, recovery_per_second=0)
+    order = []
+
+    async def acquire(chat_id: str, priority: int) -> None:
+        await bucket.acquire(chat_id, priority)
+        order.append(chat_id)
+
+    tasks = [asyncio.create_task(acquire(chat_id, priority)) for chat_id, priority in senders]
+    await asyncio.sleep(0.005)
+    tasks.extend(asyncio.create_task(acquire(chat_id, priority)) for chat_id, priority in late_senders)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_reminder_waits_for_one_token_behind_club_broadcast():
+    clubs = [(f"club{i}", broadcast_engine.CLUB_PRIORITY) for i in range(5)]
+    order = asyncio.run(acquire_in_order(clubs, [("reminder", broadcast_engine.REMINDER_PRIORITY)]))
+    # club0 took the first token and club1 was already waiting for the next one when the reminder came
+    assert order == ["club0", "club1", "reminder", "club2", "club3", "club4"]
+
+
+def test_senders_of_one_priority_go_in_arrival_order():
+    courses = [(f"course{i}", broadcast_engine.COURSE_PRIORITY) for i in range(3)]
+    clubs = [(f"club{i}", broadcast_engine.CLUB_PRIORITY) for i in range(2)]
+    order = asyncio.run(acquire_in_order(clubs, courses))
+    assert order == ["club0", "club1", "course0", "course1", "course2"]
+
+
+def test_cancelled_sender_passes_the_turn():
+    async def run() -> list[str]:
+        bucket = broadcast_engine.TokenBucket(max_rate=50, capacity=1, recovery_per_second=0)
+        order = []
+
+        async def acquire(chat_id: str) -> None:
+            await bucket.acquire(chat_id)
+            order.append(chat_id)
+
+        first, cancelled, last = (asyncio.create_task(acquire(chat_id)) for chat_id in ["first", "cancelled", "last"])
+        await asyncio.sleep(0.005)
+        cancelled.cancel()
+        await asyncio.wait_for(asyncio.gather(first, last), timeout=1)
+        return order
+
+    assert asyncio.run(run()) == ["first", "last"]
@@ -0,0 +1,151 @@
+import asyncio
+import datetime
+
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from telegram.error import NetworkError
+
+import models
+import settings
+from monitoring import delivery_ledger
+from notifications import broadcast_engine, broadcast_jobs, rendering
+
+# Jobs run against Postgres with a bot that only records what it sends. Every test cleans up its job and the ledger
+# rows of its recipients.
+
+TG_IDS = ["-700401", "-700402", "-700403"]
+REPORT_CHAT_ID = "-700400"
+
+
+class RecordingBot:
+    def __init__(self, failing_ids: set[str] = frozenset()):
+        self.failing_ids = failing_ids
+        self.chat_ids = []
+        self.reports = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == REPORT_CHAT_ID:
+            self.reports.append(text)
+            return
+        if chat_id in self.failing_ids:
+            raise NetworkError("Connection reset")
+        self.chat_ids.append(chat_id)
+
+
+@pytest.fixture
+def new_job(db, monkeypatch):
+    monkeypatch.setattr(settings, "BROADCAST_RETRY_BASE_SECONDS", 0)
+    monkeypatch.setattr(broadcast_jobs, "report_metrics", lambda job, stats: None)
+    job_ids = []
+
+    def create(expires_at: datetime.datetime = None) -> int:
+        job_id = broadcast_jobs.create_job(
+            name="test", idempotency_key=f"test-broadcast-jobs-{datetime.datetime.utcnow().isoformat()}",
+            payload=rendering.text_payload("hello"), audience_spec={"type": "all"},
+            priority=broadcast_engine.CLUB_PRIORITY, report_chat_id=REPORT_CHAT_ID, expires_at=expires_at)
+        job_ids.append(job_id)
+
+        async def store() -> None:
+            await broadcast_jobs.store_recipients(job_id, TG_IDS)
+            await broadcast_jobs.mark_audience_resolved(job_id)
+            await models.async_engine.dispose()
+
+        asyncio.run(store())
+        return job_id
+
+    yield create
+    with Session(db) as session:
+        session.execute(delete(models.BroadcastJob).where(models.BroadcastJob.id.in_(job_ids)))
+        session.execute(delete(models.DeliveryStatus).where(models.DeliveryStatus.tg_id.in_(TG_IDS)))
+        session.commit()
+
+
+def run(coroutine):
+    async def run_and_dispose():
+        try:
+            return await coroutine
+        finally:
+            await models.async_engine.dispose()
+
+    return asyncio.run(run_and_dispose())
+
+
+def recipients(job_id: int) -> dict[str, models.BroadcastRecipient]:
+    with Session(models.engine) as session:
+        return {recipient.tg_id: recipient for recipient in session.scalars(
+            select(models.BroadcastRecipient).where(models.BroadcastRecipient.job_id == job_id))}
+
+
+def test_job_resumed_after_crash_sends_to_unconfirmed_and_pending(new_job, monkeypatch):
+    job_id = new_job()
+    monkeypatch.setattr(settings, "BROADCAST_JOB_BATCH_SIZE", 2)
+    # the bot died after claiming the first batch and before its checkpoint
+    claimed = run(broadcast_jobs.claim_batch(job_id))
+    assert [status for _, status in claimed] == [broadcast_jobs.SENDING] * 2
+
+    bot = RecordingBot()
+    run(broadcast_jobs.run_job(bot, job_id))
+    assert sorted(bot.chat_ids) == sorted(TG_IDS)
+    assert {recipient.status for recipient in recipients(job_id).values()} == {broadcast_jobs.SENT}
+    assert broadcast_jobs.get_job(job_id).status == broadcast_jobs.DONE
+    assert len(bot.reports) == 1 and "sent to 3 users" in bot.reports[0]
+
+
+def test_suppressed_users_are_skipped_when_claimed(new_job):
+    job_id = new_job()
+    with Session(models.engine) as session:
+        delivery_ledger.write_deliveries(session, [], {TG_IDS[0]: broadcast_engine.BLOCKED})
+        session.commit()
+
+    claimed = dict(run(broadcast_jobs.claim_batch(job_id)))
+    assert claimed == {TG_IDS[0]: broadcast_jobs.SKIPPED, TG_IDS[1]: broadcast_jobs.SENDING,
+                       TG_IDS[2]: broadcast_jobs.SENDING}
+
+
+def test_temporary_failure_is_retried_on_the_ledger_schedule(new_job, monkeypatch):
+    monkeypatch.setattr(settings, "DELIVERY_MAX_ATTEMPTS", 2)
+    job_id = new_job()
+    failed = broadcast_engine.BroadcastResult(success_ids=TG_IDS[1:],
+                                              failures={TG_IDS[0]: broadcast_engine.NETWORK_ERROR})
+
+    run(broadcast_jobs.claim_batch(job_id))
+    run(broadcast_jobs.checkpoint(job_id, failed))
+    retried = recipients(job_id)[TG_IDS[0]]
+    assert retried.status == broadcast_jobs.PENDING
+    with Session(models.engine) as session:
+        assert retried.retry_at == session.get(models.DeliveryStatus, TG_IDS[0]).next_attempt_at
+    # not claimed again before the retry time
+    assert run(broadcast_jobs.claim_batch(job_id)) == []
+
+    with Session(models.engine) as session:
+        session.execute(models.BroadcastRecipient.__table__.update()
+                        .where(models.BroadcastRecipient.job_id == job_id).values(retry_at=None))
+        session.commit()
+    assert dict(run(broadcast_jobs.claim_batch(job_id))) == {TG_IDS[0]: broadcast_jobs.SENDING}
+    run(broadcast_jobs.checkpoint(job_id, broadcast_engine.BroadcastResult(
+        failures={TG_IDS[0]: broadcast_engine.NETWORK_ERROR})))
+    # the second attempt was the last one
+    assert recipients(job_id)[TG_IDS[0]].status == broadcast_jobs.FAILED
+
+
+def test_failed_sends_are_recorded_when_the_job_runs(new_job, monkeypatch):
+    monkeypatch.setattr(settings, "BROADCAST_MAX_ATTEMPTS", 1)
+    monkeypatch.setattr(settings, "DELIVERY_MAX_ATTEMPTS", 1)
+    job_id = new_job()
+
+    bot = RecordingBot(failing_ids={TG_IDS[0]})
+    run(broadcast_jobs.run_job(bot, job_id))
+    assert sorted(bot.chat_ids) == sorted(TG_IDS[1:])
+    assert {tg_id: recipient.status for tg_id, recipient in recipients(job_id).items()} == {
+        TG_IDS[0]: broadcast_jobs.FAILED, TG_IDS[1]: broadcast_jobs.SENT, TG_IDS[2]: broadcast_jobs.SENT}
+    assert broadcast_jobs.get_job(job_id).status == broadcast_jobs.DONE
+
+
+def test_expired_job_is_not_sent(new_job):
+    job_id = new_job(expires_at=datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+    bot = RecordingBot()
+    run(broadcast_jobs.run_job(bot, job_id))
+    assert bot.chat_ids == []
+    assert broadcast_jobs.get_job(job_id).status == broadcast_jobs.EXPIRED
+    assert len(bot.reports) == 1 and "not sent" in bot.reports[0]
@@ -0,0 +1,77 @@
+import datetime
+
+import pytest
+from sqlalchemy.orm import Session
+
+import models
+import settings
+from monitoring import delivery_ledger
+from notifications import broadcast_engine
+
+# Runs upsert_statuses in a transaction that is rolled back, so the ledger keeps no test rows.
+
+TG_ID = "-700101"
+
+
+@pytest.fixture
+def session(db, monkeypatch):
+    monkeypatch.setattr(settings, "DELIVERY_RETRY_BASE_MINUTES", 1)
+    monkeypatch.setattr(settings, "DELIVERY_RETRY_MAX_MINUTES", 8)
+    with Session(db) as session:
+        yield session
+        session.rollback()
+
+
+def deliver(session: Session, error: str = None) -> models.DeliveryStatus:
+    if error is None:
+        delivery_ledger.write_deliveries(session, [TG_ID], {})
+    else:
+        delivery_ledger.write_deliveries(session, [], {TG_ID: error})
+    session.expire_all()
+    return session.get(models.DeliveryStatus, TG_ID)
+
+
+def retry_minutes(status: models.DeliveryStatus) -> float:
+    return (status.next_attempt_at - status.last_message_try_time) / datetime.timedelta(minutes=1)
+
+
+def test_temporary_failures_back_off_exponentially_up_to_the_limit(session):
+    delays = []
+    for count in range(1, 6):
+        status = deliver(session, broadcast_engine.NETWORK_ERROR)
+        assert status.temporary_failure_count == count
+        assert not status.is_suppressed
+        delays.append(retry_minutes(status))
+    assert delays == [1, 2, 4, 8, 8]
+
+
+def test_success_resets_the_schedule(session):
+    deliver(session, broadcast_engine.NETWORK_ERROR)
+    deliver(session, broadcast_engine.NETWORK_ERROR)
+    status = deliver(session)
+    assert status.is_last_message_successful
+    assert status.temporary_failure_count == 0
+    assert status.next_attempt_at is None
+
+
+def test_rate_limit_is_not_recorded(session):
+    assert deliver(session, broadcast_engine.RATE_LIMITED) is None
+    deliver(session, broadcast_engine.NETWORK_ERROR)
+    status = deliver(session, broadcast_engine.RATE_LIMITED)
+    assert status.last_error == broadcast_engine.NETWORK_ERROR
+    assert status.temporary_failure_count == 1
+
+
+def test_other_errors_keep_the_schedule(session):
+    retry_at = deliver(session, broadcast_engine.NETWORK_ERROR).next_attempt_at
+    status = deliver(session, broadcast_engine.BAD_REQUEST)
+    assert status.last_error == broadcast_engine.BAD_REQUEST
+    assert status.temporary_failure_count == 1
+    assert status.next_attempt_at == retry_at
+    assert not status.is_suppressed
+
+
+def test_permanent_failure_suppresses_until_success(session):
+    assert deliver(session, broadcast_engine.BLOCKED).is_suppressed
+    assert deliver(session, broadcast_engine.NETWORK_ERROR).is_suppressed
+    assert not deliver(session).is_suppressed
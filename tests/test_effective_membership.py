@@ -0,0 +1,131 @@
+import asyncio
+
+import fakeredis
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+import models
+import settings
+from membership import effective_membership, fetch_boosty_patrons, fetch_patrons, level_changes, patron_cache
+
+# EffectiveMembership is rebuilt from the linked patrons in Redis, here fakeredis, and the links in Postgres. The table
+# is derived data, so the full refreshes below clear and rebuild it.
+
+TG_IDS = ["-700201", "-700202", "-700203"]
+
+
+def patron(email: str, amount: int) -> patron_cache.PatreonRecord:
+    return patron_cache.PatreonRecord(email=email, full_name=email, patron_status="active_patron",
+                                      currently_entitled_amount_cents=amount, is_gifted=False,
+                                      sum_of_entitled_tiers_amount_cents=amount)
+
+
+def email(tg_id: str) -> str:
+    return f"patron{tg_id}@example.com"
+
+
+@pytest.fixture
+def linked_users(db, monkeypatch):
+    monkeypatch.setattr(patron_cache, "r", fakeredis.FakeRedis(decode_responses=True))
+    with Session(db) as session:
+        session.execute(delete(models.EffectiveMembership))
+        session.add_all(models.User(tg_id=tg_id) for tg_id in TG_IDS)
+        session.flush()
+        session.add_all(models.PatreonLink(tg_id=tg_id, patreon_email=email(tg_id)) for tg_id in TG_IDS)
+        session.commit()
+    yield TG_IDS
+    with Session(db) as session:
+        session.execute(delete(models.EffectiveMembership))
+        session.execute(delete(models.PatreonLink).where(models.PatreonLink.tg_id.in_(TG_IDS)))
+        session.execute(delete(models.BoostyLink).where(models.BoostyLink.tg_id.in_(TG_IDS)))
+        session.execute(delete(models.User).where(models.User.tg_id.in_(TG_IDS)))
+        session.commit()
+
+
+def as_pairs(changes: list[level_changes.LevelChange]) -> set[tuple[str, bool]]:
+    return {(change.tg_id, change.is_upgrade) for change in changes}
+
+
+def pro_tg_ids() -> set[str]:
+    with Session(models.engine) as session:
+        return set(session.scalars(effective_membership.pro_tg_ids_query()))
+
+
+def test_first_full_refresh_reports_no_changes(linked_users):
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 1500), patron(email(TG_IDS[1]), 500)])
+    assert effective_membership.refresh_all() == []
+    assert pro_tg_ids() == {TG_IDS[0]}
+
+
+def test_full_refresh_reports_upgrades_and_downgrades(linked_users):
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 1500), patron(email(TG_IDS[1]), 500)])
+    effective_membership.refresh_all()
+
+    patron_cache.store_patrons([patron(email(TG_IDS[1]), 2000), patron(email(TG_IDS[2]), 1500)])
+    assert as_pairs(effective_membership.refresh_all()) == {(TG_IDS[0], False), (TG_IDS[1], True), (TG_IDS[2], True)}
+    assert pro_tg_ids() == {TG_IDS[1], TG_IDS[2]}
+    assert effective_membership.refresh_all() == []
+
+
+def test_user_refresh_changes_only_that_user(linked_users):
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 500)])
+    effective_membership.refresh_all()
+
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 1500), patron(email(TG_IDS[1]), 1500)])
+    assert as_pairs(effective_membership.refresh_user(TG_IDS[0])) == {(TG_IDS[0], True)}
+    assert pro_tg_ids() == {TG_IDS[0]}
+    with Session(models.engine) as session:
+        row = session.scalars(select(models.EffectiveMembership).where(
+            models.EffectiveMembership.tg_id == TG_IDS[0])).one()
+    assert row.is_paid and not row.has_activity and row.expires_at is None
+
+
+def test_user_refresh_reads_only_the_users_profiles(linked_users, monkeypatch):
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 500), patron(email(TG_IDS[1]), 1500)])
+    patron_cache.store_boosty_patrons([patron_cache.BoostyRecord(id="boosty1", email="", name="", price=1500)])
+    effective_membership.refresh_all()
+    with Session(models.engine) as session:
+        session.add(models.BoostyLink(tg_id=TG_IDS[0], boosty_user_id="boosty1"))
+        session.commit()
+
+    def read_all_pro_patrons():
+        raise AssertionError("refreshing one user read all Pro patrons")
+
+    monkeypatch.setattr(fetch_patrons, "get_pro_patron_emails", read_all_pro_patrons)
+    monkeypatch.setattr(fetch_boosty_patrons, "get_pro_boosty_user_ids", read_all_pro_patrons)
+    assert as_pairs(effective_membership.refresh_user(TG_IDS[0])) == {(TG_IDS[0], True)}
+    assert as_pairs(effective_membership.refresh_user(TG_IDS[1])) == set()
+    assert as_pairs(effective_membership.refresh_user(TG_IDS[2])) == set()
+    assert pro_tg_ids() == {TG_IDS[0], TG_IDS[1]}
+
+
+def test_user_refresh_reports_a_downgrade_after_unlinking(linked_users):
+    patron_cache.store_patrons([patron(email(TG_IDS[0]), 1500), patron(email(TG_IDS[1]), 1500)])
+    effective_membership.refresh_all()
+    with Session(models.engine) as session:
+        session.execute(delete(models.PatreonLink).where(models.PatreonLink.tg_id == TG_IDS[0]))
+        session.commit()
+
+    assert as_pairs(effective_membership.refresh_user(TG_IDS[0])) == {(TG_IDS[0], False)}
+    assert pro_tg_ids() == {TG_IDS[1]}
+    assert effective_membership.refresh_user(TG_IDS[0]) == []
+
+
+class RecordingBot:
+    def __init__(self):
+        self.chat_ids = []
+
+    async def send_message(self, chat_id, text):
+        self.chat_ids.append(chat_id)
+
+
+def test_large_upgrade_batches_are_not_congratulated(monkeypatch):
+    monkeypatch.setattr(settings, "PRO_CONGRATULATIONS_MAX_BATCH", 2)
+    bot = RecordingBot()
+    upgrade = [level_changes.LevelChange(tg_id, effective_membership.BASIC_LEVEL, effective_membership.PRO_LEVEL)
+               for tg_id in TG_IDS]
+    asyncio.run(level_changes.congratulate_new_pro_members(bot, upgrade))
+    assert bot.chat_ids == []
+    asyncio.run(level_changes.congratulate_new_pro_members(bot, upgrade[:2]))
+    assert sorted(bot.chat_ids) == sorted(TG_IDS[:2])
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+import models
+import settings
+from notifications import email_outbox, email_sender
+
+# The outbox is drained against Postgres with send_in_chunks replaced, so no email leaves the test. claim_batch takes
+# any due email, so the tests are skipped when the database has pending emails of its own.
+
+RECIPIENTS = ["outbox.first@example.com", "outbox.second@example.com", "outbox.third@example.com"]
+SUBJECT = "Outbox test"
+
+
+@pytest.fixture
+def outbox(db, monkeypatch):
+    with Session(db) as session:
+        if session.scalar(select(models.EmailOutbox.id).where(models.EmailOutbox.status == email_outbox.PENDING)):
+            pytest.skip("the email outbox has pending emails")
+    monkeypatch.setattr(settings, "EMAIL_OUTBOX_RETRY_BASE_SECONDS", 0)
+    yield
+    with Session(db) as session:
+        session.execute(delete(models.EmailOutbox).where(models.EmailOutbox.recipient.in_(RECIPIENTS)))
+        session.commit()
+
+
+def statuses() -> dict[str, tuple[str, int]]:
+    with Session(models.engine) as session:
+        return {email.recipient: (email.status, email.attempts) for email in session.scalars(
+            select(models.EmailOutbox).where(models.EmailOutbox.recipient.in_(RECIPIENTS)))}
+
+
+def test_claim_batch_takes_at_most_a_batch(outbox, monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_OUTBOX_BATCH_SIZE", 2)
+    email_outbox.enqueue(RECIPIENTS, SUBJECT, "body")
+    assert len(email_outbox.claim_batch()) == 2
+    assert len(email_outbox.claim_batch()) == 1
+    assert email_outbox.claim_batch() == []
+
+
+def test_failed_email_is_retried_until_it_is_dead(outbox, monkeypatch):
+    monkeypatch.setattr(settings, "EMAIL_OUTBOX_MAX_ATTEMPTS", 2)
+    sent_to = []
+
+    async def send_in_chunks(subject, body, recipients, max_attempts):
+        sent_to.extend(recipients)
+        return email_sender.EmailResult(sent=[recipient for recipient in recipients if recipient != RECIPIENTS[0]],
+                                        failures={RECIPIENTS[0]: "smtp error"} if RECIPIENTS[0] in recipients else {})
+
+    monkeypatch.setattr(email_sender, "send_in_chunks", send_in_chunks)
+    email_outbox.enqueue(RECIPIENTS, SUBJECT, "body")
+    asyncio.run(email_outbox.drain())
+
+    assert sorted(sent_to) == sorted(RECIPIENTS + RECIPIENTS[:1])
+    assert statuses() == {RECIPIENTS[0]: (email_outbox.DEAD, 2), RECIPIENTS[1]: (email_outbox.SENT, 1),
+                          RECIPIENTS[2]: (email_outbox.SENT, 1)}
+
+
+def test_unconfirmed_emails_are_not_sent_again(outbox):
+    email_outbox.enqueue(RECIPIENTS[:1], SUBJECT, "body")
+    # the bot stopped while this batch was being sent
+    email_outbox.claim_batch()
+    email_outbox.give_up_on_unconfirmed()
+    assert statuses() == {RECIPIENTS[0]: (email_outbox.DEAD, 1)}
+    assert email_outbox.claim_batch() == []
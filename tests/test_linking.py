@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from telegram import User
+
+import models
+from membership import effective_membership, level_changes, patreon_handlers, patron_cache
+
+# Linking a Patreon email saves the link, refreshes the user's effective membership and publishes the level change.
+
+TG_ID = -700301
+EMAIL = "linking.patron@example.com"
+
+
+class RecordingBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+@pytest.fixture
+def user(db, monkeypatch):
+    monkeypatch.setattr(patron_cache, "r", fakeredis.FakeRedis(decode_responses=True))
+    patron_cache.store_patrons([patron_cache.PatreonRecord(
+        email=EMAIL, full_name="Linking Patron", patron_status="active_patron", currently_entitled_amount_cents=1500,
+        is_gifted=False, sum_of_entitled_tiers_amount_cents=1500)])
+    with Session(db) as session:
+        session.add(models.User(tg_id=str(TG_ID), tg_username="linking_patron"))
+        session.commit()
+    yield User(id=TG_ID, first_name="Linking", is_bot=False, username="linking_patron")
+    with Session(db) as session:
+        session.execute(delete(models.EffectiveMembership).where(models.EffectiveMembership.tg_id == str(TG_ID)))
+        session.execute(delete(models.PatreonLink).where(models.PatreonLink.tg_id == str(TG_ID)))
+        session.execute(delete(models.User).where(models.User.tg_id == str(TG_ID)))
+        session.commit()
+
+
+@pytest.fixture
+def published(monkeypatch):
+    changes = []
+
+    async def record(bot, new_changes):
+        changes.extend(new_changes)
+
+    monkeypatch.setattr(level_changes, "_listeners", [record])
+    return changes
+
+
+def link(user: User, bot: RecordingBot) -> bool:
+    update = SimpleNamespace(callback_query=None, effective_message=SimpleNamespace(from_user=user),
+                             effective_chat=SimpleNamespace(id=user.id))
+    return asyncio.run(patreon_handlers.store_patreon_linking(update, EMAIL, SimpleNamespace(bot=bot)))
+
+
+def linked_emails() -> list[str]:
+    with Session(models.engine) as session:
+        return list(session.scalars(select(models.PatreonLink.patreon_email)
+                                    .where(models.PatreonLink.tg_id == str(TG_ID))))
+
+
+def test_linking_a_pro_patron_publishes_the_upgrade(user, published):
+    bot = RecordingBot()
+    assert link(user, bot)
+    assert linked_emails() == [EMAIL]
+    assert [(change.tg_id, change.is_upgrade) for change in published] == [(str(TG_ID), True)]
+    assert bot.messages == []
+
+
+def test_failed_refresh_keeps_the_link(user, published, monkeypatch):
+    def fail(tg_id):
+        raise RuntimeError("refresh failed")
+
+    monkeypatch.setattr(effective_membership, "refresh_user", fail)
+    bot = RecordingBot()
+    assert link(user, bot)
+    assert linked_emails() == [EMAIL]
+    assert published == []
+    # neither the admin nor the user is told that linking failed
+    assert bot.messages == []
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from pathlib import Path
+
+import fakeredis
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+import models
+import settings
+from membership import fetch_patrons, level_changes, patreon_webhook, patron_cache
+
+# Posts the recorded payloads from scripts/patreon_webhooks the way Patreon does and checks what ends up in the stored
+# patrons. Redis is replaced with fakeredis, the PatreonLink lookup and the membership refresh need Postgres.
+
+PAYLOADS = Path(__file__).parent.parent / "scripts" / "patreon_webhooks"
+EMAIL = "webhook.patron@example.com"
+TG_ID = "-700001"
+
+
+@pytest.fixture
+def stored_patrons(monkeypatch):
+    monkeypatch.setattr(patron_cache, "r", fakeredis.FakeRedis(decode_responses=True))
+    # webhooks are applied only once the first full reload has stored a generation
+    patron_cache.store_patrons([patron_cache.PatreonRecord(
+        email="other.patron@example.com", full_name="Other Patron", patron_status="active_patron",
+        currently_entitled_amount_cents=500, is_gifted=False, sum_of_entitled_tiers_amount_cents=500)])
+
+
+@pytest.fixture
+def linked_user(db):
+    with Session(db) as session:
+        session.add(models.User(tg_id=TG_ID, tg_username="webhook_patron"))
+        session.flush()
+        session.add(models.PatreonLink(tg_id=TG_ID, tg_username="webhook_patron", patreon_email=EMAIL))
+        session.commit()
+    yield TG_ID
+    with Session(db) as session:
+        session.execute(delete(models.EffectiveMembership).where(models.EffectiveMembership.tg_id == TG_ID))
+        session.execute(delete(models.PatreonLink).where(models.PatreonLink.tg_id == TG_ID))
+        session.execute(delete(models.User).where(models.User.tg_id == TG_ID))
+        session.commit()
+
+
+@pytest.fixture
+def published(monkeypatch):
+    changes = []
+
+    async def record(bot, new_changes):
+        changes.extend(new_changes)
+
+    monkeypatch.setattr(level_changes, "_listeners", [record])
+    return changes
+
+
+async def post(payloads: list[tuple[str, bytes]], secret: str = None) -> list[int]:
+    statuses = []
+    async with TestClient(TestServer(patreon_webhook.make_app(bot=None))) as client:
+        for event, body in payloads:
+            signature = hmac.new((secret or settings.PATREON_WEBHOOK_SECRET).encode(), body, hashlib.md5).hexdigest()
+            response = await client.post(settings.PATREON_WEBHOOK_PATH, data=body, headers={
+                "Content-Type": "application/json",
+                "X-Patreon-Event": event,
+                "X-Patreon-Signature": signature,
+            })
+            statuses.append(response.status)
+    # the async engine's connections belong to this event loop
+    await models.async_engine.dispose()
+    return statuses
+
+
+def payload(name: str) -> tuple[str, bytes]:
+    return name.replace("_", ":", 1), (PAYLOADS / f"{name}.json").read_bytes()
+
+
+def test_wrong_signature_is_rejected(stored_patrons):
+    assert asyncio.run(post([payload("members_create")], secret="wrong-secret")) == [403]
+    assert patron_cache.get_patron(EMAIL) is None
+
+
+def test_member_without_email_is_acknowledged(stored_patrons):
+    event, body = payload("members_create")
+    assert asyncio.run(post([(event, body.replace(EMAIL.encode(), b""))])) == [204]
+    assert patron_cache.get_patreon_summary()["active_patron"].count == 1
+
+
+def test_create_update_and_delete_are_applied(stored_patrons, linked_user, published):
+    assert asyncio.run(post([payload("members_create")])) == [204]
+    assert patron_cache.get_patron(EMAIL).sum_of_entitled_tiers_amount_cents == 500
+    assert patron_cache.get_patreon_summary()["active_patron"].count == 2
+    assert published == []
+
+    assert asyncio.run(post([payload("members_update")])) == [204]
+    assert patron_cache.get_patron(EMAIL).sum_of_entitled_tiers_amount_cents == 1500
+    assert patron_cache.get_patreon_summary()["active_patron"].total == 2000
+    assert [(change.tg_id, change.is_upgrade) for change in published] == [(linked_user, True)]
+
+    assert asyncio.run(post([payload("members_delete")])) == [204]
+    assert patron_cache.get_patron(EMAIL) is None
+    assert patron_cache.get_patreon_summary()["active_patron"].count == 1
+    assert [(change.tg_id, change.is_upgrade) for change in published] == [(linked_user, True), (linked_user, False)]
+
+
+def without_tier_amounts(body: bytes, currently_entitled_amount_cents: int) -> bytes:
+    data = json.loads(body)
+    for included in data["included"]:
+        included["attributes"].pop("amount_cents", None)
+    data["data"]["attributes"]["currently_entitled_amount_cents"] = currently_entitled_amount_cents
+    return json.dumps(data).encode()
+
+
+def test_amount_is_the_one_a_full_reload_computes(db, stored_patrons):
+    event, body = payload("members_update")
+    data = json.loads(body)
+    data["data"]["attributes"]["currently_entitled_amount_cents"] = 700
+    assert asyncio.run(post([(event, json.dumps(data).encode())])) == [204]
+    reloaded = fetch_patrons.parse_page({"data": [data["data"]], "included": data["included"]}, {})[0]
+    assert patron_cache.get_patron(EMAIL) == patron_cache.PatreonRecord.from_api(reloaded)
+    assert patron_cache.get_patron(EMAIL).sum_of_entitled_tiers_amount_cents == 1500
+
+
+def test_stored_amount_is_kept_without_tier_amounts(db, stored_patrons):
+    event, body = payload("members_update")
+    assert asyncio.run(post([payload("members_update"), (event, without_tier_amounts(body, 700))])) == [204, 204]
+    assert patron_cache.get_patron(EMAIL).sum_of_entitled_tiers_amount_cents == 1500
+    assert patron_cache.get_patron(EMAIL).currently_entitled_amount_cents == 700
+    assert patron_cache.get_patreon_summary()["active_patron"].total == 2000
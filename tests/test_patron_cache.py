@@ -0,0 +1,80 @@
+import fakeredis
+import pytest
+
+from membership import patron_cache
+
+# Full reloads and webhooks write the same generation in fakeredis. A reload only writes what differs from the stored
+# generation and returns the ids it changed.
+
+
+def patron(email: str, amount: int, patron_status: str = "active_patron") -> patron_cache.PatreonRecord:
+    return patron_cache.PatreonRecord(email=email, full_name=email, patron_status=patron_status,
+                                      currently_entitled_amount_cents=amount, is_gifted=False,
+                                      sum_of_entitled_tiers_amount_cents=amount)
+
+
+@pytest.fixture(autouse=True)
+def redis(monkeypatch):
+    monkeypatch.setattr(patron_cache, "r", fakeredis.FakeRedis(decode_responses=True))
+
+
+def amounts() -> dict[str, int]:
+    return {record.email: record.sum_of_entitled_tiers_amount_cents for record in patron_cache.all_patrons()}
+
+
+def test_first_reload_reports_everything_as_changed():
+    assert patron_cache.store_patrons([patron("a@example.com", 1500)]) is None
+    assert amounts() == {"a@example.com": 1500}
+
+
+def test_reload_returns_added_changed_and_removed_patrons():
+    patron_cache.store_patrons([patron("a@example.com", 1500), patron("b@example.com", 500),
+                                patron("c@example.com", 500)])
+    generation = patron_cache.current_generation(patron_cache.patreon)
+
+    changed = patron_cache.store_patrons([patron("a@example.com", 1500), patron("b@example.com", 2000),
+                                          patron("d@example.com", 500, "former_patron")])
+    assert changed == {"b@example.com", "c@example.com", "d@example.com"}
+    # the diff is written into the same generation
+    assert patron_cache.current_generation(patron_cache.patreon) == generation
+    assert amounts() == {"a@example.com": 1500, "b@example.com": 2000, "d@example.com": 500}
+    assert patron_cache.get_patron_emails_by_amount(1500) == {"a@example.com", "b@example.com"}
+    summary = patron_cache.get_patreon_summary()
+    assert (summary["active_patron"].count, summary["active_patron"].total) == (2, 3500)
+    assert (summary["former_patron"].count, summary["former_patron"].total) == (1, 500)
+    assert patron_cache.store_patrons([patron("a@example.com", 1500), patron("b@example.com", 2000),
+                                       patron("d@example.com", 500, "former_patron")]) == set()
+
+
+def test_webhook_racing_a_reload_is_in_its_diff(monkeypatch):
+    patron_cache.store_patrons([patron("a@example.com", 1500), patron("b@example.com", 500)])
+    read_derived = patron_cache.read_derived
+    reads = []
+
+    def read_derived_with_a_webhook(space, generation):
+        # the webhook lands after the reload has read the patrons and before it writes its diff
+        if not reads:
+            assert patron_cache.apply_patron("b@example.com", patron("b@example.com", 2000))
+        reads.append(generation)
+        return read_derived(space, generation)
+
+    monkeypatch.setattr(patron_cache, "read_derived", read_derived_with_a_webhook)
+    changed = patron_cache.store_patrons([patron("a@example.com", 1500), patron("b@example.com", 500)])
+    # the first diff was made before the webhook and is thrown away, the second one reverts it to the snapshot
+    assert len(reads) == 2
+    assert changed == {"b@example.com"}
+    assert amounts() == {"a@example.com": 1500, "b@example.com": 500}
+    assert patron_cache.get_patron_emails_by_amount(1500) == {"a@example.com"}
+    assert patron_cache.get_patreon_summary()["active_patron"].total == 2000
+
+
+def test_webhook_keeps_the_stored_amount_when_asked():
+    patron_cache.store_patrons([patron("a@example.com", 1500)])
+    assert patron_cache.apply_patron("a@example.com", patron("a@example.com", 0, "declined_patron"), keep_amount=True)
+    assert patron_cache.get_patrons(["a@example.com"])["a@example.com"].patron_status == "declined_patron"
+    assert amounts() == {"a@example.com": 1500}
+
+
+def test_webhook_before_the_first_reload_is_not_stored():
+    assert not patron_cache.apply_patron("a@example.com", patron("a@example.com", 1500))
+    assert amounts() == {}
@@ -0,0 +1,92 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+import models
+from notifications import broadcast_engine, broadcast_jobs, notifications, notifications_helpers, rendering
+
+# A planned reminder keeps its resolved recipients and rendered message until it starts. At start time it is replanned
+# only if its fingerprint changed. Emails and the Telegram fan-out are replaced, so the tests see the job the runner
+# would get.
+
+TG_IDS = ["-700501", "-700502"]
+AUDIENCE = {"kind": "course", "course_id": 1}
+
+
+@pytest.fixture
+def planned_job(db, monkeypatch):
+    monkeypatch.setattr(notifications, "render_zoom_reminders",
+                        lambda course_ids, minutes_left: f"call in {minutes_left} minutes")
+
+    async def no_emails(*args):
+        pass
+
+    monkeypatch.setattr(notifications_helpers, "email_notifications", no_emails)
+    job_id = broadcast_jobs.create_job(
+        name="Test course", idempotency_key=f"test-zoom-reminder-{datetime.datetime.utcnow().isoformat()}",
+        payload=rendering.text_payload("planned message", parse_mode="HTML"), audience_spec=AUDIENCE,
+        priority=broadcast_engine.REMINDER_PRIORITY,
+        expires_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=10, seconds=20),
+        status=broadcast_jobs.PLANNED, plan_fingerprint="planned")
+
+    async def store() -> None:
+        await broadcast_jobs.store_recipients(job_id, TG_IDS)
+        await broadcast_jobs.mark_audience_resolved(job_id)
+        await models.async_engine.dispose()
+
+    asyncio.run(store())
+    yield job_id
+    with Session(db) as session:
+        session.execute(delete(models.BroadcastJob).where(models.BroadcastJob.id == job_id))
+        session.commit()
+
+
+def start(job_id: int, fingerprint: str, monkeypatch) -> models.BroadcastJob:
+    started = []
+
+    async def run_job(bot, job_id):
+        started.append(broadcast_jobs.get_job(job_id))
+
+    monkeypatch.setattr(notifications, "get_zoom_plan_fingerprint", lambda audience_spec: fingerprint)
+    monkeypatch.setattr(broadcast_jobs, "run_job", run_job)
+    asyncio.run(notifications.send_zoom_reminder(SimpleNamespace(job=SimpleNamespace(data={"job_id": job_id}),
+                                                                 bot=None)))
+    assert len(started) == 1
+    return started[0]
+
+
+def recipient_ids(job_id: int) -> list[str]:
+    with Session(models.engine) as session:
+        return sorted(session.scalars(select(models.BroadcastRecipient.tg_id)
+                                      .where(models.BroadcastRecipient.job_id == job_id)))
+
+
+def test_unchanged_plan_starts_as_it_was_planned(planned_job, monkeypatch):
+    job = start(planned_job, "planned", monkeypatch)
+    assert job.status == broadcast_jobs.RUNNING
+    assert job.payload["text"] == "planned message"
+    assert job.is_audience_resolved
+    assert recipient_ids(planned_job) == sorted(TG_IDS)
+
+
+def test_outdated_plan_is_rendered_and_resolved_again(planned_job, monkeypatch):
+    job = start(planned_job, "changed", monkeypatch)
+    assert job.status == broadcast_jobs.RUNNING
+    # the message counts the minutes from the start, not from when it was planned
+    assert job.payload["text"] == "call in 10 minutes"
+    assert job.plan_fingerprint == "changed"
+    # the runner resolves the audience again
+    assert not job.is_audience_resolved
+    assert recipient_ids(planned_job) == []
+
+
+def test_cancelled_plan_is_not_started(planned_job, monkeypatch):
+    broadcast_jobs.set_job_status(planned_job, broadcast_jobs.CANCELLED)
+    monkeypatch.setattr(broadcast_jobs, "run_job", None)
+    asyncio.run(notifications.send_zoom_reminder(SimpleNamespace(job=SimpleNamespace(data={"job_id": planned_job}),
+                                                                 bot=None)))
+    assert broadcast_jobs.get_job(planned_job).status == broadcast_jobs.CANCELLED